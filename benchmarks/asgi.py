@@ -0,0 +1,112 @@
+"""
+Sync (gunicorn) versus async (uvicorn) serving benchmark
+
+Opens `--concurrency` client connections at once against each base URL and
+has every client fetch a wishlist `--requests` times. With `--slow` each
+client trickles its request line and waits that many seconds before sending
+the rest, like a client on a slow network, which holds a gunicorn sync worker
+but costs the event loop nothing. Throughput, latency percentiles and errors
+are printed for each server.
+
+Start both servers against the same database, then run:
+
+    gunicorn --workers=1 --bind=127.0.0.1:8000 service.wsgi:app
+    uvicorn --workers 1 --port 8001 service.asgi:app
+    python -m benchmarks.asgi --concurrency 2000 --slow 0.5 \\
+        http://127.0.0.1:8000 http://127.0.0.1:8001
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+async def request(host, port, method, path, body=None, slow=0, timeout=60):
+    """Sends one HTTP/1.1 request on a new connection, returns (status, body)"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        head = "{} {} HTTP/1.1\r\nHost: {}:{}\r\n".format(method, path, host, port)
+        writer.write(head.encode("latin-1"))
+        await writer.drain()
+        if slow:
+            await asyncio.sleep(slow)
+        rest = "Content-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+        writer.write(rest.format(len(payload)).encode("latin-1") + payload)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    status_line, _, rest = response.partition(b"\r\n")
+    _, _, content = rest.partition(b"\r\n\r\n")
+    return int(status_line.split()[1]), content
+
+
+async def client(host, port, path, args, latencies, errors):
+    """One client fetching the same resource again and again"""
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        try:
+            code, _ = await request(host, port, "GET", path, slow=args.slow, timeout=args.timeout)
+        except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+            errors.append(None)
+            continue
+        if code != 200:
+            errors.append(code)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def measure(base_url, args):
+    """Runs every client against one server and returns its results"""
+    url = urlsplit(base_url)
+    host, port = url.hostname, url.port or 80
+    code, content = await request(
+        host, port, "POST", "/api/wishlists", {"name": "benchmark", "customer_id": "bench"}
+    )
+    if code != 201:
+        raise SystemExit("Could not create a wishlist on {} ({})".format(base_url, code))
+    path = "/api/wishlists/{}".format(json.loads(content)["id"])
+
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        client(host, port, path, args, latencies, errors) for _ in range(args.concurrency)
+    ])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": elapsed,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": 1000 * statistics.median(latencies) if latencies else None,
+        "p99_ms": 1000 * latencies[int(len(latencies) * 0.99) - 1] if latencies else None,
+    }
+
+
+def main():
+    """Compares the sync and async servers"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("sync_url", help="base URL of the gunicorn (Flask) server")
+    parser.add_argument("async_url", help="base URL of the uvicorn (ASGI) server")
+    parser.add_argument("--concurrency", type=int, default=1000, help="clients connected at once")
+    parser.add_argument("--requests", type=int, default=5, help="requests sent by every client")
+    parser.add_argument("--slow", type=float, default=0.0, help="seconds every client stalls mid request")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    print("{:<8} {:>9} {:>7} {:>9} {:>10} {:>10}".format("server", "requests", "errors", "rps", "p50 (ms)", "p99 (ms)"))
+    for name, base_url in (("sync", args.sync_url), ("async", args.async_url)):
+        result = asyncio.run(measure(base_url, args))
+        print("{:<8} {:>9} {:>7} {:>9.1f} {:>10} {:>10}".format(
+            name, result["requests"], result["errors"], result["rps"],
+            "-" if result["p50_ms"] is None else "{:.1f}".format(result["p50_ms"]),
+            "-" if result["p99_ms"] is None else "{:.1f}".format(result["p99_ms"]),
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Serialization benchmark for the list endpoints
+
+Times encoding a list of Items to JSON the way the list endpoints used to
+(serialize(), then marshal() through the Swagger model, then json.dumps)
+against the compiled serializer with every available JSON backend. No
+database is needed, the Items are built in memory.
+
+    python -m benchmarks.serialization --items 5000 --runs 50
+"""
+import argparse
+import json
+import time
+from flask_restx import marshal
+from service.models import Item, serialize_item
+from service.routes import item_model
+from service.serializers import orjson, stdlib_dumps
+
+
+def marshalled(items):
+    """The old path: serialize(), marshal() and the stdlib encoder"""
+    return json.dumps(marshal([item.serialize() for item in items], item_model)).encode("utf-8")
+
+
+def compiled(dumps):
+    """The fast path with one JSON backend"""
+    return lambda items: dumps([serialize_item(item) for item in items])
+
+
+def timed(encode, items, runs):
+    """Mean milliseconds per encode of the whole list"""
+    encode(items)
+    start = time.perf_counter()
+    for _ in range(runs):
+        encode(items)
+    return (time.perf_counter() - start) * 1000 / runs
+
+
+def main():
+    """Compares marshalling with the compiled serializer"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=5000, help="items in the list")
+    parser.add_argument("--runs", type=int, default=50, help="encodes timed per path")
+    args = parser.parse_args()
+
+    items = [
+        Item(id=n, name="item{}".format(n), wishlist_id=n % 100 + 1, purchased=n % 3 == 0)
+        for n in range(args.items)
+    ]
+    paths = {"marshal_with + json": marshalled, "compiled + json": compiled(stdlib_dumps)}
+    if orjson is not None:
+        paths["compiled + orjson"] = compiled(orjson.dumps)
+
+    baseline = timed(marshalled, items, args.runs)
+    print("{:<22} {:>12} {:>9}".format("path", "mean (ms)", "speedup"))
+    for name, encode in paths.items():
+        mean_ms = baseline if encode is marshalled else timed(encode, items, args.runs)
+        print("{:<22} {:>12.3f} {:>8.1f}x".format(name, mean_ms, baseline / mean_ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import tempfile
 import logging
 import json
 import sqlalchemy.pool as pool
@@ -13,16 +14,90 @@ if 'VCAP_SERVICES' in os.environ:
     vcap = json.loads(os.environ['VCAP_SERVICES'])
     DATABASE_URI = vcap['user-provided'][0]['credentials']['url']
 
+# Connection pool sizing. Every gunicorn worker owns its own pool, so the
+# defaults give each request thread one connection and split the
+# DB_MAX_CONNECTIONS budget between the workers for bursts.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+GUNICORN_THREADS = int(os.getenv("GUNICORN_THREADS", "1"))
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "20"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(GUNICORN_THREADS)))
+DB_MAX_OVERFLOW = int(
+    os.getenv(
+        "DB_MAX_OVERFLOW",
+        str(max(0, DB_MAX_CONNECTIONS // max(1, WEB_CONCURRENCY) - DB_POOL_SIZE)),
+    )
+)
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "yes")
+# The async (ASGI) workers serve every request from one event loop, so
+# each one gets its share of the connection budget as a single pool.
+ASYNC_DB_POOL_SIZE = int(
+    os.getenv("ASYNC_DB_POOL_SIZE", str(max(1, DB_MAX_CONNECTIONS // max(1, WEB_CONCURRENCY))))
+)
+
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SQLALCHEMY_ENGINE_OPTIONS = {
     "poolclass": pool.QueuePool,
-    "pool_size": 1,
-    "max_overflow": -1,
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING,
     "isolation_level": "AUTOCOMMIT"
 }
 
+# Health checks: the database is pinged every HEALTH_INTERVAL seconds in the
+# background. A worker stops being ready when the last ping failed or is
+# older than HEALTH_MAX_AGE (0 for three intervals), or when the share of
+# its pool connections in use reaches HEALTH_POOL_SATURATION.
+HEALTH_INTERVAL = float(os.getenv("HEALTH_INTERVAL", "5"))
+HEALTH_TIMEOUT = float(os.getenv("HEALTH_TIMEOUT", "2"))
+HEALTH_MAX_AGE = float(os.getenv("HEALTH_MAX_AGE", "0"))
+HEALTH_POOL_SATURATION = float(os.getenv("HEALTH_POOL_SATURATION", "1"))
+
+# Read-through cache for model lookups: "auto", "memory", "redis" or "none".
+# A memory cache does not see the invalidations of the other workers, so
+# "auto" only uses it with a single worker. With more it uses redis when
+# CACHE_URL is set, and no cache otherwise.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "auto")
+CACHE_URL = os.getenv("CACHE_URL", "")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+
+# Encoder for the list endpoints: "auto" (orjson when installed), "orjson" or "json"
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto")
+
+# Logging: records are written by a background thread from a bounded queue
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_LENGTH = int(os.getenv("LOG_MAX_LENGTH", "2048"))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+# SQL statements: a Server-Timing header on every response, and a log of
+# the statements slower than SLOW_QUERY_MS (-1 turns it off), with their
+# EXPLAIN ANALYZE plan when SLOW_QUERY_EXPLAIN is set
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() in ("true", "1", "yes")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "false").lower() in ("true", "1", "yes")
+
+# Request metrics on /metrics. Set METRICS_DIR to a directory shared by the
+# gunicorn workers so that every worker reports the totals of all of them.
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+METRICS_BUCKETS = os.getenv("METRICS_BUCKETS", "")
+
+# On-demand request profiles, written to PROFILE_DIR. A request is profiled
+# when it has an X-Profile header signed with PROFILE_SECRET, or falls in
+# the PROFILE_SAMPLE_RATE fraction of traffic; both are off by default.
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "wishlists-profiles"))
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "200"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
@@ -0,0 +1,40 @@
+"""
+gunicorn settings for the Wishlists Service
+
+gunicorn reads this file from the working directory. Settings given on
+the command line (see Procfile) take precedence.
+
+Set PRELOAD_APP=true to import the app once in the master process and fork
+the workers from it, which makes worker startup much cheaper. The app does
+not connect to the database on import. Any connection the master did open
+is closed before forking, so workers never share a database socket.
+
+With METRICS_DIR set, the workers share their request metrics through
+files in that directory; the files of an earlier run are removed when
+gunicorn starts.
+"""
+import os
+
+preload_app = os.getenv("PRELOAD_APP", "false").lower() in ("true", "1", "yes")
+
+
+def on_starting(server):
+    """Forgets the request metrics of the previous run
+
+    Done here rather than through service.metrics, so the master does not
+    import the app unless PRELOAD_APP is set.
+    """
+    directory = os.getenv("METRICS_DIR", "")
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.startswith(("metrics_", ".metrics_")):
+                os.remove(os.path.join(directory, name))
+
+
+def pre_fork(server, worker):
+    """Closes the master's pooled connections before a worker is forked"""
+    if server.cfg.preload_app:
+        from service import app
+        from service.models import db
+        with app.app_context():
+            db.engine.dispose()
@@ -1,10 +1,11 @@
 """
 Package: service
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+This module creates the Flask app and registers its routes. Importing it
+reads no settings, starts no threads and does not connect to the SQL
+database: create_app() configures the app, and service.wsgi is the module
+that gunicorn and the flask command load it from.
 """
-import sys
 import logging
 from flask import Flask
 
@@ -16,34 +17,67 @@ app = Flask(__name__, static_folder="../app")
 app.config.from_object("config")
 
 # Import the routes after the Flask app is created
-from service import routes, models, error_handler
+from service import routes, models, error_handler, migrations, log, profiler, metrics, health, purge
+from service.serializers import backend_from_name
 
-# Set up logging for production
-print("Setting up logging for {}...".format(__name__))
-app.logger.propagate = False
-if __name__ != "__main__":
+
+def create_app(config=None):
+    """Configures the service's Flask app and returns it
+
+    Applies `config` over the settings from config.py, then sets up
+    everything that reads them: logging, the database engine options and
+    the cache, the request metrics, the health checks, the background
+    purges, the JSON encoder and the profiler. Nothing here connects to
+    the database: the engine and its connections are created by the first
+    request that needs them, and the tables are created by `flask migrate`.
+    That keeps startup fast and lets gunicorn preload the app before
+    forking its workers.
+
+    The app is configured once per process. Later calls return it as it
+    is, and raise RuntimeError if they pass settings. The limits and
+    tunables the modules read from the environment when they are imported
+    (PAGE_SIZE, MAX_PAGE_SIZE, MAX_BATCH_SIZE, the RETRY_* and BREAKER_*
+    settings, PURGE_THRESHOLD, PURGE_BATCH_SIZE, TOMBSTONE_TTL_DAYS,
+    SEARCH_THRESHOLD and SYNC_WINDOW) can only be set in the environment.
+
+    :param config: settings that override the ones from config.py
+    :type config: dict
+
+    :return: the configured app
+    :rtype: Flask
+
+    """
+    if app.extensions.get("configured"):
+        if config:
+            raise RuntimeError("The app is already configured, its settings can no longer change")
+        return app
+    if config:
+        app.config.update(config)
+
+    # Set up logging for production
+    app.logger.propagate = False
     gunicorn_logger = logging.getLogger("gunicorn.error")
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
-    # app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s",
-        "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
-    app.logger.info("Logging handler established")
-
-app.logger.info(70 * "*")
-app.logger.info("  W I S H L I S T S   S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
-
-try:
-    models.init_db(app)
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
-
-app.logger.info("Service inititalized!")
+    if gunicorn_logger.level:
+        app.logger.setLevel(gunicorn_logger.level)
+    # Records go through a queue and are written by a background thread
+    log.init_logging(app, gunicorn_logger.handlers or [logging.StreamHandler()])
+
+    models.init_app(app)
+    # times every request by the Resource that serves it
+    metrics.init_metrics(app)
+    # pings the database in the background for the readiness probe
+    health.init_health(app)
+    # deletes Wishlists with more than PURGE_THRESHOLD Items in the background
+    purge.init_purger(app)
+    # encoder for the list endpoints, which skip marshalling
+    app.extensions["json_backend"] = backend_from_name(app.config.get("JSON_BACKEND", "auto"))
+    # Profile the requests that ask for it, after the other request hooks so
+    # the profile covers little more than the dispatch itself
+    profiler.init_profiler(app)
+    app.extensions["configured"] = True
+
+    app.logger.info(70 * "*")
+    app.logger.info("  W I S H L I S T S   S E R V I C E   R U N N I N G  ".center(70, "*"))
+    app.logger.info(70 * "*")
+    app.logger.info("Service inititalized!")
+    return app
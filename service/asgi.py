@@ -0,0 +1,687 @@
+"""
+Module: asgi
+
+Async (ASGI) entry point for the Wishlists Service
+
+Serves the same /api/wishlists resource tree as the Flask routes, but on an
+asyncio event loop with the asyncpg backed queries in service.async_models,
+so a single process keeps thousands of slow clients in flight while their
+queries wait for the database:
+
+    uvicorn --workers ${WEB_CONCURRENCY:-1} service.asgi:app
+
+Request bodies, response bodies, error messages, paging headers and ETags
+match the Flask routes. The Swagger UI, static pages and /stats endpoints
+are only served by the Flask app. /metrics reports the requests served by
+this app, labelled with the name of the handler that served them, of every
+worker when METRICS_DIR is set, and
+/health/live and /health/ready answer from a database ping that a
+background task repeats on a connection outside of the pool.
+"""
+import asyncio
+import json
+import logging
+import re
+import time
+from datetime import datetime
+from urllib.parse import parse_qs, urlencode
+from flask_restx import inputs
+from werkzeug.http import parse_date, parse_etags
+from service import create_app
+from service import status  # HTTP Status Codes
+from service.models import Item, DataValidationError, PAGE_SIZE, MAX_PAGE_SIZE, MAX_BATCH_SIZE, purchase_selector
+from service.models import ITEM_FIELDS, ITEM_SORT_COLUMNS, PURGE_THRESHOLD, parse_fields, parse_sort
+from service.routes import conditional_headers, items_representation
+from service.health import HealthCheck
+from service.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from service.async_models import database, AsyncWishlist, AsyncItem
+
+# the settings, request metrics and logging are the Flask app's
+flask_app = create_app()
+metrics = flask_app.extensions["metrics"]
+
+logger = logging.getLogger("flask.app")
+
+ROUTES = []
+
+# background purges of large Wishlists, by id, kept so the tasks are not garbage collected
+PURGES = {}
+
+# the last database ping of the pinging task started with the app
+health = HealthCheck(
+    interval=flask_app.config.get("HEALTH_INTERVAL", 5.0),
+    max_age=flask_app.config.get("HEALTH_MAX_AGE", 0),
+    saturation=flask_app.config.get("HEALTH_POOL_SATURATION", 1.0),
+)
+HEALTH_TIMEOUT = flask_app.config.get("HEALTH_TIMEOUT", 2.0)
+
+
+class HTTPError(Exception):
+    """Raised by a handler to answer with an error status"""
+
+    def __init__(self, status_code, message, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.headers = headers or {}
+
+
+class Request:
+    """The parts of an ASGI http scope the handlers need"""
+
+    def __init__(self, scope, body=b""):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.scheme = scope.get("scheme", "http")
+        self.server = scope.get("server") or ("localhost", 80)
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        self.args = {key: values[-1] for key, values in query.items()}
+        self.headers = {
+            key.decode("latin-1").lower(): value.decode("latin-1")
+            for key, value in scope.get("headers", [])
+        }
+        self.body = body
+
+    @property
+    def mimetype(self):
+        """The media type of the body without its parameters"""
+        return self.headers.get("content-type", "").split(";")[0].strip().lower()
+
+    def get_json(self):
+        """Parses the body as JSON"""
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError:
+            raise HTTPError(
+                status.HTTP_400_BAD_REQUEST,
+                "The browser (or proxy) sent a request that this server could not understand."
+            )
+
+    def url_for(self, path, **params):
+        """Builds an absolute URL on this server, dropping empty parameters"""
+        host = self.headers.get("host") or "{}:{}".format(*self.server)
+        query = urlencode({key: value for key, value in params.items() if value is not None})
+        return "{}://{}{}{}".format(self.scheme, host, path, "?" + query if query else "")
+
+
+class Response:
+    """A response whose body is bytes or an async iterator of bytes"""
+
+    def __init__(self, body=b"", status_code=status.HTTP_200_OK, headers=None,
+                 media_type="application/json"):
+        self.body = body
+        self.status_code = status_code
+        self.headers = dict(headers or {})
+        if media_type and body:
+            self.headers.setdefault("Content-Type", media_type)
+
+    async def __call__(self, send):
+        headers = [
+            (key.lower().encode("latin-1"), str(value).encode("latin-1"))
+            for key, value in self.headers.items()
+        ]
+        if isinstance(self.body, bytes):
+            headers.append((b"content-length", str(len(self.body)).encode("latin-1")))
+            await send({"type": "http.response.start", "status": self.status_code, "headers": headers})
+            await send({"type": "http.response.body", "body": self.body})
+            return
+        await send({"type": "http.response.start", "status": self.status_code, "headers": headers})
+        async for chunk in self.body:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def json_response(data, status_code=status.HTTP_200_OK, headers=None):
+    """Serializes data as the body of a JSON response"""
+    return Response(json.dumps(data).encode("utf-8"), status_code, headers)
+
+
+def route(path, *methods):
+    """Registers a handler for a path whose {placeholders} are integer ids"""
+    pattern = re.compile("^" + re.sub(r"{(\w+)}", r"(?P<\1>[0-9]{1,9})", path) + "/?$")
+
+    def decorator(handler):
+        ROUTES.append((pattern, methods, handler))
+        return handler
+    return decorator
+
+
+def resolve(method, path):
+    """Returns the handler for a request and its path parameters"""
+    allowed = set()
+    for pattern, methods, handler in ROUTES:
+        match = pattern.match(path)
+        if not match:
+            continue
+        if method in methods:
+            return handler, {key: int(value) for key, value in match.groupdict().items()}
+        allowed.update(methods)
+    if allowed:
+        raise HTTPError(
+            status.HTTP_405_METHOD_NOT_ALLOWED,
+            "The method is not allowed for the requested URL.",
+            {"Allow": ", ".join(sorted(allowed))},
+        )
+    raise HTTPError(
+        status.HTTP_404_NOT_FOUND,
+        "The requested URL was not found on the server. If you entered the URL manually "
+        "please check your spelling and try again.",
+    )
+
+
+######################################################################
+# ASGI application
+######################################################################
+async def app(scope, receive, send):
+    """The ASGI application callable"""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    request = Request(scope, body)
+
+    start = time.perf_counter()
+    try:
+        handler, params = resolve(request.method, request.path)
+    except HTTPError as error:
+        handler, response = None, error_response(error)
+    resource = handler.__name__ if handler else "unmatched"
+    metrics.started(resource, request.method)
+    status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    try:
+        if handler:
+            response = await respond(handler, request, params)
+        status_code = response.status_code
+    finally:
+        metrics.finished(resource, request.method, status_code, time.perf_counter() - start)
+    await response(send)
+
+
+def error_response(error):
+    """Answers with the status and message of an HTTPError"""
+    logger.error(error.message)
+    return json_response({"message": error.message}, error.status_code, error.headers)
+
+
+async def respond(handler, request, params):
+    """Runs a handler, turning the errors it raises into responses"""
+    try:
+        response = await handler(request, **params)
+    except NotModified as error:
+        response = Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=error.headers)
+    except HTTPError as error:
+        response = error_response(error)
+    except DataValidationError as error:
+        logger.error(str(error))
+        response = json_response({
+            "status_code": status.HTTP_400_BAD_REQUEST,
+            "error": "Bad Request",
+            "message": str(error)
+        }, status.HTTP_400_BAD_REQUEST)
+    except database.unavailable_errors as error:
+        message = "Database unavailable: {}".format(error.__class__.__name__)
+        logger.critical(message)
+        response = json_response({
+            "status_code": status.HTTP_503_SERVICE_UNAVAILABLE,
+            "error": "Service Unavailable",
+            "message": message
+        }, status.HTTP_503_SERVICE_UNAVAILABLE)
+    return response
+
+
+async def lifespan(receive, send):
+    """Opens the database pool on startup and closes it on shutdown"""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # each uvicorn worker flushes its totals for the others' /metrics
+            metrics.start_flusher()
+            try:
+                await database.connect(
+                    flask_app.config["DATABASE_URI"],
+                    max_size=flask_app.config["ASYNC_DB_POOL_SIZE"],
+                )
+            except Exception as error:  # pylint: disable=broad-except
+                logger.critical("%s: Cannot continue", error)
+                await send({"type": "lifespan.startup.failed", "message": str(error)})
+                return
+            pinger = asyncio.ensure_future(ping_forever())
+            logger.info("Async service initialized!")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            pinger.cancel()
+            await database.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def ping_forever():
+    """Pings the database into the HealthCheck until the app shuts down"""
+    while True:
+        start = time.perf_counter()
+        try:
+            await database.ping(HEALTH_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:  # pylint: disable=broad-except
+            health.record(False, time.perf_counter() - start, error.__class__.__name__)
+            logger.warning("Database ping failed: %s", error)
+        else:
+            health.record(True, time.perf_counter() - start)
+        await asyncio.sleep(health.interval)
+
+######################################################################
+#  PATH: /wishlists/{id}
+######################################################################
+@route("/api/wishlists/{wishlist_id}", "GET")
+async def get_wishlist(request, wishlist_id):
+    """Retrieve a single Wishlist"""
+    expand = expand_arg(request)
+    wishlist = await find_wishlist_or_404(wishlist_id)
+    if not expand:
+        headers = check_not_modified(request, wishlist, "wishlist")
+        return json_response(wishlist, status.HTTP_200_OK, headers)
+    headers = check_not_modified(request, wishlist, "wishlist+items")
+    wishlist = dict(wishlist, items=await AsyncItem.find_by_wishlist_id(wishlist_id))
+    return json_response(wishlist, status.HTTP_200_OK, headers)
+
+
+@route("/api/wishlists/{wishlist_id}", "PUT")
+async def update_wishlist(request, wishlist_id):
+    """Update a Wishlist"""
+    check_content_type(request, "application/json")
+    wishlist = await AsyncWishlist.update(wishlist_id, request.get_json())
+    if not wishlist:
+        raise HTTPError(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+    logger.info("Wishlist with ID [%s] updated.", wishlist_id)
+    return json_response(wishlist)
+
+
+@route("/api/wishlists/{wishlist_id}", "DELETE")
+async def delete_wishlist(request, wishlist_id):
+    """Delete a Wishlist, in the background if it has very many Items"""
+    if await AsyncItem.has_more_than(wishlist_id, PURGE_THRESHOLD):
+        if wishlist_id not in PURGES:
+            task = asyncio.ensure_future(AsyncWishlist.purge(wishlist_id))
+            PURGES[wishlist_id] = task
+            task.add_done_callback(lambda _: PURGES.pop(wishlist_id, None))
+        logger.info("Wishlist with id [%s] was queued for deletion", wishlist_id)
+        return Response(status_code=status.HTTP_202_ACCEPTED)
+    await AsyncWishlist.delete(wishlist_id)
+    logger.info("Wishlist with id [%s] was deleted", wishlist_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+######################################################################
+#  PATH: /wishlists
+######################################################################
+@route("/api/wishlists", "GET")
+async def list_wishlists(request):
+    """Returns all of the Wishlists, streamed or one keyset page at a time"""
+    customer_id = int_arg(request, "customer_id")
+    limit = int_arg(request, "limit", 1, MAX_PAGE_SIZE)
+    after = int_arg(request, "after")
+    expand = expand_arg(request)
+
+    if limit is None and after is None:
+        if expand:
+            return Response(stream_json_list(expanded_pages(customer_id)))
+        return Response(stream_json_list(AsyncWishlist.iter_pages(customer_id=customer_id)))
+
+    # fetch one extra row to find out whether there is a next page
+    limit = limit or PAGE_SIZE
+    wishlists = await AsyncWishlist.find_page(after=after, limit=limit + 1, customer_id=customer_id)
+    headers = {}
+    if len(wishlists) > limit:
+        wishlists = wishlists[:limit]
+        cursor = wishlists[-1]["id"]
+        next_url = request.url_for(request.path, after=cursor, limit=limit, customer_id=customer_id, expand=expand)
+        headers["Link"] = '<{}>; rel="next"'.format(next_url)
+        headers["X-Next-Cursor"] = str(cursor)
+    if expand:
+        wishlists = await AsyncWishlist.with_items(wishlists)
+    return json_response(wishlists, status.HTTP_200_OK, headers)
+
+
+async def expanded_pages(customer_id):
+    """Yields every Wishlist with its Items, one Item query per page"""
+    async for page in AsyncWishlist.pages(customer_id=customer_id):
+        for wishlist in await AsyncWishlist.with_items(page):
+            yield wishlist
+
+
+@route("/api/wishlists", "POST")
+async def create_wishlist(request):
+    """Creates a Wishlist"""
+    check_content_type(request, "application/json")
+    wishlist = await AsyncWishlist.create(request.get_json())
+    logger.info("Wishlist with new id [%s] created!", wishlist["id"])
+    location_url = request.url_for("/api/wishlists/{}".format(wishlist["id"]))
+    return json_response(wishlist, status.HTTP_201_CREATED, {"Location": location_url})
+
+
+######################################################################
+#  PATH: /wishlists/{id}/items/{item_id}
+######################################################################
+@route("/api/wishlists/{wishlist_id}/items/{item_id}", "GET")
+async def get_item(request, wishlist_id, item_id):
+    """Retrieve a single Item"""
+    return json_response(await find_item_or_404(wishlist_id, item_id))
+
+
+@route("/api/wishlists/{wishlist_id}/items/{item_id}", "PUT")
+async def update_item(request, wishlist_id, item_id):
+    """Update an Item"""
+    check_content_type(request, "application/json")
+    await find_item_or_404(wishlist_id, item_id)
+    item = await AsyncItem.update(wishlist_id, item_id, request.get_json())
+    if not item:
+        raise HTTPError(status.HTTP_404_NOT_FOUND, item_not_found(wishlist_id, item_id))
+    logger.info("Wishlist item with ID [%s] updated.", item_id)
+    return json_response(item)
+
+
+@route("/api/wishlists/{wishlist_id}/items/{item_id}", "DELETE")
+async def delete_item(request, wishlist_id, item_id):
+    """Delete an Item"""
+    wishlist_found, _ = await AsyncItem.find_on_wishlist(wishlist_id, item_id)
+    if not wishlist_found:
+        raise HTTPError(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+    await AsyncItem.delete(wishlist_id, item_id)
+    logger.info("Item with ID [%s] delete complete.", item_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@route("/api/wishlists/{wishlist_id}/items/{item_id}/purchase", "PUT")
+async def purchase_item(request, wishlist_id, item_id):
+    """Purchase an Item"""
+    check_content_type(request, "application/json")
+    await find_item_or_404(wishlist_id, item_id)
+    item = await AsyncItem.purchase(wishlist_id, item_id)
+    if not item:
+        raise HTTPError(status.HTTP_404_NOT_FOUND, item_not_found(wishlist_id, item_id))
+    logger.info("Item with id [%s] has been purchased!", item_id)
+    return json_response(item)
+
+
+######################################################################
+#  PATH: /wishlists/{id}/items
+######################################################################
+@route("/api/wishlists/{wishlist_id}/items", "GET")
+async def list_items(request, wishlist_id):
+    """Returns the Items on a specific Wishlist, filtered, sorted and projected like the Flask route"""
+    query = read_item_query(request)
+    wishlist = await find_wishlist_or_404(wishlist_id)
+    headers = check_not_modified(request, wishlist, query["representation"])
+    if query["count"]:
+        count = await AsyncItem.count_by_wishlist_id(wishlist_id, **query["filters"])
+        headers["X-Total-Count"] = str(count)
+        return json_response({"count": count}, status.HTTP_200_OK, headers)
+    items = await AsyncItem.find_by_wishlist_id(
+        wishlist_id, sort=query["sort"], fields=query["fields"], **query["filters"]
+    )
+    if not items and not any(value is not None for value in query["filters"].values()):
+        raise HTTPError(status.HTTP_404_NOT_FOUND, "No items found on Wishlist with id '{}'.".format(wishlist_id))
+    return json_response(items, status.HTTP_200_OK, headers)
+
+
+@route("/api/wishlists/{wishlist_id}/items", "HEAD")
+async def count_items(request, wishlist_id):
+    """Counts the Items on a Wishlist, returned in X-Total-Count"""
+    query = read_item_query(request)
+    wishlist = await find_wishlist_or_404(wishlist_id)
+    headers = check_not_modified(request, wishlist, query["representation"] + "-count")
+    headers["X-Total-Count"] = str(await AsyncItem.count_by_wishlist_id(wishlist_id, **query["filters"]))
+    return Response(b"", status.HTTP_200_OK, headers)
+
+
+@route("/api/wishlists/{wishlist_id}/items", "POST")
+async def create_item(request, wishlist_id):
+    """Creates an Item"""
+    check_content_type(request, "application/json")
+    await find_wishlist_or_404(wishlist_id)
+    item = await AsyncItem.create(wishlist_id, request.get_json())
+    location_url = request.url_for("/api/wishlists/{}/items/{}".format(wishlist_id, item["id"]))
+    return json_response(item, status.HTTP_201_CREATED, {"Location": location_url})
+
+
+######################################################################
+#  PATH: /wishlists/{id}/items:batch
+######################################################################
+@route("/api/wishlists/{wishlist_id}/items:batch", "POST")
+async def create_items_batch(request, wishlist_id):
+    """Creates many Items in a single statement, reporting a result per row"""
+    check_content_type(request, "application/json", "application/x-ndjson")
+    await find_wishlist_or_404(wishlist_id)
+    rows = read_batch_payload(request, MAX_BATCH_SIZE + 1)
+    if len(rows) > MAX_BATCH_SIZE:
+        raise HTTPError(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            "At most {} items may be created at once.".format(MAX_BATCH_SIZE)
+        )
+
+    items, accepted, results = [], [], []
+    for index, data in enumerate(rows):
+        if isinstance(data, dict):
+            # items in the batch belong to the wishlist in the path
+            data = dict({"wishlist_id": wishlist_id}, **data)
+        result = {"index": index}
+        try:
+            items.append(Item().deserialize(data))
+            result["status"] = status.HTTP_201_CREATED
+            accepted.append(result)
+        except DataValidationError as error:
+            result["status"] = status.HTTP_400_BAD_REQUEST
+            result["message"] = str(error)
+        results.append(result)
+
+    if not items:
+        raise HTTPError(status.HTTP_400_BAD_REQUEST, "No valid items were posted.")
+
+    ids = await AsyncItem.create_many(wishlist_id, items)
+    for result, item_id in zip(accepted, ids):
+        result["id"] = item_id
+    code = status.HTTP_201_CREATED if len(ids) == len(rows) else status.HTTP_207_MULTI_STATUS
+    return json_response({"wishlist_id": wishlist_id, "created": ids, "results": results}, code)
+
+
+######################################################################
+#  PATH: /wishlists/{id}/items:purchase
+######################################################################
+@route("/api/wishlists/{wishlist_id}/items:purchase", "PUT")
+async def purchase_items(request, wishlist_id):
+    """Purchases many Items in a single statement"""
+    check_content_type(request, "application/json")
+    item_ids = purchase_selector(request.get_json())
+    await find_wishlist_or_404(wishlist_id)
+    purchased, already_purchased, missing = await AsyncItem.purchase_many(wishlist_id, item_ids)
+    logger.info("[%s] Items purchased on Wishlist %s", len(purchased), wishlist_id)
+    return json_response({
+        "wishlist_id": wishlist_id,
+        "purchased": purchased,
+        "already_purchased": already_purchased,
+        "missing": missing,
+    })
+
+
+######################################################################
+#  PATH: /health
+######################################################################
+@route("/health/live", "GET")
+async def liveness(request):
+    """Answers as long as the event loop serves requests"""
+    return json_response(health.liveness())
+
+
+@route("/health/ready", "GET")
+async def readiness(request):
+    """Answers 200 when the app can serve requests, 503 otherwise, from cached checks only"""
+    ready, report = health.readiness(database.pool_status())
+    return json_response(report, status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+######################################################################
+#  PATH: /metrics
+######################################################################
+@route("/metrics", "GET")
+async def prometheus_metrics(request):
+    """Returns the request metrics in the Prometheus text format"""
+    return Response(metrics.render().encode("utf-8"), media_type=METRICS_CONTENT_TYPE)
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def item_not_found(wishlist_id, item_id):
+    """The message for a missing Item"""
+    return "Item with wishlist_id '{}' and item_id '{}' was not found.".format(wishlist_id, item_id)
+
+
+async def find_wishlist_or_404(wishlist_id):
+    """Returns a serialized Wishlist or raises a 404"""
+    wishlist = await AsyncWishlist.find(wishlist_id)
+    if not wishlist:
+        raise HTTPError(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+    return wishlist
+
+
+async def find_item_or_404(wishlist_id, item_id):
+    """Returns a serialized Item or raises a 404 for it or its Wishlist"""
+    wishlist_found, item = await AsyncItem.find_on_wishlist(wishlist_id, item_id)
+    if not wishlist_found:
+        raise HTTPError(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+    if not item:
+        raise HTTPError(status.HTTP_404_NOT_FOUND, item_not_found(wishlist_id, item_id))
+    return item
+
+
+def int_arg(request, name, minimum=None, maximum=None):
+    """Parses an optional integer query string argument"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        raise HTTPError(status.HTTP_400_BAD_REQUEST, "{}: invalid literal for int(): {}".format(name, value))
+    if (minimum is not None and number < minimum) or (maximum is not None and number > maximum):
+        raise HTTPError(
+            status.HTTP_400_BAD_REQUEST,
+            "{}: Value must be in range [{}, {}]".format(name, minimum, maximum)
+        )
+    return number
+
+
+def expand_arg(request):
+    """Parses the optional expand argument, which may only name items"""
+    expand = request.args.get("expand") or None
+    if expand not in (None, "items"):
+        raise HTTPError(status.HTTP_400_BAD_REQUEST, "expand: The value '{}' is not a valid choice".format(expand))
+    return expand
+
+
+def bool_arg(request, name):
+    """Parses an optional boolean query string argument like flask_restx's inputs.boolean"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return inputs.boolean(value)
+    except ValueError as error:
+        raise HTTPError(status.HTTP_400_BAD_REQUEST, "{}: {}".format(name, error))
+
+
+def read_item_query(request):
+    """Reads and checks the filtering, sorting and projection arguments of an Item listing"""
+    sort = (request.args.get("sort") or "").split(",")
+    fields = (request.args.get("fields") or "").split(",")
+    parse_sort(sort, ITEM_SORT_COLUMNS)
+    query = {
+        "filters": {"purchased": bool_arg(request, "purchased"), "name": request.args.get("name") or None},
+        "sort": sort,
+        "fields": parse_fields(fields, ITEM_FIELDS) if request.args.get("fields") else None,
+        "count": bool(bool_arg(request, "count")),
+    }
+    query["representation"] = items_representation([
+        ("purchased", query["filters"]["purchased"]),
+        ("name", request.args.get("name")),
+        ("sort", request.args.get("sort")),
+        ("fields", request.args.get("fields")),
+        ("count", bool_arg(request, "count")),
+    ])
+    return query
+
+
+def check_content_type(request, *media_types):
+    """Checks that the media type is one of the accepted ones"""
+    if request.headers.get("content-type") in media_types:
+        return
+    raise HTTPError(
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        "Content-Type must be {}".format(" or ".join(media_types)),
+    )
+
+
+def check_not_modified(request, wishlist, representation):
+    """Returns the ETag and Last-Modified headers of a Wishlist representation
+
+    Raises a 304 HTTPError instead when the client already has this version,
+    with the same rules as the Flask routes.
+    """
+    headers, not_modified = conditional_headers(
+        representation,
+        wishlist["id"],
+        wishlist["version"],
+        datetime.fromisoformat(wishlist["updated_at"]) if wishlist["updated_at"] else None,
+        parse_etags(request.headers.get("if-none-match")),
+        parse_date(request.headers.get("if-modified-since")),
+    )
+    if not_modified:
+        raise NotModified(headers)
+    return headers
+
+
+class NotModified(HTTPError):
+    """Raised when a conditional GET matches the current representation"""
+
+    def __init__(self, headers):
+        super().__init__(status.HTTP_304_NOT_MODIFIED, "Not Modified", headers)
+
+
+async def stream_json_list(records):
+    """Streams serialized records as a chunked JSON array"""
+    yield b"["
+    count = 0
+    async for record in records:
+        yield (b"," if count else b"") + json.dumps(record).encode("utf-8")
+        count += 1
+    yield b"]"
+
+
+def read_batch_payload(request, max_rows):
+    """Reads a JSON array or an NDJSON stream of records from the request body"""
+    if request.mimetype == "application/x-ndjson":
+        rows = []
+        for line in request.body.splitlines():
+            if len(rows) >= max_rows:
+                break
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                rows.append(None)  # reported as a bad row by deserialize()
+        return rows
+
+    payload = request.get_json()
+    if not isinstance(payload, list):
+        raise DataValidationError("Invalid batch: body of request must be a JSON array")
+    return payload[:max_rows]
@@ -0,0 +1,510 @@
+"""
+Async models for Wishlist Service
+
+Async versions of the Wishlist and Item query methods used by the ASGI
+entry point (service/asgi.py). They talk to PostgreSQL through an asyncpg
+connection pool instead of SQLAlchemy, so a single event loop can keep
+thousands of requests in flight while they wait on the database.
+
+Rows are returned as dictionaries in the same shape as the sync models'
+serialize(), and request data is validated with the sync models'
+deserialize(), so both serving modes accept and return the same JSON.
+"""
+import logging
+from contextlib import asynccontextmanager
+from operator import itemgetter
+from service.models import Wishlist, Item, DataValidationError, PAGE_SIZE, MAX_BATCH_SIZE, PURGE_BATCH_SIZE
+from service.models import ITEM_FIELDS, ITEM_SORT_COLUMNS, ITEM_SERIALIZED, WISHLIST_SERIALIZED, parse_fields, parse_sort
+from service.serializers import compile_serializer
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+logger = logging.getLogger("flask.app")
+
+WISHLIST_COLUMNS = "id, name, customer_id, version, updated_at"
+ITEM_COLUMNS = "id, name, wishlist_id, purchased"
+UTC_NOW = "(now() AT TIME ZONE 'utc')"
+
+
+class CountingPool:
+    """An asyncpg pool that counts the connections checked out of it
+
+    asyncpg 0.22 keeps no gauges of its own (Pool.get_size() and friends
+    came in later versions), so every query goes through acquire() here.
+    """
+
+    def __init__(self, pool, max_size):
+        self.pool = pool
+        self.max_size = max_size
+        self.checked_out = 0
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self.pool.acquire() as conn:
+            self.checked_out += 1
+            try:
+                yield conn
+            finally:
+                self.checked_out -= 1
+
+    async def execute(self, query, *args):
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args)
+
+    async def fetch(self, query, *args):
+        async with self.acquire() as conn:
+            return await conn.fetch(query, *args)
+
+    async def fetchrow(self, query, *args):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(query, *args)
+
+    async def fetchval(self, query, *args):
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args)
+
+    async def close(self):
+        await self.pool.close()
+
+
+class AsyncDatabase:
+    """Holds the asyncpg connection pool for the event loop"""
+
+    def __init__(self):
+        self.pool = None
+        self.dsn = None
+        self.ping_connection = None
+
+    async def connect(self, dsn, min_size=1, max_size=10):
+        """Creates the connection pool"""
+        if asyncpg is None:
+            raise ImportError("The ASGI mode needs asyncpg, which is not installed")
+        logger.info("Creating async database pool (max %s connections)", max_size)
+        self.dsn = dsn
+        pool = await asyncpg.create_pool(dsn, min_size=min_size, max_size=max_size)
+        self.pool = CountingPool(pool, max_size)
+
+    async def close(self):
+        """Closes every connection in the pool, and the health check's"""
+        await self.close_ping_connection()
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def ping(self, timeout=2.0):
+        """Runs SELECT 1 on a connection kept outside of the pool for health checks"""
+        if self.ping_connection is None or self.ping_connection.is_closed():
+            self.ping_connection = await asyncpg.connect(self.dsn, timeout=timeout)
+        try:
+            await self.ping_connection.fetchval("SELECT 1", timeout=timeout)
+        except BaseException:
+            await self.close_ping_connection()
+            raise
+
+    async def close_ping_connection(self):
+        """Closes the health check connection, the next ping opens a new one"""
+        connection, self.ping_connection = self.ping_connection, None
+        if connection is not None:
+            connection.terminate()
+
+    def pool_status(self):
+        """Returns the pool gauges in the shape of service.pool.pool_status()"""
+        if self.pool is None:
+            return None
+        return {
+            "pool": "asyncpg",
+            "size": self.pool.max_size,
+            "max_overflow": 0,
+            "checked_out": self.pool.checked_out,
+        }
+
+    @property
+    def unavailable_errors(self):
+        """Exception types that mean the database cannot be reached"""
+        if asyncpg is None:
+            return (OSError,)
+        return (OSError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError)
+
+
+# The pool is created when the ASGI app starts up
+database = AsyncDatabase()
+
+
+# asyncpg records are read by key, not by attribute
+serialize_wishlist_record = compile_serializer(WISHLIST_SERIALIZED, itemgetter)
+serialize_item_record = compile_serializer(ITEM_SERIALIZED, itemgetter)
+
+
+def serialize_wishlist(row):
+    """Serializes a wishlist row like Wishlist.serialize()"""
+    return None if row is None else serialize_wishlist_record(row)
+
+
+def serialize_item(row):
+    """Serializes an item row like Item.serialize()"""
+    return None if row is None else serialize_item_record(row)
+
+
+def as_int(value, message):
+    """Coerces a deserialized id for an integer parameter, asyncpg does not cast strings"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise DataValidationError(message)
+
+
+async def touch_wishlist(conn, wishlist_id):
+    """Bumps the version of a Wishlist whose items changed, like Wishlist.touch()"""
+    await conn.execute(
+        "UPDATE wishlist SET version = version + 1, updated_at = {} WHERE id = $1".format(UTC_NOW),
+        wishlist_id,
+    )
+
+
+async def record_item_tombstones(conn, wishlist_id, item_ids):
+    """Inserts the tombstones of Items leaving a Wishlist, like Tombstone.record_items()"""
+    await conn.execute(
+        "INSERT INTO tombstone (kind, object_id, wishlist_id, customer_id, deleted_at) "
+        "SELECT 'item', i.id, w.id, w.customer_id, {} FROM wishlist w JOIN item i ON i.wishlist_id = w.id "
+        "WHERE w.id = $1 AND i.id = ANY($2::int[])".format(UTC_NOW),
+        wishlist_id, list(item_ids),
+    )
+
+
+class AsyncWishlist:
+    """Async queries on the wishlist table"""
+
+    @classmethod
+    async def find(cls, wishlist_id):
+        """Finds a Wishlist by its ID, returns None if not found"""
+        row = await database.pool.fetchrow(
+            "SELECT {} FROM wishlist WHERE id = $1".format(WISHLIST_COLUMNS), wishlist_id
+        )
+        return serialize_wishlist(row)
+
+    @classmethod
+    async def find_page(cls, after=None, limit=PAGE_SIZE, customer_id=None):
+        """Returns one keyset page of Wishlists ordered by id"""
+        row_filters, args = [], []
+        if customer_id is not None:
+            args.append(customer_id)
+            row_filters.append("customer_id = ${}".format(len(args)))
+        if after is not None:
+            args.append(after)
+            row_filters.append("id > ${}".format(len(args)))
+        where = "WHERE " + " AND ".join(row_filters) if row_filters else ""
+        args.append(limit)
+        rows = await database.pool.fetch(
+            "SELECT {} FROM wishlist {} ORDER BY id LIMIT ${}".format(WISHLIST_COLUMNS, where, len(args)),
+            *args
+        )
+        return [serialize_wishlist(row) for row in rows]
+
+    @classmethod
+    async def iter_pages(cls, customer_id=None, page_size=PAGE_SIZE):
+        """Yields every Wishlist one keyset page at a time"""
+        async for page in cls.pages(customer_id=customer_id, page_size=page_size):
+            for wishlist in page:
+                yield wishlist
+
+    @classmethod
+    async def pages(cls, customer_id=None, page_size=PAGE_SIZE):
+        """Yields every Wishlist in keyset pages, one list per query"""
+        after = None
+        while True:
+            page = await cls.find_page(after=after, limit=page_size, customer_id=customer_id)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after = page[-1]["id"]
+
+    @classmethod
+    async def with_items(cls, wishlists):
+        """Nests the Items of many Wishlists in them, read with a single query"""
+        items = await AsyncItem.find_by_wishlist_ids([wishlist["id"] for wishlist in wishlists])
+        return [dict(wishlist, items=items.get(wishlist["id"], [])) for wishlist in wishlists]
+
+    @classmethod
+    async def create(cls, data):
+        """Validates and inserts a Wishlist"""
+        wishlist = Wishlist().deserialize(data)
+        customer_id = as_int(wishlist.customer_id, "Invalid wishlist: customer_id must be an integer")
+        row = await database.pool.fetchrow(
+            "INSERT INTO wishlist (name, customer_id, version, created_at, updated_at) "
+            "VALUES ($1, $2, 1, {0}, {0}) RETURNING {1}".format(UTC_NOW, WISHLIST_COLUMNS),
+            wishlist.name, customer_id,
+        )
+        return serialize_wishlist(row)
+
+    @classmethod
+    async def update(cls, wishlist_id, data):
+        """Validates and saves a Wishlist, returns None if not found"""
+        wishlist = Wishlist().deserialize(data)
+        new_customer_id = as_int(wishlist.customer_id, "Invalid wishlist: customer_id must be an integer")
+        async with database.pool.acquire() as conn:
+            async with conn.transaction():
+                customer_id = await conn.fetchval(
+                    "SELECT customer_id FROM wishlist WHERE id = $1 FOR UPDATE", wishlist_id
+                )
+                row = await conn.fetchrow(
+                    "UPDATE wishlist SET name = $2, customer_id = $3, version = version + 1, "
+                    "updated_at = {} WHERE id = $1 RETURNING {}".format(UTC_NOW, WISHLIST_COLUMNS),
+                    wishlist_id, wishlist.name, new_customer_id,
+                )
+                if row is not None and customer_id != row["customer_id"]:
+                    # the old customer's delta sync sees the Wishlist as deleted
+                    await conn.execute(
+                        "INSERT INTO tombstone (kind, object_id, wishlist_id, customer_id, deleted_at) "
+                        "VALUES ('wishlist', $1, $1, $2, {})".format(UTC_NOW),
+                        wishlist_id, customer_id,
+                    )
+                    # and the new one's sees it new, Items included
+                    await conn.execute(
+                        "UPDATE item SET updated_at = {} WHERE wishlist_id = $1".format(UTC_NOW), wishlist_id
+                    )
+        return serialize_wishlist(row)
+
+    @classmethod
+    async def delete(cls, wishlist_id):
+        """Removes a Wishlist, the database cascades the delete to its items"""
+        await database.pool.execute(
+            "WITH deleted AS (DELETE FROM wishlist WHERE id = $1 RETURNING id, customer_id) "
+            "INSERT INTO tombstone (kind, object_id, wishlist_id, customer_id, deleted_at) "
+            "SELECT 'wishlist', id, id, customer_id, {} FROM deleted".format(UTC_NOW),
+            wishlist_id,
+        )
+
+    @classmethod
+    async def purge(cls, wishlist_id, batch_size=PURGE_BATCH_SIZE):
+        """Deletes a Wishlist's items a batch per transaction, then the Wishlist, like Wishlist.purge()"""
+        purged = 0
+        while True:
+            async with database.pool.acquire() as conn:
+                async with conn.transaction():
+                    ids = await conn.fetch(
+                        "SELECT id FROM item WHERE wishlist_id = $1 ORDER BY id LIMIT $2",
+                        wishlist_id, batch_size,
+                    )
+                    ids = [row["id"] for row in ids]
+                    deleted = 0
+                    if ids:
+                        await record_item_tombstones(conn, wishlist_id, ids)
+                        deleted = await conn.fetchval(
+                            "WITH batch AS (DELETE FROM item WHERE wishlist_id = $1 AND id = ANY($2::int[]) "
+                            "RETURNING 1) SELECT count(*) FROM batch",
+                            wishlist_id, ids,
+                        )
+                    if deleted:
+                        await conn.execute(
+                            "UPDATE wishlist SET version = version + 1, updated_at = {} "
+                            "WHERE id = $1".format(UTC_NOW), wishlist_id,
+                        )
+            purged += deleted
+            if deleted < batch_size:
+                break
+        await cls.delete(wishlist_id)
+        logger.info("Purged Wishlist %s and %s Items", wishlist_id, purged)
+        return purged
+
+
+class AsyncItem:
+    """Async queries on the item table"""
+
+    @classmethod
+    def wishlist_criteria(cls, wishlist_id, purchased=None, name=None):
+        """Builds the WHERE clause and its arguments like Item.wishlist_criteria()"""
+        criteria, args = ["wishlist_id = $1"], [wishlist_id]
+        if purchased is not None:
+            criteria.append("purchased" if purchased else "NOT purchased")
+        if name:
+            args.append(name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+            criteria.append("name LIKE ${} ESCAPE '\\'".format(len(args)))
+        return " AND ".join(criteria), args
+
+    @classmethod
+    async def find_by_wishlist_id(cls, wishlist_id, purchased=None, name=None, sort=None, fields=None):
+        """Returns the Items on a Wishlist, filtered, ordered and projected in the SELECT"""
+        fields = parse_fields(fields, ITEM_FIELDS)
+        keys = parse_sort(sort, ITEM_SORT_COLUMNS)
+        order = ["{}{}".format(column, " DESC" if descending else "") for column, descending in keys]
+        if "id" not in [column for column, _ in keys]:
+            order.append("id")
+        where, args = cls.wishlist_criteria(wishlist_id, purchased, name)
+        rows = await database.pool.fetch(
+            "SELECT {} FROM item WHERE {} ORDER BY {}".format(", ".join(fields), where, ", ".join(order)),
+            *args
+        )
+        return [{field: row[field] for field in fields} for row in rows]
+
+    @classmethod
+    async def find_by_wishlist_ids(cls, wishlist_ids):
+        """Returns the Items of many Wishlists keyed by wishlist_id, read with a single query"""
+        items = {}
+        if not wishlist_ids:
+            return items
+        rows = await database.pool.fetch(
+            "SELECT {} FROM item WHERE wishlist_id = ANY($1::int[]) ORDER BY wishlist_id, id".format(ITEM_COLUMNS),
+            list(wishlist_ids),
+        )
+        for row in rows:
+            items.setdefault(row["wishlist_id"], []).append(serialize_item(row))
+        return items
+
+    @classmethod
+    async def count_by_wishlist_id(cls, wishlist_id, purchased=None, name=None):
+        """Counts the Items on a Wishlist with SELECT count(*)"""
+        where, args = cls.wishlist_criteria(wishlist_id, purchased, name)
+        return await database.pool.fetchval("SELECT count(*) FROM item WHERE {}".format(where), *args)
+
+    @classmethod
+    async def has_more_than(cls, wishlist_id, count):
+        """Tells if a Wishlist has more than count Items, like Item.has_more_than()"""
+        row = await database.pool.fetchrow(
+            "SELECT id FROM item WHERE wishlist_id = $1 ORDER BY id OFFSET $2 LIMIT 1", wishlist_id, count
+        )
+        return row is not None
+
+    @classmethod
+    async def find_on_wishlist(cls, wishlist_id, item_id):
+        """Finds an Item and checks that its Wishlist exists in one query
+
+        :return: whether the Wishlist exists, and the Item or None if not found
+        :rtype: tuple
+
+        """
+        row = await database.pool.fetchrow(
+            "SELECT w.id AS found, i.id, i.name, i.wishlist_id, i.purchased FROM wishlist w "
+            "LEFT OUTER JOIN item i ON i.wishlist_id = w.id AND i.id = $2 WHERE w.id = $1",
+            wishlist_id, item_id,
+        )
+        if row is None:
+            return False, None
+        return True, serialize_item(row) if row["id"] is not None else None
+
+    @classmethod
+    async def create(cls, wishlist_id, data):
+        """Validates and inserts an Item on a Wishlist"""
+        item = Item().deserialize(data)
+        async with database.pool.acquire() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow(
+                    "INSERT INTO item (name, wishlist_id, purchased, created_at, updated_at) "
+                    "VALUES ($1, $2, $3, {0}, {0}) RETURNING {1}".format(UTC_NOW, ITEM_COLUMNS),
+                    item.name, wishlist_id, bool(item.purchased),
+                )
+                await touch_wishlist(conn, wishlist_id)
+        return serialize_item(row)
+
+    @classmethod
+    async def create_many(cls, wishlist_id, items):
+        """Inserts already deserialized Items with a single statement
+
+        :return: the ids assigned to the Items, in the same order
+        :rtype: list
+
+        """
+        if not items:
+            return []
+        if len(items) > MAX_BATCH_SIZE:
+            raise DataValidationError(
+                "Invalid batch: at most {} items may be created at once".format(MAX_BATCH_SIZE)
+            )
+        async with database.pool.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch(
+                    "INSERT INTO item (name, wishlist_id, purchased, created_at, updated_at) "
+                    "SELECT name, $1, purchased, {0}, {0} FROM unnest($2::text[], $3::boolean[]) "
+                    "WITH ORDINALITY AS batch(name, purchased, position) ORDER BY position "
+                    "RETURNING id".format(UTC_NOW),
+                    wishlist_id, [item.name for item in items], [bool(item.purchased) for item in items],
+                )
+                await touch_wishlist(conn, wishlist_id)
+        return [row["id"] for row in rows]
+
+    @classmethod
+    async def update(cls, wishlist_id, item_id, data):
+        """Validates and saves an Item, returns None if not found"""
+        item = Item().deserialize(data)
+        new_wishlist_id = as_int(item.wishlist_id, "Invalid item: wishlist_id must be an integer")
+        async with database.pool.acquire() as conn:
+            async with conn.transaction():
+                if new_wishlist_id != wishlist_id:
+                    # the old Wishlist's customer sees the Item as deleted
+                    await record_item_tombstones(conn, wishlist_id, [item_id])
+                row = await conn.fetchrow(
+                    "UPDATE item SET name = $3, wishlist_id = $4, purchased = $5, updated_at = {} "
+                    "WHERE wishlist_id = $1 AND id = $2 RETURNING {}".format(UTC_NOW, ITEM_COLUMNS),
+                    wishlist_id, item_id, item.name, new_wishlist_id, bool(item.purchased),
+                )
+                if row is not None:
+                    for touched in {wishlist_id, row["wishlist_id"]}:
+                        await touch_wishlist(conn, touched)
+        return serialize_item(row)
+
+    @classmethod
+    async def purchase(cls, wishlist_id, item_id):
+        """Marks an Item as purchased, returns None if not found"""
+        async with database.pool.acquire() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow(
+                    "UPDATE item SET purchased = TRUE, updated_at = {} WHERE wishlist_id = $1 AND id = $2 "
+                    "RETURNING {}".format(UTC_NOW, ITEM_COLUMNS),
+                    wishlist_id, item_id,
+                )
+                if row is not None:
+                    await touch_wishlist(conn, wishlist_id)
+        return serialize_item(row)
+
+    @classmethod
+    async def purchase_many(cls, wishlist_id, item_ids=None):
+        """Marks many Items as purchased with a single statement
+
+        :param item_ids: the ids of the Items to purchase, None for every unpurchased Item
+
+        :return: the ids purchased now, the ids that already were purchased and
+            the ids that are not on the Wishlist, each sorted
+        :rtype: tuple
+
+        """
+        async with database.pool.acquire() as conn:
+            async with conn.transaction():
+                if item_ids is None:
+                    rows = await conn.fetch(
+                        "UPDATE item SET purchased = TRUE, updated_at = {} "
+                        "WHERE wishlist_id = $1 AND NOT purchased RETURNING id, TRUE AS updated".format(UTC_NOW),
+                        wishlist_id,
+                    )
+                else:
+                    item_ids = sorted(set(item_ids))
+                    # the SELECT sees the rows as they were before the UPDATE in the same statement
+                    rows = await conn.fetch(
+                        "WITH purchased AS (UPDATE item SET purchased = TRUE, updated_at = {} "
+                        "WHERE wishlist_id = $1 AND id = ANY($2::int[]) AND NOT purchased RETURNING id) "
+                        "SELECT id, TRUE FROM purchased UNION ALL "
+                        "SELECT id, FALSE FROM item WHERE wishlist_id = $1 AND id = ANY($2::int[]) AND purchased"
+                        .format(UTC_NOW),
+                        wishlist_id, item_ids,
+                    ) if item_ids else []
+                updated = sorted(row[0] for row in rows if row[1])
+                already = sorted(row[0] for row in rows if not row[1])
+                if updated:
+                    await touch_wishlist(conn, wishlist_id)
+        missing = [] if item_ids is None else sorted(set(item_ids) - set(updated) - set(already))
+        return updated, already, missing
+
+    @classmethod
+    async def delete(cls, wishlist_id, item_id):
+        """Removes an Item from a Wishlist"""
+        async with database.pool.acquire() as conn:
+            async with conn.transaction():
+                await record_item_tombstones(conn, wishlist_id, [item_id])
+                deleted = await conn.fetchval(
+                    "DELETE FROM item WHERE wishlist_id = $1 AND id = $2 RETURNING id",
+                    wishlist_id, item_id,
+                )
+                if deleted is not None:
+                    await touch_wishlist(conn, wishlist_id)
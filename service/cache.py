@@ -0,0 +1,217 @@
+"""
+Module: cache
+
+Read-through cache for model lookups
+
+The models keep serialized rows (plain dicts) in a cache backend so hot
+wishlists and items are not fetched from the database on every request.
+Two backends are provided:
+
+LRUCache - an in-process least recently used cache with a time to live
+SharedCache - a cache kept in a shared key-value server such as Redis, so
+              every worker sees the same entries and invalidations
+
+ReadThroughCache sits in front of either backend and counts hits, misses
+and invalidations.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger("flask.app")
+
+
+class LRUCache:
+    """In-process LRU cache whose entries expire after `ttl` seconds"""
+
+    def __init__(self, max_entries=10000, ttl=60, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= self.clock():
+                del self._entries[key]
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Stores a value, evicting the least recently used entry when full"""
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        """Removes keys from the cache"""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes every entry"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedCache:
+    """Cache kept in a shared key-value server
+
+    The client only needs the get/set/delete/scan_iter subset of the
+    redis-py API, so tests can pass a local stand-in instead of a server.
+    """
+
+    def __init__(self, client, ttl=60, prefix="wishlists:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.evictions = 0  # expiry happens on the server and is not visible
+
+    def get(self, key):
+        """Returns the cached value for key, or None if missing"""
+        raw = self.client.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value):
+        """Stores a value that the server expires after `ttl` seconds"""
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, *keys):
+        """Removes keys from the cache"""
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        """Removes every entry under this cache's prefix"""
+        keys = list(self.client.scan_iter(self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(self.prefix + "*"))
+
+
+class NullCache:
+    """Backend that never stores anything (caching disabled)"""
+
+    evictions = 0
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+class ReadThroughCache:
+    """Counts hits and misses in front of a swappable cache backend"""
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else LRUCache()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns the cached value for key, or None on a miss"""
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Stores a value, None values are never cached"""
+        if value is not None:
+            self.backend.set(key, value)
+
+    def get_or_load(self, key, loader):
+        """Returns the cached value for key, calling loader() on a miss"""
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, *keys):
+        """Drops keys after the rows behind them have changed"""
+        with self._lock:
+            self.invalidations += len(keys)
+        self.backend.delete(*keys)
+
+    def clear(self):
+        """Drops every entry"""
+        self.backend.clear()
+
+    def stats(self):
+        """Returns the hit, miss, eviction and invalidation counters"""
+        with self._lock:
+            return {
+                "backend": type(self.backend).__name__,
+                "entries": len(self.backend),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.backend.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+def backend_from_config(config):
+    """Builds the cache backend named by CACHE_BACKEND in the app config
+
+    A per-process cache is only used by a single worker: the others would
+    keep serving an entry, and the ETag built from its version, for up to
+    CACHE_TTL seconds after it changed.
+    """
+    name = config.get("CACHE_BACKEND", "auto")
+    ttl = config.get("CACHE_TTL", 60)
+    single_worker = config.get("WEB_CONCURRENCY", 1) <= 1
+    if name == "auto":
+        name = "memory" if single_worker else "redis" if config.get("CACHE_URL") else "none"
+    elif name == "memory" and not single_worker:
+        logger.warning("CACHE_BACKEND is memory with several workers, their entries may be stale")
+    if name == "redis":
+        if redis is None:
+            logger.warning("CACHE_BACKEND is redis but redis-py is not installed, not shared")
+            name = "memory" if single_worker else "none"
+        else:
+            url = config.get("CACHE_URL") or "redis://localhost:6379/0"
+            return SharedCache(redis.Redis.from_url(url), ttl=ttl)
+    if name == "none":
+        return NullCache()
+    return LRUCache(max_entries=config.get("CACHE_MAX_ENTRIES", 10000), ttl=ttl)
@@ -0,0 +1,189 @@
+"""
+Module: health
+
+Liveness and readiness checks that never wait on the database
+
+A background thread pings the database every HEALTH_INTERVAL seconds on a
+connection of its own, outside the request pool, and keeps the result. A
+readiness probe only reads that result, the pool gauges and the circuit
+breaker state, so it answers in microseconds even when every pooled
+connection is busy or the database hangs. A worker is ready when:
+
+* the last ping succeeded and is at most HEALTH_MAX_AGE seconds old
+* the circuit breaker is not open
+* fewer than HEALTH_POOL_SATURATION of its pool connections are checked out
+
+Liveness only tells that the worker answers requests: restarting a worker
+does not fix a database outage.
+"""
+import logging
+import os
+import threading
+import time
+from service.models import db
+from service.threads import BackgroundThread
+
+logger = logging.getLogger("flask.app")
+
+
+class HealthCheck:
+    """The cached result of the last database ping and the readiness rules"""
+
+    def __init__(self, interval=5.0, max_age=0, saturation=1.0, clock=time.monotonic):
+        self.interval = interval
+        self.max_age = max_age or 3 * interval
+        self.saturation = saturation
+        self.clock = clock
+        self.started = clock()
+        self.pings = 0
+        self.failures = 0
+        self._result = None  # (ok, seconds, error, checked_at), replaced in one step
+        self._checked = threading.Event()
+
+    def record(self, ok, seconds, error=None):
+        """Keeps the result of a ping"""
+        self.pings += 1
+        self.failures += int(not ok)
+        self._result = (ok, seconds, error, self.clock())
+        self._checked.set()
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds for the first ping"""
+        return self._checked.wait(timeout)
+
+    def database(self):
+        """Returns the last ping: up, down, stale, or starting before the first one"""
+        result = self._result
+        if result is None:
+            return {"status": "starting"}
+        ok, seconds, error, checked_at = result
+        age = self.clock() - checked_at
+        report = {
+            "status": "up" if ok else "down",
+            "latency_ms": round(seconds * 1000, 3),
+            "age_seconds": round(age, 3),
+        }
+        if ok and age > self.max_age:
+            report["status"] = "stale"  # the pinger is stuck, e.g. on a hung connection
+        if error:
+            report["error"] = error
+        return report
+
+    def readiness(self, pool=None, breaker_state=None):
+        """Tells if the worker should receive traffic, and why
+
+        :param pool: the pool_status() of the request pool, or any dict with
+            size, checked_out and max_overflow
+        :type pool: dict
+        :param breaker_state: the state of the database circuit breaker
+        :type breaker_state: str
+
+        :return: whether the worker is ready and the report of every check
+        :rtype: tuple
+
+        """
+        checks = {"database": self.database()}
+        ready = checks["database"]["status"] == "up"
+        if pool is not None:
+            checks["pool"] = dict(pool)
+            capacity = pool.get("size", 0) + max(0, pool.get("max_overflow", 0))
+            if capacity > 0 and "checked_out" in pool:
+                saturation = pool["checked_out"] / capacity
+                checks["pool"]["saturation"] = round(saturation, 3)
+                ready = ready and saturation < self.saturation
+        if breaker_state is not None:
+            checks["breaker"] = {"state": breaker_state}
+            ready = ready and breaker_state != "open"
+        return ready, {"status": "ready" if ready else "unavailable", "checks": checks}
+
+    def liveness(self):
+        """Returns the uptime of the worker"""
+        return {"status": "alive", "pid": os.getpid(), "uptime_seconds": round(self.clock() - self.started, 3)}
+
+
+class DatabasePinger:
+    """The thread that pings the database of a Flask app into a HealthCheck"""
+
+    def __init__(self, app, check, timeout=2.0):
+        self.app = app
+        self.check = check
+        self.timeout = timeout
+        self.connection = None
+        self.thread = BackgroundThread(self.run, "database-ping")
+
+    def start(self):
+        """Starts pinging, once per process"""
+        self.thread.start()
+
+    def run(self):
+        """Pings the database until the process exits"""
+        while True:
+            self.ping()
+            time.sleep(self.check.interval)
+
+    def connect(self, engine):
+        """Opens a DBAPI connection of the engine's database outside of its pool"""
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        cparams.update(self.app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}).get("connect_args", {}))
+        if engine.dialect.driver == "psycopg2":
+            cparams.setdefault("connect_timeout", max(1, int(self.timeout)))
+            cparams.setdefault("options", "-c statement_timeout={}".format(int(self.timeout * 1000)))
+        return engine.dialect.connect(*cargs, **cparams)
+
+    def ping(self):
+        """Runs SELECT 1 and records the outcome, reconnecting after a failure"""
+        start = time.perf_counter()
+        try:
+            with self.app.app_context():
+                if self.connection is None:
+                    self.connection = self.connect(db.engine)
+                cursor = self.connection.cursor()
+                try:
+                    cursor.execute("SELECT 1")
+                    cursor.fetchone()
+                finally:
+                    cursor.close()
+                self.connection.rollback()  # psycopg2 opened a transaction
+        except Exception as error:  # pylint: disable=broad-except
+            self.check.record(False, time.perf_counter() - start, error.__class__.__name__)
+            logger.warning("Database ping failed: %s", error)
+            self.close()
+        else:
+            self.check.record(True, time.perf_counter() - start)
+
+    def close(self):
+        """Closes the ping connection, the next ping opens a new one"""
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+
+
+def init_health(app):
+    """Pings the database of a Flask app in the background
+
+    The thread starts with the first request a worker serves, so each
+    gunicorn worker pings from its own process.
+
+    :param app: the Flask app to check
+    :type app: Flask
+
+    :return: the pinger, whose check holds the results
+    :rtype: DatabasePinger
+
+    """
+    check = HealthCheck(
+        interval=app.config.get("HEALTH_INTERVAL", 5.0),
+        max_age=app.config.get("HEALTH_MAX_AGE", 0),
+        saturation=app.config.get("HEALTH_POOL_SATURATION", 1.0),
+    )
+    pinger = DatabasePinger(app, check, timeout=app.config.get("HEALTH_TIMEOUT", 2.0))
+
+    @app.before_request
+    def start_pinger():
+        pinger.start()
+
+    app.extensions["health"] = pinger
+    return pinger
@@ -0,0 +1,213 @@
+"""
+Module: log
+
+Non-blocking structured logging
+
+Request threads only put records on a bounded queue. A background
+QueueListener thread formats them as JSON and writes them to the real
+handlers (the gunicorn error log, or stderr). On the request thread:
+
+* arguments are snapshotted with a size-limited repr, so logging a huge
+  list costs the same as logging a short one
+* records are sampled per level, e.g. keep 10% of INFO under load
+* when the queue is full the record is dropped and counted instead of
+  blocking the request
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import reprlib
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# attributes every LogRecord has, anything else was passed in `extra`
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def parse_sample_rates(spec):
+    """Parses "info=0.1,debug=0" into {logging.INFO: 0.1, logging.DEBUG: 0.0}"""
+    rates = {}
+    for part in filter(None, (part.strip() for part in (spec or "").split(","))):
+        name, _, rate = part.partition("=")
+        level = logging.getLevelName(name.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError("Unknown log level {!r} in LOG_SAMPLE_RATES".format(name))
+        rates[level] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+def truncate(text, max_length):
+    """Shortens text to max_length characters, saying how much was cut"""
+    if max_length and len(text) > max_length:
+        return "{}...({} more chars)".format(text[:max_length], len(text) - max_length)
+    return text
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of the records of the sampled levels"""
+
+    def __init__(self, rates=None, rand=random.random):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self.rand = rand
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1.0)
+        if rate >= 1.0:
+            return True
+        return rate > 0.0 and self.rand() < rate
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line"""
+
+    def __init__(self, max_length=2048):
+        super().__init__()
+        self.max_length = max_length
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": truncate(record.getMessage(), self.max_length),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith("_"):
+                if not isinstance(value, (str, int, float, bool, type(None))):
+                    value = truncate(repr(value), self.max_length)
+                data[key] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class GuardedQueueHandler(QueueHandler):
+    """A QueueHandler that never blocks and never formats large payloads
+
+    The stdlib QueueHandler formats every record on the calling thread.
+    This one leaves formatting to the listener and only snapshots the
+    arguments with a bounded repr, so later changes to mutable arguments
+    cannot leak into the log and their size does not matter.
+    """
+
+    def __init__(self, log_queue, max_length=2048):
+        super().__init__(log_queue)
+        self.max_length = max_length
+        self.repr = reprlib.Repr()
+        self.repr.maxstring = max_length
+        self.repr.maxother = max_length
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self, value):
+        """Returns an immutable, size-limited stand-in for a log argument"""
+        if isinstance(value, str):
+            return truncate(value, self.max_length)
+        if isinstance(value, (int, float, bool, type(None))):
+            return value
+        if isinstance(value, (list, tuple, dict, set, frozenset)):
+            return self.repr.repr(value)  # elides the items past a few
+        return truncate(str(value), self.max_length)
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(vars(record))
+        if isinstance(record.msg, str):
+            record.msg = truncate(record.msg, self.max_length)
+        else:
+            record.msg = self.snapshot(record.msg)
+        if isinstance(record.args, dict):
+            record.args = {key: self.snapshot(value) for key, value in record.args.items()}
+        elif record.args:
+            record.args = tuple(self.snapshot(value) for value in record.args)
+        if record.exc_info:
+            # tracebacks hold frames, so render them now
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+
+class LogPipeline:
+    """The queue, the handler feeding it and the listener draining it"""
+
+    def __init__(self, handlers, queue_size=10000, max_length=2048, sample_rates=None):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.handler = GuardedQueueHandler(self.queue, max_length=max_length)
+        self.handler.addFilter(SamplingFilter(sample_rates))
+        self.handlers = handlers
+        self.listener = None
+
+    def start(self):
+        """Starts the background thread that writes the records"""
+        if self.listener is None:
+            self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+            self.listener.start()
+
+    def stop(self):
+        """Writes out the queued records and stops the background thread"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def restart_after_fork(self):
+        """Threads do not survive fork(), so forked workers need a new listener"""
+        self.listener = None
+        self.start()
+
+    def stats(self):
+        """Returns the queue depth and the records dropped because it was full"""
+        return {
+            "queued": self.queue.qsize(),
+            "capacity": self.queue.maxsize,
+            "dropped": self.handler.dropped,
+        }
+
+
+def init_logging(app, handlers):
+    """Routes the app's logger through a LogPipeline
+
+    :param app: the Flask app whose logger is set up
+    :param handlers: the handlers that finally write the records
+
+    :return: the started pipeline
+    :rtype: LogPipeline
+
+    """
+    max_length = app.config.get("LOG_MAX_LENGTH", 2048)
+    if app.config.get("LOG_FORMAT", "json") == "json":
+        formatter = JSONFormatter(max_length=max_length)
+    else:
+        formatter = logging.Formatter(
+            "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s",
+            "%Y-%m-%d %H:%M:%S %z"
+        )
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    pipeline = LogPipeline(
+        handlers,
+        queue_size=app.config.get("LOG_QUEUE_SIZE", 10000),
+        max_length=max_length,
+        sample_rates=parse_sample_rates(app.config.get("LOG_SAMPLE_RATES", "")),
+    )
+    app.logger.handlers = [pipeline.handler]
+    app.extensions["log_pipeline"] = pipeline
+    pipeline.start()
+    atexit.register(pipeline.stop)
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=pipeline.restart_after_fork)
+    return pipeline
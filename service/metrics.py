@@ -0,0 +1,313 @@
+"""
+Module: metrics
+
+Per-resource request metrics in the Prometheus text format
+
+Every request is timed from before_request to after_request and counted
+under the flask_restx Resource that served it (WishlistResource,
+ItemCollection, ...) and its HTTP method:
+
+* wishlists_http_request_duration_seconds, a latency histogram
+* wishlists_http_requests_total, a counter by status code
+* wishlists_http_requests_in_progress, a gauge of requests being served
+
+Each thread records into its own shard, so request threads never wait on
+a lock; a scrape adds the shards up. Under gunicorn each worker is a
+separate process with its own shards. Set METRICS_DIR to a directory the
+workers share and every worker writes its totals there every
+METRICS_FLUSH_INTERVAL seconds; GET /metrics, served by whichever worker
+gets it, adds up the files of all of them. The counters of workers that
+have exited are kept, their in-progress gauges are dropped.
+"""
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from flask import g, request
+from service.threads import BackgroundThread
+
+PREFIX = "wishlists_http_"
+
+# the default Prometheus latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def parse_buckets(spec):
+    """Parses "0.01,0.1,1" into sorted bucket bounds, the defaults when empty"""
+    bounds = sorted(float(part) for part in (spec or "").split(",") if part.strip())
+    return tuple(bounds) or DEFAULT_BUCKETS
+
+
+def escape_label(value):
+    """Escapes a label value for the text format"""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Shard:
+    """The metrics recorded by one thread, only ever written by that thread"""
+
+    def __init__(self, size):
+        self.size = size
+        self.latency = {}
+        self.requests = {}
+        self.in_progress = {}
+
+    def observe(self, key, bucket, seconds):
+        """Adds one latency to the histogram of key"""
+        series = self.latency.get(key)
+        if series is None:
+            series = self.latency[key] = [0] * (self.size + 2)  # buckets, +Inf, then the sum
+        series[bucket] += 1
+        series[-1] += seconds
+
+
+class MetricsRegistry:
+    """Thread-sharded request metrics and their Prometheus exposition"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, directory=None, flush_interval=5.0):
+        self.buckets = tuple(buckets)
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()  # only taken when a thread records for the first time
+        self._flusher = BackgroundThread(self._flush_forever, "metrics-flush")
+
+    def shard(self):
+        """Returns the calling thread's shard, creating it on first use"""
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = Shard(len(self.buckets))
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def bucket(self, seconds):
+        """Returns the index of the first bucket a latency falls in"""
+        return bisect_left(self.buckets, seconds)
+
+    def started(self, resource, method):
+        """Counts a request as in progress"""
+        in_progress = self.shard().in_progress
+        key = (resource, method)
+        in_progress[key] = in_progress.get(key, 0) + 1
+
+    def finished(self, resource, method, status_code, seconds):
+        """Records a served request and stops counting it as in progress"""
+        shard = self.shard()
+        key = (resource, method)
+        shard.in_progress[key] = shard.in_progress.get(key, 0) - 1
+        shard.observe(key, self.bucket(seconds), seconds)
+        counted = (resource, method, str(status_code))
+        shard.requests[counted] = shard.requests.get(counted, 0) + 1
+
+    def snapshot(self):
+        """Adds up the shards of this process
+
+        :return: latency histograms, request counts and in-progress gauges keyed
+            by "resource method" (and "status") strings, ready for JSON
+        :rtype: dict
+
+        """
+        latency, requests, in_progress = {}, {}, {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            # dict() copies in one step, while the owning thread may be adding keys
+            for key, series in dict(shard.latency).items():
+                total = latency.setdefault(" ".join(key), [0] * len(series))
+                for index, value in enumerate(list(series)):
+                    total[index] += value
+            for key, count in dict(shard.requests).items():
+                key = " ".join(key)
+                requests[key] = requests.get(key, 0) + count
+            for key, count in dict(shard.in_progress).items():
+                key = " ".join(key)
+                in_progress[key] = in_progress.get(key, 0) + count
+        return {"latency": latency, "requests": requests, "in_progress": in_progress}
+
+    ##################################################
+    # Multi-process mode
+    ##################################################
+
+    def path(self, pid=None):
+        """Returns the file holding a worker's totals"""
+        return os.path.join(self.directory, "metrics_{}.json".format(pid or os.getpid()))
+
+    def flush(self):
+        """Writes this process's totals to METRICS_DIR, replacing its last file atomically"""
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=self.directory, prefix=".metrics_")
+        with os.fdopen(handle, "w") as stream:
+            json.dump(self.snapshot(), stream)
+        os.replace(temporary, self.path())
+
+    def start_flusher(self):
+        """Starts the thread that flushes the totals, once per process"""
+        if self.directory and self._flusher.start():
+            atexit.register(self.flush)
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass  # the next interval tries again
+
+    def collect(self):
+        """Adds up this process and the files the other workers flushed"""
+        totals = self.snapshot()
+        if not self.directory or not os.path.isdir(self.directory):
+            return totals
+        for name in os.listdir(self.directory):
+            if not (name.startswith("metrics_") and name.endswith(".json")):
+                continue
+            pid = int(name[len("metrics_"):-len(".json")])
+            if pid == os.getpid():
+                continue  # the live shards are newer than the last flush
+            try:
+                with open(os.path.join(self.directory, name)) as stream:
+                    worker = json.load(stream)
+            except (OSError, ValueError):
+                continue
+            for key, series in worker["latency"].items():
+                total = totals["latency"].setdefault(key, [0] * len(series))
+                for index, value in enumerate(series):
+                    total[index] += value
+            for key, count in worker["requests"].items():
+                totals["requests"][key] = totals["requests"].get(key, 0) + count
+            if is_alive(pid):
+                for key, count in worker["in_progress"].items():
+                    totals["in_progress"][key] = totals["in_progress"].get(key, 0) + count
+        return totals
+
+    ##################################################
+    # Exposition
+    ##################################################
+
+    def render(self):
+        """Returns every metric in the Prometheus text format"""
+        totals = self.collect()
+        lines = [
+            "# HELP {}request_duration_seconds Request latency by resource and method".format(PREFIX),
+            "# TYPE {}request_duration_seconds histogram".format(PREFIX),
+        ]
+        bounds = ["{:g}".format(bound) for bound in self.buckets] + ["+Inf"]
+        for key, series in sorted(totals["latency"].items()):
+            labels = labels_of(key, ("resource", "method"))
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                lines.append('{}request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                    PREFIX, labels, bound, cumulative
+                ))
+            lines.append("{}request_duration_seconds_sum{{{}}} {}".format(PREFIX, labels, repr(float(series[-1]))))
+            lines.append("{}request_duration_seconds_count{{{}}} {}".format(PREFIX, labels, cumulative))
+        lines += [
+            "# HELP {}requests_total Requests served by resource, method and status code".format(PREFIX),
+            "# TYPE {}requests_total counter".format(PREFIX),
+        ]
+        for key, count in sorted(totals["requests"].items()):
+            lines.append("{}requests_total{{{}}} {}".format(
+                PREFIX, labels_of(key, ("resource", "method", "status")), count
+            ))
+        lines += [
+            "# HELP {}requests_in_progress Requests being served by resource and method".format(PREFIX),
+            "# TYPE {}requests_in_progress gauge".format(PREFIX),
+        ]
+        for key, count in sorted(totals["in_progress"].items()):
+            lines.append("{}requests_in_progress{{{}}} {}".format(
+                PREFIX, labels_of(key, ("resource", "method")), count
+            ))
+        return "\n".join(lines) + "\n"
+
+
+def labels_of(key, names):
+    """Turns a "resource method ..." key into Prometheus labels"""
+    return ",".join('{}="{}"'.format(name, escape_label(value)) for name, value in zip(names, key.split(" ")))
+
+
+def is_alive(pid):
+    """Tells if a process is still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def resource_name(app):
+    """Returns the name of the flask_restx Resource (or view function) serving the request"""
+    if request.url_rule is None:
+        return "unmatched"
+    view = app.view_functions.get(request.url_rule.endpoint)
+    view_class = getattr(view, "view_class", None)
+    return view_class.__name__ if view_class is not None else request.url_rule.endpoint
+
+
+def finish_requests(app, name, finish):
+    """Calls finish(value, response) once for each request that set g.<name>
+
+    after_request does not run when a request fails before a response
+    exists, so those are finished on teardown with a response of None.
+
+    :param app: the Flask app whose requests are finished
+    :param name: the attribute of flask.g set when the request started
+    :param finish: called with the value popped from g and the response
+
+    """
+    @app.after_request
+    def finish_request(response):
+        value = g.pop(name, None)
+        if value is not None:
+            finish(value, response)
+        return response
+
+    @app.teardown_request
+    def finish_failed_request(_):
+        value = g.pop(name, None)
+        if value is not None:
+            finish(value, None)
+
+
+def init_metrics(app):
+    """Times every request of a Flask app into a MetricsRegistry
+
+    :param app: the Flask app to instrument
+    :type app: Flask
+
+    :return: the registry, also kept in app.extensions["metrics"]
+    :rtype: MetricsRegistry
+
+    """
+    registry = MetricsRegistry(
+        buckets=parse_buckets(app.config.get("METRICS_BUCKETS", "")),
+        directory=app.config.get("METRICS_DIR") or None,
+        flush_interval=app.config.get("METRICS_FLUSH_INTERVAL", 5.0),
+    )
+
+    @app.before_request
+    def start_timer():
+        registry.start_flusher()
+        g.metrics = (resource_name(app), request.method, time.perf_counter())
+        registry.started(g.metrics[0], g.metrics[1])
+
+    def record_request(started, response):
+        resource, method, start = started
+        status_code = response.status_code if response is not None else 500
+        registry.finished(resource, method, status_code, time.perf_counter() - start)
+
+    finish_requests(app, "metrics", record_request)
+
+    app.extensions["metrics"] = registry
+    return registry
@@ -0,0 +1,278 @@
+"""
+Module: migrations
+
+Schema creation and online schema changes. The service does not create
+its tables on startup, so new databases get their tables, and existing
+deployments pick up new columns and indexes, by running:
+
+    flask migrate
+
+Columns are added with their server defaults, which PostgreSQL 11+ applies
+without rewriting the table. Indexes are built with
+``CREATE INDEX CONCURRENTLY`` so reads and writes on the tables are not
+blocked while they build. Foreign keys whose ON DELETE action changed are
+swapped for a NOT VALID constraint, validated afterwards without blocking
+writes.
+"""
+from datetime import timedelta
+import click
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn, CreateIndex, DropIndex
+from service.models import db, utcnow, Wishlist, Item, Tombstone, TOMBSTONE_TTL_DAYS
+from . import app
+
+MIGRATED_TABLES = (Wishlist.__table__, Item.__table__, Tombstone.__table__)
+
+# PostgreSQL extensions the model indexes depend on
+EXTENSIONS = ("pg_trgm",)
+
+
+def model_indexes():
+    """Returns every index declared on the models, in a stable order"""
+    indexes = []
+    for table in MIGRATED_TABLES:
+        indexes.extend(sorted(table.indexes, key=lambda index: index.name))
+    return indexes
+
+
+def invalid_indexes(engine):
+    """Returns the names of indexes left INVALID by a failed concurrent build"""
+    if engine.dialect.name != "postgresql":
+        return set()
+    rows = engine.execute(text(
+        "SELECT c.relname FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid"
+    ))
+    return {row[0] for row in rows}
+
+
+def execute_ddl(engine, ddl):
+    """Runs a DDL statement outside of a transaction block"""
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text(ddl))
+
+
+def create_extensions(engine=None):
+    """Enables the PostgreSQL extensions the model indexes need
+
+    :param engine: the engine to migrate, defaults to the app's engine
+    :type engine: Engine
+
+    :return: the names of the extensions that were checked
+    :rtype: list
+
+    """
+    engine = engine or db.engine
+    if engine.dialect.name != "postgresql":
+        return []
+    for extension in EXTENSIONS:
+        execute_ddl(engine, "CREATE EXTENSION IF NOT EXISTS {}".format(extension))
+    return list(EXTENSIONS)
+
+
+def create_tables(engine=None):
+    """Creates any model table that is missing from the database
+
+    :param engine: the engine to migrate, defaults to the app's engine
+    :type engine: Engine
+
+    :return: the names of the tables that were created
+    :rtype: list
+
+    """
+    engine = engine or db.engine
+    existing = set(inspect(engine).get_table_names())
+    missing = [table for table in MIGRATED_TABLES if table.name not in existing]
+    for table in missing:
+        app.logger.info("Creating table %s", table.name)
+    db.Model.metadata.create_all(bind=engine, tables=missing)
+    return [table.name for table in missing]
+
+
+def add_missing_columns(engine=None):
+    """Adds any model column that is missing from an existing table
+
+    :param engine: the engine to migrate, defaults to the app's engine
+    :type engine: Engine
+
+    :return: the "table.column" names that were added
+    :rtype: list
+
+    """
+    engine = engine or db.engine
+    inspector = inspect(engine)
+    added = []
+    for table in MIGRATED_TABLES:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            app.logger.info("Adding column %s.%s", table.name, column.name)
+            default = column.server_default
+            if engine.dialect.name == "sqlite" and default is not None and not isinstance(default.arg, str):
+                # SQLite cannot ADD COLUMN with a non-constant default, so backfill it
+                execute_ddl(engine, "ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table.name, column.name, column.type.compile(dialect=engine.dialect)
+                ))
+                execute_ddl(engine, "UPDATE {} SET {} = {}".format(
+                    table.name, column.name, default.arg.compile(dialect=engine.dialect)
+                ))
+            else:
+                execute_ddl(engine, "ALTER TABLE {} ADD COLUMN {}".format(
+                    table.name, CreateColumn(column).compile(dialect=engine.dialect)
+                ))
+            added.append("{}.{}".format(table.name, column.name))
+    return added
+
+
+def delete_orphan_items(engine=None):
+    """Deletes the Items that Wishlist deletes used to detach instead of deleting
+
+    :param engine: the engine to migrate, defaults to the app's engine
+    :type engine: Engine
+
+    :return: the number of Items deleted
+    :rtype: int
+
+    """
+    engine = engine or db.engine
+    table = Item.__table__
+    with engine.connect() as conn:
+        return conn.execute(table.delete().where(table.c.wishlist_id.is_(None))).rowcount
+
+
+def update_foreign_keys(engine=None):
+    """Gives existing foreign keys the ON DELETE action declared on the models
+
+    :param engine: the engine to migrate, defaults to the app's engine
+    :type engine: Engine
+
+    :return: the names of the foreign keys that were replaced
+    :rtype: list
+
+    """
+    engine = engine or db.engine
+    inspector = inspect(engine)
+    updated = []
+    for table in MIGRATED_TABLES:
+        existing = inspector.get_foreign_keys(table.name)
+        for constraint in sorted(table.foreign_key_constraints, key=lambda fk: fk.column_keys):
+            columns = [column.name for column in constraint.columns]
+            wanted = (constraint.ondelete or "NO ACTION").upper()
+            for current in existing:
+                if current["constrained_columns"] != columns:
+                    continue
+                if (current.get("options", {}).get("ondelete") or "NO ACTION").upper() == wanted:
+                    continue
+                name = current["name"]
+                if engine.dialect.name != "postgresql" or not name:
+                    app.logger.warning(
+                        "Cannot change foreign key %s(%s) in place, recreate the table to get ON DELETE %s",
+                        table.name, ", ".join(columns), wanted,
+                    )
+                    continue
+                app.logger.info("Replacing foreign key %s with ON DELETE %s", name, wanted)
+                # swapping the constraints only takes a brief lock, validating scans without blocking writes
+                execute_ddl(engine, (
+                    "ALTER TABLE {table} DROP CONSTRAINT {name}, ADD CONSTRAINT {name} "
+                    "FOREIGN KEY ({columns}) REFERENCES {referred} ({referred_columns}) "
+                    "ON DELETE {action} NOT VALID"
+                ).format(
+                    table=table.name, name=name, columns=", ".join(columns),
+                    referred=constraint.referred_table.name,
+                    referred_columns=", ".join(element.column.name for element in constraint.elements),
+                    action=wanted,
+                ))
+                execute_ddl(engine, "ALTER TABLE {} VALIDATE CONSTRAINT {}".format(table.name, name))
+                updated.append(name)
+    return updated
+
+
+def create_indexes(engine=None):
+    """Creates any model index that is missing from the database
+
+    :param engine: the engine to migrate, defaults to the app's engine
+    :type engine: Engine
+
+    :return: the names of the indexes that were built
+    :rtype: list
+
+    """
+    engine = engine or db.engine
+    concurrently = engine.dialect.name == "postgresql"
+    create_extensions(engine)
+    inspector = inspect(engine)
+    existing = set()
+    for table in MIGRATED_TABLES:
+        existing.update(index["name"] for index in inspector.get_indexes(table.name))
+    broken = invalid_indexes(engine)
+
+    created = []
+    for index in model_indexes():
+        if index.name in broken:
+            app.logger.warning("Rebuilding invalid index %s", index.name)
+            drop = "DROP INDEX CONCURRENTLY IF EXISTS {}".format(index.name)
+            execute_ddl(engine, drop)
+        elif index.name in existing:
+            continue
+        ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+        if concurrently:
+            ddl = ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+        app.logger.info("Building index %s", index.name)
+        execute_ddl(engine, ddl)
+        created.append(index.name)
+    return created
+
+
+def drop_indexes(engine=None):
+    """Drops every model index that exists in the database
+
+    :param engine: the engine to migrate, defaults to the app's engine
+    :type engine: Engine
+
+    :return: the names of the indexes that were dropped
+    :rtype: list
+
+    """
+    engine = engine or db.engine
+    inspector = inspect(engine)
+    dropped = []
+    for table in MIGRATED_TABLES:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing:
+                execute_ddl(engine, str(DropIndex(index).compile(dialect=engine.dialect)))
+                dropped.append(index.name)
+    return dropped
+
+
+######################################################################
+# Flask CLI commands
+######################################################################
+@app.cli.command("migrate")
+def migrate_command():
+    """Creates the tables or brings an existing database up to date with the models"""
+    created = create_tables()
+    click.echo("Created tables: {}".format(", ".join(created) or "none"))
+    added = add_missing_columns()
+    click.echo("Added columns: {}".format(", ".join(added) or "none"))
+    deleted = delete_orphan_items()
+    click.echo("Deleted orphan items: {}".format(deleted))
+    updated = update_foreign_keys()
+    click.echo("Updated foreign keys: {}".format(", ".join(updated) or "none"))
+    created = create_indexes()
+    click.echo("Created indexes: {}".format(", ".join(created) or "none"))
+
+
+@app.cli.command("create-indexes")
+def create_indexes_command():
+    """Builds missing model indexes without locking the tables"""
+    created = create_indexes()
+    click.echo("Created indexes: {}".format(", ".join(created) or "none"))
+
+
+@app.cli.command("prune-tombstones")
+def prune_tombstones_command():
+    """Deletes the tombstones delta syncs no longer need, run it daily"""
+    deleted = Tombstone.prune(utcnow() - timedelta(days=TOMBSTONE_TTL_DAYS))
+    click.echo("Pruned tombstones: {}".format(deleted))
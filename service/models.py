@@ -11,6 +11,9 @@ Attributes:
 -----------
 name (string) - the name of the wishlist
 customer_id (int) - the customer_id the wishlist belongs to (i.e., 1, 2)
+version (int) - bumped whenever the wishlist or one of its items changes
+created_at (datetime) - when the wishlist was created
+updated_at (datetime) - when the wishlist or one of its items last changed
 
 Items
 ------
@@ -20,26 +23,105 @@ Attributes:
 -----------
 name (string) - the name of the wishlist
 wishlist_id (int) - the wishlist the item belongs to (i.e., 1, 2)
+created_at (datetime) - when the item was created
+updated_at (datetime) - when the item last changed
+
+Tombstones
+------
+Tombstone - A deleted Wishlist or Item, kept for delta syncs
+
+Attributes:
+-----------
+kind (string) - "wishlist" or "item"
+object_id (int) - the id of the deleted wishlist or item
+wishlist_id (int) - the wishlist the item was on
+customer_id (int) - the customer the deleted object belonged to
+deleted_at (datetime) - when it was deleted
 
 """
 import os
 import logging
+from contextlib import contextmanager
+from datetime import datetime
 from enum import Enum
 from flask_sqlalchemy import SQLAlchemy
-from retry import retry
-from requests import HTTPError, ConnectionError
+from sqlalchemy import DDL, event, inspect
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.pool import Pool
+from sqlalchemy.orm import make_transient_to_detached
 from . import app, APP_NAME, VERSION
-
-# global variables for retry (must be int)
-RETRY_COUNT = int(os.environ.get("RETRY_COUNT", 10))
-RETRY_DELAY = int(os.environ.get("RETRY_DELAY", 1))
-RETRY_BACKOFF = int(os.environ.get("RETRY_BACKOFF", 2))
+from .pool import instrument
+from .queries import instrument_queries
+from .cache import ReadThroughCache, backend_from_config
+from .serializers import compile_serializer
+from .resilience import CircuitBreaker, RetryPolicy, guarded
+
+# global variables for retrying transient database errors (delays in seconds)
+RETRY_COUNT = int(os.environ.get("RETRY_COUNT", 3))
+RETRY_DELAY = float(os.environ.get("RETRY_DELAY", 0.1))
+RETRY_BACKOFF = float(os.environ.get("RETRY_BACKOFF", 2))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", 1))
+RETRY_BUDGET = float(os.environ.get("RETRY_BUDGET", 5))
+
+# global variables for the database circuit breaker
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", 30))
+
+# global variables for keyset pagination (must be int)
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 1000))
+
+# largest number of Items accepted by a single bulk insert (must be int)
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 1000))
+
+# Wishlists with more Items than this are purged in the background (must be int)
+PURGE_THRESHOLD = int(os.environ.get("PURGE_THRESHOLD", 1000))
+# Items deleted per transaction by a background purge (must be int)
+PURGE_BATCH_SIZE = int(os.environ.get("PURGE_BATCH_SIZE", 1000))
+
+# Tombstones older than this many days are pruned, delta syncs from before then must start over
+TOMBSTONE_TTL_DAYS = float(os.environ.get("TOMBSTONE_TTL_DAYS", 30))
+
+# the Item columns a listing may return (fields=) and be ordered by (sort=)
+ITEM_FIELDS = ("id", "name", "wishlist_id", "purchased")
+ITEM_SORT_COLUMNS = ("id", "name", "purchased")
+
+# purchases the listed items and reports the ones that already were purchased
+PURCHASE_MANY_SQL = """
+WITH purchased AS (
+    UPDATE item SET purchased = TRUE, updated_at = :now
+    WHERE wishlist_id = :wishlist_id AND id = ANY(:ids) AND NOT purchased
+    RETURNING id
+)
+SELECT id, TRUE FROM purchased
+UNION ALL
+SELECT id, FALSE FROM item WHERE wishlist_id = :wishlist_id AND id = ANY(:ids) AND purchased
+"""
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# the trigram indexes need pg_trgm, so create_all() enables it first on PostgreSQL
+event.listen(
+    db.Model.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+
+# Read-through cache of serialized rows, the backend is set in init_db()
+cache = ReadThroughCache()
+
+# Every database call goes through one breaker shared by the process
+breaker = CircuitBreaker(failure_threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT)
+retry_policy = RetryPolicy(
+    tries=RETRY_COUNT, delay=RETRY_DELAY, backoff=RETRY_BACKOFF,
+    max_delay=RETRY_MAX_DELAY, budget=RETRY_BUDGET
+)
+
 
 class DatabaseConnectionError(Exception):
     """Custom Exception when database connection fails"""
@@ -50,10 +132,337 @@ class DataValidationError(Exception):
     pass
 
 
+def key_id(value):
+    """Normalizes an id for a cache key, so "01", "1" and 1 name the same entry"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+def wishlist_key(wishlist_id):
+    """Cache key of a single Wishlist"""
+    return "wishlist:{}".format(key_id(wishlist_id))
+
+def item_key(wishlist_id, item_id):
+    """Cache key of a single Item on a Wishlist"""
+    return "item:{}:{}".format(key_id(wishlist_id), key_id(item_id))
+
+def old_and_new(instance, attribute):
+    """Returns the current value of an attribute and any value it replaced"""
+    history = inspect(instance).attrs[attribute].history
+    return {getattr(instance, attribute)} | set(history.deleted or ())
+
+def serialize_or_none(instance):
+    """Serializes a model instance for the cache, passing None through"""
+    return None if instance is None else instance.serialize()
+
+def utcnow():
+    """Returns the current time as a naive UTC datetime"""
+    return datetime.utcnow()
+
+class UTCNow(FunctionElement):
+    """The current time as a naive UTC timestamp, the server side utcnow()"""
+    type = db.DateTime()
+    name = "utc_now"
+
+@compiles(UTCNow)
+def compile_utc_now(element, compiler, **kw):
+    """CURRENT_TIMESTAMP is already in UTC on SQLite"""
+    return "CURRENT_TIMESTAMP"
+
+@compiles(UTCNow, "postgresql")
+def compile_utc_now_postgresql(element, compiler, **kw):
+    """CURRENT_TIMESTAMP is in the session's time zone on PostgreSQL"""
+    return "(now() AT TIME ZONE 'utc')"
+
+def isoformat_or_none(value):
+    """Formats a datetime as ISO 8601, passing None through"""
+    return None if value is None else value.isoformat()
+
+# the fields serialize() returns, as (key, attribute[, converter]); the list
+# endpoints and the async queries serialize from the same lists
+WISHLIST_SERIALIZED = (
+    ("id", "id"),
+    ("name", "name"),
+    ("customer_id", "customer_id"),
+    ("version", "version"),
+    ("updated_at", "updated_at", isoformat_or_none),
+)
+ITEM_SERIALIZED = tuple((field, field) for field in ITEM_FIELDS)
+
+serialize_wishlist = compile_serializer(WISHLIST_SERIALIZED)
+serialize_item = compile_serializer(ITEM_SERIALIZED)
+
+def purchase_selector(data):
+    """Reads the Items a bulk purchase applies to from a request body
+
+    :param data: {"ids": [1, 2, ...]} or {"all": true} for every unpurchased Item
+    :type data: dict
+
+    :return: the Item ids, or None for every unpurchased Item
+    :rtype: list
+
+    """
+    if not isinstance(data, dict):
+        raise DataValidationError("Invalid purchase: body of request contained bad or no data")
+    if data.get("all") is True and "ids" not in data:
+        return None
+    item_ids = data.get("ids")
+    if not isinstance(item_ids, list) or not all(
+            isinstance(item_id, int) and not isinstance(item_id, bool) for item_id in item_ids
+    ):
+        raise DataValidationError('Invalid purchase: "ids" must be a list of item ids, or pass "all": true')
+    if len(item_ids) > MAX_BATCH_SIZE:
+        raise DataValidationError(
+            "Invalid purchase: at most {} items may be purchased at once".format(MAX_BATCH_SIZE)
+        )
+    return item_ids
+
+def parse_sort(names, columns):
+    """Reads sort keys such as ["-purchased", "name"] into (column, descending) pairs
+
+    :param names: column names, each optionally prefixed with "-" for descending order
+    :type names: list
+    :param columns: the column names that may be sorted on
+    :type columns: tuple
+
+    :return: (column name, descending) pairs, in order
+    :rtype: list
+
+    """
+    keys = []
+    for name in filter(None, (name.strip() for name in names or [])):
+        descending = name.startswith("-")
+        column = name.lstrip("-+")
+        if column not in columns:
+            raise DataValidationError(
+                "Invalid sort: {!r} is not one of {}".format(column, ", ".join(columns))
+            )
+        keys.append((column, descending))
+    return keys
+
+def parse_fields(names, columns):
+    """Checks the fields asked for are columns, keeping their order
+
+    :param names: the names of the fields to return, None or empty for all of them
+    :type names: list
+    :param columns: the column names that may be returned
+    :type columns: tuple
+
+    :return: the field names without duplicates, or all columns
+    :rtype: list
+
+    """
+    fields = []
+    for name in filter(None, (name.strip() for name in names or [])):
+        if name not in columns:
+            raise DataValidationError(
+                "Invalid fields: {!r} is not one of {}".format(name, ", ".join(columns))
+            )
+        if name not in fields:
+            fields.append(name)
+    return fields or list(columns)
+
+def read_rows(query):
+    """Runs a Core select of plain columns, without building ORM instances
+
+    The rows are not added to the session's identity map. Their columns
+    read as attributes (row.id, row.name), so the compiled serializers
+    accept them like model instances.
+
+    :param query: the select to run
+    :type query: Select
+
+    :return: read-only named rows
+    :rtype: list
+
+    """
+    return db.session.execute(query).fetchall()
+
+def from_cache(cls, data):
+    """Attaches a cached row to the session as a persistent instance
+
+    merge(load=False) adds the instance without a SELECT, so a cache hit
+    costs no database round trip but can still be updated or deleted.
+    """
+    if data is None:
+        return None
+    data = dict(data)
+    for column in cls.__table__.columns:
+        if isinstance(column.type, db.DateTime) and isinstance(data.get(column.name), str):
+            data[column.name] = datetime.fromisoformat(data[column.name])
+    instance = cls(**data)
+    make_transient_to_detached(instance)
+    return db.session.merge(instance, load=False)
+
+def db_call(retry=True):
+    """Guards a model method with the circuit breaker and retry policy
+
+    Transient failures roll back the session and surface as a
+    DatabaseConnectionError (503). Pass retry=False for writes that cannot
+    simply be replayed after a rollback. Inside a unit of work the
+    transaction belongs to the caller, so nothing is rolled back or
+    retried there: the error reaches unit_of_work() or savepoint() instead.
+    A db_call made from inside another one (i.e. begin_unit() in
+    Wishlist.create()) runs as part of the outer call.
+    """
+    return guarded(
+        breaker,
+        retry_policy if retry else None,
+        on_error=rollback_outside_unit_of_work,
+        error_class=DatabaseConnectionError,
+        can_retry=lambda: current_unit_of_work() is None,
+    )
+
+class UnitOfWork:
+    """The cache keys staged by the writes of one database transaction"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.keys = []
+
+    def invalidate(self, *keys):
+        """Stages cache keys to invalidate once the transaction has committed"""
+        self.keys.extend(keys)
+
+def current_unit_of_work():
+    """Returns the UnitOfWork the session is in, or None"""
+    return db.session.info.get("unit_of_work")
+
+def rollback_outside_unit_of_work():
+    """Rolls back the session after a failed call, unless a unit of work owns it"""
+    if current_unit_of_work() is None:
+        db.session.rollback()
+
+@db_call()
+def begin_unit():
+    """Opens a transaction on the session's AUTOCOMMIT connection"""
+    connection = db.session.connection()
+    connection.execute(db.text("BEGIN"))
+    return connection
+
+@db_call(retry=False)
+def commit_unit(work):
+    """Flushes the session and commits the unit's transaction"""
+    db.session.flush()
+    work.connection.execute(db.text("COMMIT"))
+
+def abort_unit(work):
+    """Rolls back the unit's transaction and the session"""
+    try:
+        work.connection.execute(db.text("ROLLBACK"))
+    except SQLAlchemyError:
+        # never hand a connection that may still be in a transaction back to the pool
+        app.logger.warning("Could not roll back a unit of work", exc_info=True)
+        work.connection.invalidate()
+    db.session.rollback()
+
+@contextmanager
+def unit_of_work():
+    """Runs the writes of a block in one database transaction
+
+    The engine is configured with AUTOCOMMIT, so every statement sent
+    outside of a unit of work is committed (and flushed to disk) on its
+    own. In a unit of work the changes are staged in a single
+    BEGIN ... COMMIT instead, and the cache keys the writes staged are
+    only invalidated after that commit. An exception rolls the whole unit
+    back and invalidates nothing.
+
+    A unit of work opened inside another one joins it. Use savepoint()
+    around the parts of a unit that may fail on their own.
+
+        with unit_of_work():
+            for item in items:
+                item.create(wishlist_id)
+
+    :return: the UnitOfWork, whose invalidate() stages cache keys
+    :rtype: UnitOfWork
+
+    """
+    work = current_unit_of_work()
+    if work is not None:
+        yield work
+        return
+    work = UnitOfWork(begin_unit())
+    db.session.info["unit_of_work"] = work
+    try:
+        yield work
+        commit_unit(work)
+    except BaseException:
+        del db.session.info["unit_of_work"]
+        abort_unit(work)
+        raise
+    del db.session.info["unit_of_work"]
+    db.session.commit()  # the driver commit is a no-op, this expires the instances as usual
+    cache.invalidate(*work.keys)
+
+@contextmanager
+def savepoint():
+    """Runs part of a unit of work so that it can fail on its own
+
+    An exception in the block rolls back to a SAVEPOINT taken on entry,
+    drops the cache keys staged since, and is raised again; the caller may
+    catch it and go on with the rest of the unit. Outside of a unit of
+    work, savepoint() is a unit of work of its own.
+
+    :return: the enclosing UnitOfWork
+    :rtype: UnitOfWork
+
+    """
+    work = current_unit_of_work()
+    if work is None:
+        with unit_of_work() as work:
+            yield work
+        return
+    staged = len(work.keys)
+    nested = db.session.begin_nested()
+    try:
+        yield work
+        nested.commit()
+    except BaseException:
+        nested.rollback()  # also closes a savepoint a failed flush already rolled back
+        del work.keys[staged:]
+        raise
+
+def init_app(app):
+    """Configures the models for a Flask app without touching the database
+
+    Flask-SQLAlchemy creates the engine and opens connections on first use,
+    so this is cheap and safe to run before gunicorn forks its workers.
+    """
+    instrument(app)
+    instrument_queries(app)
+    if str(app.config.get("SQLALCHEMY_DATABASE_URI", "")).startswith("sqlite"):
+        # pooled SQLite connections are handed to request and background purge threads alike
+        options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        options["connect_args"] = dict(options.get("connect_args", {}), check_same_thread=False)
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+    cache.backend = backend_from_config(app.config)
+    Wishlist.app = app
+    Item.app = app
+    db.init_app(app)
+
 def init_db(app, pool=None):
-    """Initialies the SQLAlchemy app"""
-    Wishlist.init_db(app, pool)
-    Item.init_db(app, pool)
+    """Configures the app, pushes an app context and creates missing tables
+
+    For tests and tools that use the models outside of a request. The
+    service itself is only configured by create_app(), and `flask migrate`
+    creates the tables.
+    """
+    from service import create_app  # pylint: disable=import-outside-toplevel
+
+    create_app()
+    app.app_context().push()
+    db.create_all()
+
+@event.listens_for(Pool, "connect")
+def enable_foreign_keys(dbapi_connection, _):
+    """Makes SQLite enforce foreign keys (and ON DELETE CASCADE) like PostgreSQL does"""
+    if type(dbapi_connection).__module__.split(".")[0] != "sqlite3":
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys = ON")
+    cursor.close()
 
 class Wishlist(db.Model):
     """
@@ -64,6 +473,19 @@ class Wishlist(db.Model):
     """
 
     __tablename__ = 'wishlist'
+    __table_args__ = (
+        # serves the keyset pages filtered by customer
+        db.Index("ix_wishlist_customer_id_id", "customer_id", "id"),
+        # serves the delta sync of a customer's changes (see changed_rows)
+        db.Index("ix_wishlist_customer_id_updated_at", "customer_id", "updated_at"),
+        # trigram index behind the prefix and fuzzy name search (see service/search.py)
+        db.Index(
+            "ix_wishlist_name_trgm",
+            "name",
+            postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"},
+        ),
+    )
 
     app = None
 
@@ -73,8 +495,16 @@ class Wishlist(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(63), nullable=False)
     customer_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=utcnow, server_default=UTCNow()
+    )
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=utcnow, server_default=UTCNow()
+    )
 
-    items = db.relationship("Item", backref="wishlist")
+    # the database deletes the Items (ON DELETE CASCADE), the ORM does not load them
+    items = db.relationship("Item", backref="wishlist", cascade="all, delete", passive_deletes=True)
 
     ##################################################
     # INSTANCE METHODS
@@ -83,17 +513,18 @@ class Wishlist(db.Model):
     def __repr__(self):
         return "<Wishlist %r id=[%s]>" % (self.name, self.id)
 
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
+    @db_call(retry=False)
     def create(self):
         """
         Creates a Wishlist to the database
         """
         app.logger.info("Creating %s", self.name)
         self.id = None  # id must be none to generate next primary key
-        db.session.add(self)
-        db.session.commit()
+        with unit_of_work() as work:
+            db.session.add(self)
+            db.session.flush()
 
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
+    @db_call(retry=False)
     def update(self):
         """
         Updates a Wishlist to the database
@@ -101,22 +532,44 @@ class Wishlist(db.Model):
         app.logger.info("Saving %s", self.name)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
-        db.session.commit()
-
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
+        keys = self.cache_keys()
+        with unit_of_work() as work:
+            self.version = Wishlist.version + 1  # incremented by the database
+            self.updated_at = utcnow()
+            # a Wishlist given to another customer is deleted as far as the old one syncs
+            old_customers = {str(value) for value in old_and_new(self, "customer_id")} - {str(self.customer_id)}
+            for customer_id in old_customers:
+                Tombstone.record("wishlist", [self.id], self.id, int(customer_id))
+            if old_customers:
+                # and new to the new one, Items included, though they did not change
+                item = Item.__table__
+                db.session.execute(
+                    item.update().where(item.c.wishlist_id == self.id).values(updated_at=self.updated_at)
+                )
+            db.session.flush()
+            work.invalidate(*keys)
+
+    @db_call()
     def delete(self):
         """Removes a Wishlist from the data store"""
         app.logger.info("Deleting %s", self.name)
-        db.session.delete(self)
-        db.session.commit()
+        keys = self.cache_keys()
+        with unit_of_work() as work:
+            # only the ids are read, for the cache keys: the database deletes the Items
+            keys += [item_key(self.id, item_id) for item_id in Item.ids_on_wishlist(self.id)]
+            # the client drops the Items with their Wishlist, so they need no tombstones
+            Tombstone.record("wishlist", [self.id], self.id, self.customer_id)
+            db.session.delete(self)
+            db.session.flush()
+            work.invalidate(*keys)
+
+    def cache_keys(self):
+        """Returns the cache keys that may hold this Wishlist"""
+        return [wishlist_key(wishlist_id) for wishlist_id in old_and_new(self, "id")]
 
     def serialize(self):
         """Serializes a Wishlist into a dictionary"""
-        return {
-            "id": self.id,
-            "name": self.name,
-            "customer_id": self.customer_id,
-        }
+        return serialize_wishlist(self)
 
     def deserialize(self, data):
         """
@@ -145,29 +598,66 @@ class Wishlist(db.Model):
     ##################################################
 
     @classmethod
-    def init_db(cls, app, pool=None):
-        """Initializes the database session
+    def touch(cls, wishlist_id):
+        """Bumps the version of a Wishlist whose items have changed
+
+        The UPDATE joins the caller's unit of work, which stages the returned
+        cache keys until it commits.
 
-        :param app: the Flask app
-        :type data: Flask
+        :param wishlist_id: the id of the Wishlist to bump
+        :type wishlist_id: int
+
+        :return: the cache keys that held the old version
+        :rtype: list
 
         """
-        app.logger.info("Initializing Wishlist tables")
-        cls.app = app
-        # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        table = cls.__table__
+        db.session.execute(
+            table.update()
+            .where(table.c.id == wishlist_id)
+            .values(version=table.c.version + 1, updated_at=utcnow())
+        )
+        return [wishlist_key(wishlist_id)]
 
     @classmethod
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
+    def purge(cls, wishlist_id, batch_size=PURGE_BATCH_SIZE):
+        """Deletes a Wishlist with many Items a batch of Items at a time
+
+        Each batch is its own short transaction, so no single statement
+        holds locks on every Item. The Wishlist itself goes last, with any
+        Item added in the meantime.
+
+        :param wishlist_id: the id of the Wishlist to delete
+        :type wishlist_id: int
+        :param batch_size: the most Items deleted per transaction
+        :type batch_size: int
+
+        :return: the number of Items deleted in batches
+        :rtype: int
+
+        """
+        app.logger.info("Purging Wishlist %s", wishlist_id)
+        purged = 0
+        while True:
+            deleted = Item.delete_batch(wishlist_id, batch_size)
+            purged += deleted
+            if deleted < batch_size:
+                break
+        wishlist = cls.find(wishlist_id)
+        if wishlist:
+            wishlist.delete()
+        app.logger.info("Purged Wishlist %s and %s Items", wishlist_id, purged)
+        return purged
+
+    @classmethod
+    @db_call()
     def all(cls):
         """Returns all of the Wishlists in the database"""
         app.logger.info("Processing all Wishlists")
         return cls.query.all()
 
     @classmethod
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
+    @db_call()
     def find(cls, wishlist_id):
         """Finds a Wishlist by its ID
 
@@ -179,10 +669,13 @@ class Wishlist(db.Model):
 
         """
         app.logger.info("Processing lookup for id %s ...", wishlist_id)
-        return cls.query.get(wishlist_id)
+        data = cache.get_or_load(
+            wishlist_key(wishlist_id), lambda: serialize_or_none(cls.query.get(wishlist_id))
+        )
+        return from_cache(cls, data)
 
     @classmethod
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
+    @db_call()
     def find_or_404(cls, wishlist_id):
         """Find a Wishlist by it's id
 
@@ -197,22 +690,106 @@ class Wishlist(db.Model):
         return cls.query.get_or_404(wishlist_id)
 
 
+
+
+
+
     @classmethod
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
-    def find_by_customer_id(cls, customer_id):
-        """Returns all of the Wishlists in a customer_id
+    @db_call()
+    def find_page_rows(cls, after=None, limit=PAGE_SIZE, customer_id=None):
+        """Returns one keyset page of Wishlists as plain rows ordered by id
+
+        The rows are not ORM instances and are not tracked by the session.
 
-        :param customer_id: the customer_id of the Wishlists you want to match
+        :param after: only return Wishlists with an id greater than this cursor
+        :type after: int
+        :param limit: the maximum number of Wishlists to return
+        :type limit: int
+        :param customer_id: optionally restrict the page to one customer
         :type customer_id: int
 
-        :return: a collection of Wishlists in that customer_id
+        :return: at most `limit` rows with ids after the cursor
         :rtype: list
 
         """
-        app.logger.info("Processing customer_id query for %s ...", customer_id)
-        return cls.query.filter(cls.customer_id == customer_id).all()
+        app.logger.info("Processing page row query after %s (limit %s) ...", after, limit)
+        table = cls.__table__
+        query = db.select(table.columns)
+        if customer_id is not None:
+            query = query.where(table.c.customer_id == customer_id)
+        if after is not None:
+            query = query.where(table.c.id > after)
+        return read_rows(query.order_by(table.c.id).limit(limit))
+
+    @classmethod
+    @db_call()
+    def changed_rows(cls, customer_id, since=None, after=None, limit=PAGE_SIZE):
+        """Returns one keyset page of the Wishlists of a customer changed since a time, as plain rows
+
+        A change to an Item also moves its Wishlist's updated_at, so the
+        Wishlists returned are the only ones whose Items may have changed.
+
+        :param customer_id: the customer whose Wishlists to return
+        :type customer_id: int
+        :param since: only return Wishlists updated at or after this time, all when None
+        :type since: datetime
+        :param after: only return Wishlists with an id greater than this
+        :type after: int
+        :param limit: the maximum number of Wishlists to return
+        :type limit: int
+
+        :return: the rows ordered by id
+        :rtype: list
+
+        """
+        app.logger.info("Processing changed Wishlists of customer %s since %s ...", customer_id, since)
+        table = cls.__table__
+        query = db.select(table.columns).where(table.c.customer_id == customer_id)
+        if since is not None:
+            query = query.where(table.c.updated_at >= since)
+        if after is not None:
+            query = query.where(table.c.id > after)
+        return read_rows(query.order_by(table.c.id).limit(limit))
+
+    @classmethod
+    def iter_pages(cls, customer_id=None, page_size=PAGE_SIZE):
+        """Yields the row of every Wishlist one keyset page at a time
+
+        Only a single page of rows is held in memory at once, so this is
+        safe to use on tables of any size.
+
+        :param customer_id: optionally restrict the walk to one customer
+        :type customer_id: int
+        :param page_size: how many rows to fetch per query
+        :type page_size: int
+
+        """
+        for page in cls.pages(customer_id=customer_id, page_size=page_size):
+            for wishlist in page:
+                yield wishlist
+
+    @classmethod
+    def pages(cls, customer_id=None, page_size=PAGE_SIZE):
+        """Yields the rows of every Wishlist in keyset pages, one list per query
+
+        Callers that load something for each Wishlist can then do it with
+        one query per page rather than one per Wishlist.
+
+        :param customer_id: optionally restrict the walk to one customer
+        :type customer_id: int
+        :param page_size: how many rows to fetch per query
+        :type page_size: int
+
+        """
+        after = None
+        while True:
+            page = cls.find_page_rows(after=after, limit=page_size, customer_id=customer_id)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after = page[-1].id
 
-    
 
 
 class Item(db.Model):
@@ -224,6 +801,26 @@ class Item(db.Model):
     """
 
     __tablename__ = 'item'
+    __table_args__ = (
+        # serves find_rows_by_wishlist_id and find_on_wishlist
+        db.Index("ix_item_wishlist_id_id", "wishlist_id", "id"),
+        # serves the delta sync of the Items on changed Wishlists (see changed_rows)
+        db.Index("ix_item_wishlist_id_updated_at", "wishlist_id", "updated_at"),
+        # partial index that only covers the items still left to buy
+        db.Index(
+            "ix_item_wishlist_id_unpurchased",
+            "wishlist_id",
+            postgresql_where=db.text("NOT purchased"),
+            sqlite_where=db.text("NOT purchased"),
+        ),
+        # trigram index behind the prefix and fuzzy name search (see service/search.py)
+        db.Index(
+            "ix_item_name_trgm",
+            "name",
+            postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"},
+        ),
+    )
 
     app = None
 
@@ -232,8 +829,16 @@ class Item(db.Model):
     ##################################################
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(63), nullable=False)
-    wishlist_id = db.Column(db.Integer, db.ForeignKey('wishlist.id'))
+    wishlist_id = db.Column(db.Integer, db.ForeignKey('wishlist.id', ondelete="CASCADE"))
     purchased = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=utcnow, server_default=UTCNow()
+    )
+    # also set by Core UPDATEs (purchase_many) that do not name it
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=utcnow, onupdate=utcnow,
+        server_default=UTCNow(),
+    )
 
     ##################################################
     # INSTANCE METHODS
@@ -242,7 +847,7 @@ class Item(db.Model):
     def __repr__(self):
         return "<Item %r id=[%s]>" % (self.name, self.id)
 
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
+    @db_call(retry=False)
     def create(self, wishlist_id):
         """
         Creates a Item to the database
@@ -250,10 +855,12 @@ class Item(db.Model):
         app.logger.info("Creating %s", self.name)
         self.id = None  # id must be none to generate next primary key
         self.wishlist_id = wishlist_id
-        db.session.add(self)
-        db.session.commit()
+        with unit_of_work() as work:
+            db.session.add(self)
+            db.session.flush()
+            work.invalidate(*Wishlist.touch(wishlist_id))
 
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
+    @db_call(retry=False)
     def update(self):
         """
         Updates a Item to the database
@@ -261,24 +868,48 @@ class Item(db.Model):
         app.logger.info("Saving %s", self.name)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
-        db.session.commit()
-
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
+        # an Item moved to another Wishlist is deleted from the old one
+        moved_from = {str(value) for value in old_and_new(self, "wishlist_id") if value is not None}
+        moved_from.discard(str(self.wishlist_id))
+        with unit_of_work() as work:
+            work.invalidate(*self.cache_keys())
+            work.invalidate(*self.touch_wishlists())
+            for wishlist_id in moved_from:
+                Tombstone.record_items(wishlist_id, [self.id])
+            db.session.flush()
+
+    @db_call()
     def delete(self):
         """Removes a Item from the data store"""
         app.logger.info("Deleting %s", self.name)
-        db.session.delete(self)
-        db.session.commit()
+        with unit_of_work() as work:
+            work.invalidate(*self.cache_keys())
+            work.invalidate(*self.touch_wishlists())
+            if self.wishlist_id is not None:
+                Tombstone.record_items(self.wishlist_id, [self.id])
+            db.session.delete(self)
+            db.session.flush()
+
+    def cache_keys(self):
+        """Returns the cache keys that may hold this Item"""
+        return [
+            item_key(wishlist_id, item_id)
+            for wishlist_id in old_and_new(self, "wishlist_id")
+            for item_id in old_and_new(self, "id")
+        ]
+
+    def touch_wishlists(self):
+        """Bumps the version of the Wishlists this Item was and is on"""
+        keys = []
+        # the same id may show up as both "1" and 1 after deserialize()
+        for wishlist_id in {str(value) for value in old_and_new(self, "wishlist_id") if value is not None}:
+            keys += Wishlist.touch(wishlist_id)
+        return keys
 
 
     def serialize(self):
         """Serializes a Item into a dictionary"""
-        return {
-            "id": self.id,
-            "name": self.name,
-            "wishlist_id": self.wishlist_id,
-            "purchased": self.purchased,
-        }
+        return serialize_item(self)
 
     def deserialize(self, data):
         """
@@ -308,23 +939,110 @@ class Item(db.Model):
     ##################################################
 
     @classmethod
-    def init_db(cls, app, pool=None):
-        """Initializes the database session
+    @db_call(retry=False)
+    def create_many(cls, wishlist_id, items):
+        """
+        Creates many Items on a Wishlist with a single multi-row INSERT
 
-        :param app: the Flask app
-        :type data: Flask
+        :param wishlist_id: the id of the Wishlist the Items belong to
+        :type wishlist_id: int
+        :param items: the deserialized Items to insert
+        :type items: list
+
+        :return: the ids assigned to the Items, in the same order
+        :rtype: list
 
         """
-        app.logger.info("Initializing Item tables")
-        cls.app = app
-        # This is where we initialize SQLAlchemy from the Flask app
-        app.logger.info(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
-        db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        app.logger.info("Creating %s Items on Wishlist %s", len(items), wishlist_id)
+        if not items:
+            return []
+        if len(items) > MAX_BATCH_SIZE:
+            raise DataValidationError(
+                "Invalid batch: at most {} items may be created at once".format(MAX_BATCH_SIZE)
+            )
+        table = cls.__table__
+        rows = [
+            {"name": item.name, "wishlist_id": wishlist_id, "purchased": bool(item.purchased)}
+            for item in items
+        ]
+        with unit_of_work() as work:
+            if db.engine.dialect.implicit_returning:
+                # INSERT ... VALUES (...), (...) RETURNING id in one round trip
+                statement = table.insert().values(rows).returning(table.c.id)
+                ids = [row[0] for row in db.session.execute(statement)]
+            else:
+                # dialects without RETURNING (i.e., SQLite) still share one transaction
+                ids = [
+                    db.session.execute(table.insert().values(row)).inserted_primary_key[0]
+                    for row in rows
+                ]
+            work.invalidate(*Wishlist.touch(wishlist_id))
+        for item, item_id in zip(items, ids):
+            item.id = item_id
+            item.wishlist_id = wishlist_id
+        return ids
+
+    @classmethod
+    @db_call(retry=False)
+    def purchase_many(cls, wishlist_id, item_ids=None):
+        """
+        Marks many Items on a Wishlist as purchased with a single UPDATE
+
+        :param wishlist_id: the id of the Wishlist the Items are on
+        :type wishlist_id: int
+        :param item_ids: the ids of the Items to purchase, None for every unpurchased Item
+        :type item_ids: list
+
+        :return: the ids purchased now, the ids that already were purchased and
+            the ids that are not on the Wishlist, each sorted
+        :rtype: tuple
+
+        """
+        app.logger.info(
+            "Purchasing %s Items on Wishlist %s", "all" if item_ids is None else len(item_ids), wishlist_id
+        )
+        if item_ids is not None:
+            item_ids = sorted(set(item_ids))
+            if not item_ids:
+                return [], [], []
+        table = cls.__table__
+        criteria = [table.c.wishlist_id == wishlist_id]
+        if item_ids is None:
+            criteria.append(table.c.purchased.is_(False))
+        else:
+            criteria.append(table.c.id.in_(item_ids))
+
+        with unit_of_work() as work:
+            if item_ids is not None and db.engine.dialect.name == "postgresql":
+                # the SELECT sees the rows as they were before the UPDATE in the same statement
+                rows = db.session.execute(
+                    db.text(PURCHASE_MANY_SQL), {"wishlist_id": wishlist_id, "ids": item_ids, "now": utcnow()}
+                ).fetchall()
+                updated = [row[0] for row in rows if row[1]]
+                already = [row[0] for row in rows if not row[1]]
+            elif db.engine.dialect.implicit_returning:
+                statement = table.update().where(db.and_(*criteria)).values(purchased=True)
+                updated = [row[0] for row in db.session.execute(statement.returning(table.c.id))]
+                already = []
+            else:
+                # dialects without RETURNING (i.e., SQLite) read the rows first in the same transaction
+                rows = db.session.execute(
+                    db.select([table.c.id, table.c.purchased]).where(db.and_(*criteria))
+                ).fetchall()
+                updated = [row[0] for row in rows if not row[1]]
+                already = [row[0] for row in rows if row[1]]
+                if updated:
+                    statement = table.update().where(table.c.id.in_(updated)).values(purchased=True)
+                    db.session.execute(statement)
+
+            work.invalidate(*[item_key(wishlist_id, item_id) for item_id in updated])
+            if updated:
+                work.invalidate(*Wishlist.touch(wishlist_id))
+        missing = [] if item_ids is None else sorted(set(item_ids) - set(updated) - set(already))
+        return sorted(updated), sorted(already), missing
 
     @classmethod
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
+    @db_call()
     def all(cls):
         """Returns all of the Items in the database"""
         app.logger.info("Processing all Items")
@@ -332,7 +1050,7 @@ class Item(db.Model):
 
 
     @classmethod
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
+    @db_call()
     def find(cls, item_id):
         """Finds a Item by it's ID
 
@@ -348,7 +1066,7 @@ class Item(db.Model):
 
 
     @classmethod
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
+    @db_call()
     def find_or_404(cls, item_id):
         """Find a Item by it's id
 
@@ -363,23 +1081,335 @@ class Item(db.Model):
         return cls.query.get_or_404(item_id)
 
     @classmethod
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
-    def find_by_wishlist_id(cls, wishlist_id):
-        """Returns all of the Wishlists in a wishlist_id
+    def wishlist_criteria(cls, wishlist_id, purchased=None, name=None):
+        """Builds the WHERE clause shared by the Wishlist listing and counting queries
+
+        :param purchased: only match Items that are (True) or are not (False) purchased
+        :type purchased: bool
+        :param name: only match Items whose name starts with this prefix
+        :type name: str
+
+        """
+        table = cls.__table__
+        criteria = [table.c.wishlist_id == wishlist_id]
+        if purchased is not None:
+            # NOT purchased lets PostgreSQL use ix_item_wishlist_id_unpurchased
+            criteria.append(table.c.purchased if purchased else db.not_(table.c.purchased))
+        if name:
+            criteria.append(table.c.name.startswith(name, autoescape=True))
+        return db.and_(*criteria)
+
+    @classmethod
+    def wishlist_order(cls, sort=None):
+        """Builds the ORDER BY for a Wishlist listing, ending with the id so pages are stable"""
+        table = cls.__table__
+        keys = parse_sort(sort, ITEM_SORT_COLUMNS)
+        order = [table.c[column].desc() if descending else table.c[column] for column, descending in keys]
+        if "id" not in [column for column, _ in keys]:
+            order.append(table.c.id)
+        return order
+
+
+    @classmethod
+    @db_call()
+    def find_rows_by_wishlist_id(cls, wishlist_id, purchased=None, name=None, sort=None, fields=None):
+        """Returns the columns of the Items on a Wishlist as plain rows
+
+        Filtering, ordering and the choice of columns all happen in the SELECT.
 
         :param wishlist_id: the wishlist_id of the Items you want to match
         :type wishlist_id: int
+        :param purchased: only return Items that are (True) or are not (False) purchased
+        :type purchased: bool
+        :param name: only return Items whose name starts with this prefix
+        :type name: str
+        :param sort: column names to order by, "-" prefixed for descending order
+        :type sort: list
+        :param fields: the columns to read, all of them if None
+        :type fields: list
+
+        :return: the rows of the Items on that Wishlist
+        :rtype: list
+
+        """
+        app.logger.info("Processing wishlist_id row query for %s ...", wishlist_id)
+        table = cls.__table__
+        columns = [table.c[field] for field in parse_fields(fields, ITEM_FIELDS)]
+        query = db.select(columns).where(cls.wishlist_criteria(wishlist_id, purchased, name))
+        return read_rows(query.order_by(*cls.wishlist_order(sort)))
+
+    @classmethod
+    @db_call()
+    def find_rows_by_wishlist_ids(cls, wishlist_ids):
+        """Returns the Items of many Wishlists as plain rows with a single IN query
+
+        :param wishlist_ids: the ids of the Wishlists whose Items you want
+        :type wishlist_ids: list
 
-        :return: a collection of Wishlists in that wishlist_id
+        :return: the rows of the Items ordered by id, keyed by wishlist_id;
+            Wishlists without Items are left out
+        :rtype: dict
+
+        """
+        app.logger.info("Processing row query for the Items of %s Wishlists ...", len(wishlist_ids))
+        items = {}
+        if not wishlist_ids:
+            return items
+        table = cls.__table__
+        query = db.select(table.columns).where(table.c.wishlist_id.in_(list(wishlist_ids)))
+        for row in read_rows(query.order_by(table.c.wishlist_id, table.c.id)):
+            items.setdefault(row.wishlist_id, []).append(row)
+        return items
+
+    @classmethod
+    @db_call()
+    def changed_rows(cls, wishlist_ids, since=None):
+        """Returns the Items on some Wishlists changed since a time, as plain rows
+
+        Pass the Wishlists returned by Wishlist.changed_rows(): every Item
+        write moves its Wishlist's updated_at too, so no other Wishlist
+        holds a changed Item.
+
+        :param wishlist_ids: the Wishlists whose Items to return
+        :type wishlist_ids: list
+        :param since: only return Items updated at or after this time, all when None
+        :type since: datetime
+
+        :return: the rows ordered by wishlist_id and id
         :rtype: list
 
         """
-        app.logger.info("Processing wishlist_id query for %s ...", wishlist_id)
-        return cls.query.filter(cls.wishlist_id == wishlist_id).all()
+        if not wishlist_ids:
+            return []
+        app.logger.info("Processing changed Items of %s Wishlists since %s ...", len(wishlist_ids), since)
+        table = cls.__table__
+        query = db.select(table.columns).where(table.c.wishlist_id.in_(wishlist_ids))
+        if since is not None:
+            query = query.where(table.c.updated_at >= since)
+        return read_rows(query.order_by(table.c.wishlist_id, table.c.id))
+
+    @classmethod
+    @db_call()
+    def count_by_wishlist_id(cls, wishlist_id, purchased=None, name=None):
+        """Counts the Items on a Wishlist with SELECT count(*), without reading them
+
+        :param wishlist_id: the wishlist_id of the Items you want to count
+        :type wishlist_id: int
+        :param purchased: only count Items that are (True) or are not (False) purchased
+        :type purchased: bool
+        :param name: only count Items whose name starts with this prefix
+        :type name: str
+
+        :return: the number of matching Items
+        :rtype: int
+
+        """
+        app.logger.info("Processing wishlist_id count for %s ...", wishlist_id)
+        query = db.select([db.func.count()]).select_from(cls.__table__)
+        return db.session.execute(query.where(cls.wishlist_criteria(wishlist_id, purchased, name))).scalar()
+
+    @classmethod
+    @db_call()
+    def has_more_than(cls, wishlist_id, count):
+        """Tells if a Wishlist has more than count Items, reading at most count + 1 index entries
+
+        :param wishlist_id: the id of the Wishlist
+        :type wishlist_id: int
+        :param count: the number of Items to compare with
+        :type count: int
+
+        :rtype: bool
+
+        """
+        table = cls.__table__
+        query = db.select([table.c.id]).where(table.c.wishlist_id == wishlist_id)
+        return db.session.execute(query.order_by(table.c.id).offset(count).limit(1)).first() is not None
+
+    @classmethod
+    @db_call()
+    def ids_on_wishlist(cls, wishlist_id, limit=None):
+        """Returns the ids of the Items on a Wishlist, from the index alone
+
+        :param wishlist_id: the id of the Wishlist
+        :type wishlist_id: int
+        :param limit: the most ids to return, None for all of them
+        :type limit: int
+
+        :rtype: list
+
+        """
+        table = cls.__table__
+        query = db.select([table.c.id]).where(table.c.wishlist_id == wishlist_id).order_by(table.c.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return [row[0] for row in db.session.execute(query)]
+
+    @classmethod
+    @db_call()
+    def delete_batch(cls, wishlist_id, batch_size=PURGE_BATCH_SIZE):
+        """Deletes up to batch_size Items of a Wishlist in one transaction
+
+        :param wishlist_id: the id of the Wishlist
+        :type wishlist_id: int
+        :param batch_size: the most Items to delete
+        :type batch_size: int
+
+        :return: the number of Items deleted
+        :rtype: int
+
+        """
+        table = cls.__table__
+        with unit_of_work() as work:
+            ids = cls.ids_on_wishlist(wishlist_id, limit=batch_size)
+            if ids:
+                Tombstone.record_items(wishlist_id, ids)
+                db.session.execute(table.delete().where(table.c.id.in_(ids)))
+                work.invalidate(*[item_key(wishlist_id, item_id) for item_id in ids])
+                work.invalidate(*Wishlist.touch(wishlist_id))
+        return len(ids)
 
     
+
     @classmethod
-    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT, logger=logger)
-    def get_by_wishlist_id_and_item_id(cls, wishlist_id, item_id):
-        app.logger.info("Processing wishlist_id/item_id query for %s/%s ...", wishlist_id, item_id)
-        return cls.query.filter_by(wishlist_id=wishlist_id, id=item_id).first()
+    @db_call()
+    def find_on_wishlist(cls, wishlist_id, item_id):
+        """Finds an Item and checks that its Wishlist exists in one query
+
+        The wishlist row is LEFT OUTER JOINed to the item so a missing
+        wishlist and a missing item can be told apart without a second
+        round trip to the database.
+
+        :param wishlist_id: the id of the Wishlist the Item is on
+        :type wishlist_id: int
+        :param item_id: the id of the Item to find
+        :type item_id: int
+
+        :return: whether the Wishlist exists, and the Item or None if not found
+        :rtype: tuple
+
+        """
+        app.logger.info("Processing wishlist/item lookup for %s/%s ...", wishlist_id, item_id)
+        data = cache.get(item_key(wishlist_id, item_id))
+        if data is not None:
+            # a cached item implies its wishlist exists
+            return True, from_cache(cls, data)
+        row = (
+            db.session.query(Wishlist.id, cls)
+            .outerjoin(cls, db.and_(cls.wishlist_id == Wishlist.id, cls.id == item_id))
+            .filter(Wishlist.id == wishlist_id)
+            .first()
+        )
+        if row is None:
+            return False, None
+        cache.set(item_key(wishlist_id, item_id), serialize_or_none(row[1]))
+        return True, row[1]
+
+
+class Tombstone(db.Model):
+    """
+    Class that represents a deleted Wishlist or Item
+
+    Delta syncs read them to learn what was deleted since their cursor.
+    They are kept for TOMBSTONE_TTL_DAYS, see prune().
+    """
+
+    __tablename__ = "tombstone"
+    __table_args__ = (
+        # serves the delta sync of a customer's deletes
+        db.Index("ix_tombstone_customer_id_deleted_at", "customer_id", "deleted_at"),
+    )
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(8), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    wishlist_id = db.Column(db.Integer, nullable=False)
+    customer_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+    def __repr__(self):
+        return "<Tombstone %s id=[%s]>" % (self.kind, self.object_id)
+
+    ##################################################
+    # CLASS METHODS
+    ##################################################
+
+    @classmethod
+    def record(cls, kind, object_ids, wishlist_id, customer_id):
+        """Inserts the tombstones of deleted objects in the caller's unit of work
+
+        :param kind: "wishlist" or "item"
+        :type kind: str
+        :param object_ids: the ids of the deleted objects
+        :type object_ids: list
+        :param wishlist_id: the Wishlist they were (or were on)
+        :type wishlist_id: int
+        :param customer_id: the customer they belonged to
+        :type customer_id: int
+
+        """
+        now = utcnow()
+        db.session.execute(cls.__table__.insert().values([
+            {"kind": kind, "object_id": object_id, "wishlist_id": wishlist_id,
+             "customer_id": customer_id, "deleted_at": now}
+            for object_id in object_ids
+        ]))
+
+    @classmethod
+    def record_items(cls, wishlist_id, item_ids):
+        """Inserts the tombstones of Items leaving a Wishlist, in the caller's unit of work
+
+        One INSERT ... SELECT reads the Wishlist's customer, so it must run
+        before the Items themselves are deleted.
+
+        :param wishlist_id: the Wishlist the Items are leaving
+        :type wishlist_id: int
+        :param item_ids: the ids of the Items
+        :type item_ids: list
+
+        """
+        table, wishlist, item = cls.__table__, Wishlist.__table__, Item.__table__
+        columns = ["kind", "object_id", "wishlist_id", "customer_id", "deleted_at"]
+        rows = db.select([
+            db.literal("item"), item.c.id, wishlist.c.id, wishlist.c.customer_id, db.literal(utcnow(), db.DateTime),
+        ]).where(db.and_(wishlist.c.id == wishlist_id, item.c.id.in_([int(item_id) for item_id in item_ids])))
+        db.session.execute(table.insert().from_select(columns, rows))
+
+    @classmethod
+    @db_call()
+    def since(cls, customer_id, since=None):
+        """Returns the tombstones of a customer's Wishlists and Items as plain rows
+
+        :param customer_id: the customer whose deletes to return
+        :type customer_id: int
+        :param since: only return deletes at or after this time, all retained ones when None
+        :type since: datetime
+
+        :rtype: list
+
+        """
+        app.logger.info("Processing tombstones of customer %s since %s ...", customer_id, since)
+        table = cls.__table__
+        query = db.select(table.columns).where(table.c.customer_id == customer_id)
+        if since is not None:
+            query = query.where(table.c.deleted_at >= since)
+        return read_rows(query.order_by(table.c.deleted_at, table.c.id))
+
+    @classmethod
+    @db_call()
+    def prune(cls, before):
+        """Deletes the tombstones older than a time
+
+        :param before: the oldest deletion time to keep
+        :type before: datetime
+
+        :return: the number of tombstones deleted
+        :rtype: int
+
+        """
+        app.logger.info("Pruning tombstones older than %s", before)
+        table = cls.__table__
+        with unit_of_work():
+            return db.session.execute(table.delete().where(table.c.deleted_at < before)).rowcount
@@ -0,0 +1,104 @@
+"""
+Module: pool
+
+Instrumented database connection pool
+
+InstrumentedQueuePool is a QueuePool that times every connection checkout,
+so the service can report how long requests wait for a connection on top
+of the usual checked-out and overflow gauges.
+"""
+import threading
+import time
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+# upper bounds (in milliseconds) of the checkout latency histogram buckets
+CHECKOUT_BUCKETS_MS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class PoolStats:
+    """Thread-safe checkout counters for one connection pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.buckets = [0] * (len(CHECKOUT_BUCKETS_MS) + 1)
+
+    def observe(self, seconds, timed_out=False):
+        """Records how long one checkout waited for a connection"""
+        millis = seconds * 1000
+        index = len(CHECKOUT_BUCKETS_MS)
+        for position, bound in enumerate(CHECKOUT_BUCKETS_MS):
+            if millis <= bound:
+                index = position
+                break
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += int(timed_out)
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            self.buckets[index] += 1
+
+    def snapshot(self):
+        """Returns the counters with a cumulative (Prometheus style) histogram"""
+        with self._lock:
+            buckets = list(self.buckets)
+            result = {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+            }
+        histogram, running = {}, 0
+        for bound, count in zip(CHECKOUT_BUCKETS_MS + ("+Inf",), buckets):
+            running += count
+            histogram[str(bound)] = running
+        result["checkout_latency_ms"] = histogram
+        return result
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that records the wait time of every checkout"""
+
+    def __init__(self, creator, **kw):
+        super().__init__(creator, **kw)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.observe(time.perf_counter() - start, timed_out=True)
+            raise
+        self.stats.observe(time.perf_counter() - start)
+        return conn
+
+
+def instrument(app):
+    """Swaps a configured QueuePool for the InstrumentedQueuePool
+
+    Must run before the engine is first created by Flask-SQLAlchemy.
+    """
+    options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    if options.get("poolclass") is QueuePool:
+        options["poolclass"] = InstrumentedQueuePool
+
+
+def pool_status(pool):
+    """Returns the live gauges and checkout counters of a connection pool"""
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "max_overflow": pool._max_overflow,
+        })
+    if isinstance(pool, InstrumentedQueuePool):
+        status.update(pool.stats.snapshot())
+    return status
@@ -0,0 +1,381 @@
+"""
+Module: profiler
+
+On-demand profiles of single requests
+
+A request is profiled when it carries a valid signed X-Profile header, or
+when it falls in the PROFILE_SAMPLE_RATE fraction of traffic. Its dispatch
+runs under cProfile while a sampler thread reads the request thread's stack
+every PROFILE_INTERVAL seconds. Each profile leaves three files in
+PROFILE_DIR:
+
+* <id>.pstats, the cProfile statistics, for pstats or snakeviz
+* <id>.collapsed, the sampled stacks folded one per line, for flamegraph.pl
+  or speedscope
+* <id>.json, the resource, method, path, status and duration of the request
+
+The header is "<expires>.<signature>", where expires is a Unix time and the
+signature its HMAC-SHA256 under PROFILE_SECRET; `flask profile-token` prints
+one. A process profiles one request at a time, requests arriving meanwhile
+are served without a profile. Only the newest PROFILE_KEEP profiles are
+kept.
+"""
+import cProfile
+import hashlib
+import hmac
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from functools import wraps
+from flask import abort, current_app, g, request
+from service import status
+from service.metrics import finish_requests, resource_name
+
+logger = logging.getLogger("flask.app")
+
+HEADER = "X-Profile"
+
+SORT_KEYS = {"own": 2, "cumulative": 3}
+
+
+def sign(secret, expires):
+    """Returns the signature of an expiry time"""
+    return hmac.new(secret.encode("utf-8"), str(int(expires)).encode("ascii"), hashlib.sha256).hexdigest()
+
+
+def profile_token(secret, ttl=300):
+    """Returns an X-Profile header value valid for ttl seconds
+
+    :param secret: the PROFILE_SECRET of the service
+    :type secret: str
+    :param ttl: the seconds the token stays valid
+    :type ttl: int
+
+    :return: the header value
+    :rtype: str
+
+    """
+    expires = int(time.time() + ttl)
+    return "{}.{}".format(expires, sign(secret, expires))
+
+
+def check_token(secret, token):
+    """Tells if a token was signed with secret and has not expired"""
+    if not secret or not token:
+        return False
+    expires, _, signature = token.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, sign(secret, expires))
+
+
+def function_name(code):
+    """Returns "file:function" for a code object, as flame graphs show it"""
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+class Sampler:
+    """A thread that counts the stacks of another thread"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)  # pylint: disable=protected-access
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                stack.append(function_name(frame.f_code))
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def collapsed(self):
+        """Returns the stacks in the folded format, one "a;b;c count" per line"""
+        return "".join("{} {}\n".format(stack, count) for stack, count in sorted(self.stacks.items()))
+
+
+class Profile:
+    """The profilers running around one request"""
+
+    def __init__(self, reason, interval):
+        self.id = "{}-{}".format(time.strftime("%Y%m%dT%H%M%S"), uuid.uuid4().hex[:8])
+        self.reason = reason
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.profile = cProfile.Profile()
+        self.sampler = Sampler(threading.get_ident(), interval)
+
+    def __enter__(self):
+        self.sampler.start()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.disable()
+        self.sampler.stop()
+        self.seconds = time.perf_counter() - self.start
+
+
+class RequestProfiler:
+    """Decides which requests to profile, profiles them and keeps the results"""
+
+    def __init__(self, directory, secret="", sample_rate=0.0, interval=0.001, keep=200):
+        self.directory = directory
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.keep = keep
+        self.profiled = 0
+        self.skipped = 0
+        self._lock = threading.Lock()  # held while a request is profiled
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and (bool(self.secret) or self.sample_rate > 0)
+
+    def reason(self, headers):
+        """Returns why a request should be profiled, None when it should not"""
+        if not self.enabled:
+            return None
+        if HEADER in headers:
+            return "header" if check_token(self.secret, headers[HEADER]) else None
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sample"
+        return None
+
+    def start(self, reason):
+        """Starts profiling the calling thread, None when another request is being profiled"""
+        if not self._lock.acquire(blocking=False):
+            self.skipped += 1
+            return None
+        profile = Profile(reason, self.interval)
+        try:
+            return profile.__enter__()
+        except Exception:
+            self._lock.release()
+            raise
+
+    def stop(self, profile, details):
+        """Stops a profile and writes its files
+
+        :param profile: the Profile returned by start()
+        :type profile: Profile
+        :param details: what to record about the request (resource, method, path, status)
+        :type details: dict
+
+        :return: the metadata written to <id>.json
+        :rtype: dict
+
+        """
+        try:
+            profile.__exit__(None, None, None)
+        finally:
+            self._lock.release()
+        meta = dict(
+            details,
+            id=profile.id,
+            reason=profile.reason,
+            started=profile.started,
+            duration_ms=round(profile.seconds * 1000, 3),
+            samples=profile.sampler.samples,
+        )
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profile.profile.dump_stats(self.path(profile.id, "pstats"))
+            with open(self.path(profile.id, "collapsed"), "w") as stream:
+                stream.write(profile.sampler.collapsed())
+            with open(self.path(profile.id, "json"), "w") as stream:
+                json.dump(meta, stream)
+            self.profiled += 1
+            self.prune()
+        except OSError:
+            logger.exception("Could not write profile %s", profile.id)
+        return meta
+
+    ##################################################
+    # Stored profiles
+    ##################################################
+
+    def path(self, profile_id, extension):
+        """Returns the file of a profile"""
+        return os.path.join(self.directory, "{}.{}".format(profile_id, extension))
+
+    def profiles(self, resource=None):
+        """Returns the metadata of the stored profiles, newest first
+
+        :param resource: only the profiles of "Resource.method", e.g. "WishlistCollection.get"
+        :type resource: str
+
+        """
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as stream:
+                    meta = json.load(stream)
+            except (OSError, ValueError):
+                continue  # pruned meanwhile, or still being written
+            if resource is None or meta.get("resource") == resource:
+                found.append(meta)
+        found.sort(key=lambda meta: meta["started"], reverse=True)
+        return found
+
+    def prune(self):
+        """Deletes the oldest profiles beyond PROFILE_KEEP"""
+        for meta in self.profiles()[self.keep:]:
+            for extension in ("json", "pstats", "collapsed"):
+                try:
+                    os.remove(self.path(meta["id"], extension))
+                except OSError:
+                    pass
+
+    def hot_functions(self, resource=None, top=20, sort="cumulative"):
+        """Merges the stored profiles and returns their hottest functions
+
+        :param resource: only the profiles of "Resource.method", all when None
+        :type resource: str
+        :param top: the number of functions to return
+        :type top: int
+        :param sort: "cumulative" for the time spent in a function and its
+            callees, "own" for the time spent in the function itself
+        :type sort: str
+
+        :return: the number of profiles merged and the functions, hottest first
+        :rtype: dict
+
+        """
+        merged = None
+        profiles = self.profiles(resource)
+        for meta in profiles:
+            try:
+                if merged is None:
+                    merged = pstats.Stats(self.path(meta["id"], "pstats"))
+                else:
+                    merged.add(self.path(meta["id"], "pstats"))
+            except (OSError, TypeError, EOFError):
+                continue
+        functions = []
+        if merged is not None:
+            index = SORT_KEYS[sort]
+            ranked = sorted(merged.stats.items(), key=lambda entry: entry[1][index], reverse=True)
+            for (filename, line, name), (_, calls, own, cumulative, _) in ranked[:top]:
+                functions.append({
+                    "function": name,
+                    "file": filename,
+                    "line": line,
+                    "calls": calls,
+                    "own_ms": round(own * 1000, 3),
+                    "cumulative_ms": round(cumulative * 1000, 3),
+                })
+        return {"resource": resource, "profiles": len(profiles), "sort": sort, "functions": functions}
+
+    def stats(self):
+        """Returns the requests profiled and skipped by this process"""
+        return {"enabled": self.enabled, "profiled": self.profiled, "skipped": self.skipped}
+
+
+def profile_label(app):
+    """Returns "Resource.method" for the request, e.g. "WishlistCollection.get" """
+    return "{}.{}".format(resource_name(app), request.method.lower())
+
+
+def init_profiler(app):
+    """Profiles the requests of a Flask app that ask for it or are sampled
+
+    Call it after the other request hooks are registered, so the profile
+    covers as little besides the dispatch of the request as possible.
+
+    :param app: the Flask app to profile
+    :type app: Flask
+
+    :return: the profiler, also kept in app.extensions["profiler"]
+    :rtype: RequestProfiler
+
+    """
+    profiler = RequestProfiler(
+        directory=app.config.get("PROFILE_DIR", ""),
+        secret=app.config.get("PROFILE_SECRET", ""),
+        sample_rate=app.config.get("PROFILE_SAMPLE_RATE", 0.0),
+        interval=app.config.get("PROFILE_INTERVAL", 0.001),
+        keep=app.config.get("PROFILE_KEEP", 200),
+    )
+
+    @app.before_request
+    def start_profile():
+        if getattr(app.view_functions.get(request.endpoint), "profile_admin", False):
+            return  # the listing would otherwise fill up with itself
+        reason = profiler.reason(request.headers)
+        if reason is not None:
+            g.profile = profiler.start(reason)
+
+    def stop_profile(profile, response):
+        details = {
+            "resource": profile_label(app),
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "status": response.status_code if response is not None else 500,
+        }
+        if response is None:
+            profiler.stop(profile, details)
+            return
+        response.headers[HEADER + "-Id"] = profile.id
+        if response.is_streamed:
+            # the list endpoints query while their body is sent, so keep profiling until it is
+            response.call_on_close(lambda: profiler.stop(profile, details))
+        else:
+            profiler.stop(profile, details)
+
+    finish_requests(app, "profile", stop_profile)
+
+    @app.cli.command("profile-token")
+    def profile_token_command():
+        """Prints an X-Profile header value valid for five minutes"""
+        if not profiler.secret:
+            raise SystemExit("PROFILE_SECRET is not set")
+        print(profile_token(profiler.secret))
+
+    app.extensions["profiler"] = profiler
+    return profiler
+
+
+def admin_required(function):
+    """Lets a request through only with a valid X-Profile header
+
+    Without a PROFILE_SECRET no header is valid, so the profiles of a
+    sampling-only setup are read from PROFILE_DIR rather than over HTTP.
+    """
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        profiler = current_app.extensions["profiler"]
+        if not check_token(profiler.secret, request.headers.get(HEADER)):
+            abort(status.HTTP_403_FORBIDDEN, "A valid {} header is required.".format(HEADER))
+        return function(*args, **kwargs)
+
+    wrapper.profile_admin = True
+    return wrapper
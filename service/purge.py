@@ -0,0 +1,104 @@
+"""
+Module: purge
+
+Background deletion of very large Wishlists
+
+Deleting a Wishlist lets the database cascade the delete to its Items,
+which for tens of thousands of Items holds the request (and row locks)
+for as long as that takes. Wishlists with more than PURGE_THRESHOLD Items
+are instead handed to a Purger: the DELETE request returns 202 Accepted
+at once, and a background thread deletes the Items PURGE_BATCH_SIZE at a
+time, each batch in its own transaction, then the Wishlist itself.
+
+The queue lives in the worker that accepted the request. If that worker
+dies mid purge, the Wishlist is still there with fewer Items, and
+repeating the DELETE finishes the job.
+"""
+import logging
+import queue
+import threading
+from service.models import Wishlist, PURGE_BATCH_SIZE
+from service.threads import BackgroundThread
+
+logger = logging.getLogger("flask.app")
+
+
+class Purger:
+    """A queue of Wishlist ids and the thread that purges them"""
+
+    def __init__(self, app, batch_size=PURGE_BATCH_SIZE):
+        self.app = app
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.purged = 0
+        self.failed = 0
+        self.thread = BackgroundThread(self.run, "wishlist-purge")
+        self._lock = threading.Lock()
+
+    def submit(self, wishlist_id):
+        """Queues a Wishlist for deletion
+
+        :param wishlist_id: the id of the Wishlist to delete
+        :type wishlist_id: int
+
+        :return: False if the Wishlist was already queued
+        :rtype: bool
+
+        """
+        wishlist_id = int(wishlist_id)
+        with self._lock:
+            if wishlist_id in self.pending:
+                return False
+            self.pending.add(wishlist_id)
+        self.thread.start()
+        self.queue.put(wishlist_id)
+        return True
+
+    def run(self):
+        """Purges queued Wishlists until the process exits"""
+        while True:
+            wishlist_id = self.queue.get()
+            try:
+                self.purge(wishlist_id)
+            finally:
+                with self._lock:
+                    self.pending.discard(wishlist_id)
+                self.queue.task_done()
+
+    def purge(self, wishlist_id):
+        """Deletes one Wishlist in batches, logging instead of raising errors"""
+        with self.app.app_context():
+            try:
+                Wishlist.purge(wishlist_id, self.batch_size)
+            except Exception:  # pylint: disable=broad-except
+                self.failed += 1
+                logger.exception("Purge of Wishlist %s failed", wishlist_id)
+            else:
+                self.purged += 1
+
+    def join(self):
+        """Waits until every queued Wishlist has been purged"""
+        self.queue.join()
+
+    def stats(self):
+        """Returns the Wishlists queued, purged and failed"""
+        return {"pending": len(self.pending), "purged": self.purged, "failed": self.failed}
+
+
+def init_purger(app):
+    """Purges the large Wishlists of a Flask app in the background
+
+    The thread starts with the first Wishlist submitted, so each gunicorn
+    worker purges from its own process.
+
+    :param app: the Flask app whose database to purge
+    :type app: Flask
+
+    :return: the purger, also kept in app.extensions["purger"]
+    :rtype: Purger
+
+    """
+    purger = Purger(app)
+    app.extensions["purger"] = purger
+    return purger
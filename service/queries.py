@@ -0,0 +1,198 @@
+"""
+Module: queries
+
+SQL statement counts, timings and a slow query log
+
+Engine events time every statement. While a request is being served the
+statements it runs are counted and their time added up, and the response
+carries both in a Server-Timing header that browsers' dev tools and most
+APM agents display:
+
+    Server-Timing: db;dur=3.2;desc="4 queries", app;dur=7.9
+
+Statements slower than SLOW_QUERY_MS are logged with their parameters.
+With SLOW_QUERY_EXPLAIN set, a slow SELECT is run again under EXPLAIN
+ANALYZE (EXPLAIN QUERY PLAN on SQLite) and the plan is logged with it.
+Only SELECTs outside of a transaction are explained, as EXPLAIN ANALYZE
+executes the statement a second time.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from flask import g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("flask.app")
+
+
+class QueryStats:
+    """The statements run while serving one request"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def server_timing(self, total_seconds=None):
+        """Returns the value of a Server-Timing header"""
+        timing = 'db;dur={:.1f};desc="{} {}"'.format(
+            self.seconds * 1000, self.count, "query" if self.count == 1 else "queries"
+        )
+        if total_seconds is not None:
+            timing += ", app;dur={:.1f}".format(total_seconds * 1000)
+        return timing
+
+
+class QueryMonitor:
+    """Engine event listeners that time statements and log the slow ones"""
+
+    def __init__(self, slow_ms=500, explain=False):
+        self.slow_ms = slow_ms
+        self.explain = explain
+        self.slow = 0
+        self._local = threading.local()
+        self._key = "query_start_{}".format(id(self))  # several monitors may time one connection
+
+    @property
+    def stats(self):
+        """The QueryStats of the request the calling thread serves, or None"""
+        return getattr(self._local, "stats", None)
+
+    def start(self):
+        """Starts counting the statements of the calling thread"""
+        self._local.stats = QueryStats()
+        return self._local.stats
+
+    def stop(self):
+        """Stops counting and returns what was counted"""
+        stats = self.stats
+        self._local.stats = None
+        return stats
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault(self._key, []).append(time.perf_counter())
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get(self._key)
+        if not starts:
+            return
+        seconds = time.perf_counter() - starts.pop()
+        stats = self.stats
+        if stats is not None:
+            stats.count += 1
+            stats.seconds += seconds
+        if self.slow_ms is not None and seconds * 1000 >= self.slow_ms:
+            self.slow += 1
+            self.log_slow(conn, cursor, statement, parameters, executemany, seconds)
+
+    def handle_error(self, context):
+        # after_cursor_execute does not run for a failed statement
+        if context.connection is not None and context.connection.info.get(self._key):
+            context.connection.info[self._key].pop()
+
+    def listen(self, target):
+        """Listens to the statements of an engine, or of every engine with the Engine class"""
+        event.listen(target, "before_cursor_execute", self.before_execute)
+        event.listen(target, "after_cursor_execute", self.after_execute)
+        event.listen(target, "handle_error", self.handle_error)
+
+    def log_slow(self, conn, cursor, statement, parameters, executemany, seconds):
+        """Logs a slow statement, with its plan when asked to"""
+        plan = None
+        if self.explain and not executemany and statement.lstrip()[:6].upper() == "SELECT":
+            plan = explain(conn, statement, parameters)
+        logger.warning(
+            "Slow query (%.1f ms): %s", seconds * 1000, statement,
+            extra={"duration_ms": round(seconds * 1000, 1), "parameters": parameters, "plan": plan},
+        )
+
+
+def in_transaction(dbapi_connection):
+    """Tells if a DBAPI connection is inside a transaction block"""
+    if hasattr(dbapi_connection, "in_transaction"):  # sqlite3
+        return dbapi_connection.in_transaction
+    if hasattr(dbapi_connection, "get_transaction_status"):  # psycopg2, 0 is idle
+        return dbapi_connection.get_transaction_status() != 0
+    return True  # unknown drivers are never explained
+
+
+def explain(conn, statement, parameters):
+    """Returns the plan of a statement, None when it cannot be explained safely
+
+    The cursor is used directly so the EXPLAIN is not timed or logged itself.
+    """
+    dbapi_connection = conn.connection.connection
+    if in_transaction(dbapi_connection):
+        return None  # a failing EXPLAIN would abort the caller's transaction
+    prefix = "EXPLAIN ANALYZE " if conn.dialect.name == "postgresql" else "EXPLAIN QUERY PLAN "
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
+    except Exception as error:  # pylint: disable=broad-except
+        return "EXPLAIN failed: {}".format(error)
+    finally:
+        cursor.close()
+
+
+@contextmanager
+def capture_queries(engine):
+    """Collects the statements an engine runs inside the block
+
+    :param engine: the engine to listen to
+    :type engine: Engine
+
+    :return: the statements, filled in as they run
+    :rtype: list
+
+    """
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+
+def instrument_queries(app):
+    """Times the statements of every engine and reports them per request
+
+    Runs once per app, the listeners are installed on the Engine class
+    because Flask-SQLAlchemy only creates its engine on first use.
+
+    :param app: the Flask app whose requests are reported
+    :type app: Flask
+
+    :return: the QueryMonitor, also kept in app.extensions["queries"]
+    :rtype: QueryMonitor
+
+    """
+    if "queries" in app.extensions:
+        return app.extensions["queries"]
+    slow_ms = app.config.get("SLOW_QUERY_MS", 500)
+    monitor = QueryMonitor(
+        slow_ms=slow_ms if slow_ms >= 0 else None,
+        explain=app.config.get("SLOW_QUERY_EXPLAIN", False),
+    )
+    monitor.listen(Engine)
+
+    @app.before_request
+    def count_queries():
+        monitor.start()
+        g.queries_started = time.perf_counter()
+
+    @app.after_request
+    def add_server_timing(response):
+        stats = monitor.stop()
+        if stats is not None and app.config.get("SERVER_TIMING", True):
+            total = time.perf_counter() - g.pop("queries_started", time.perf_counter())
+            response.headers.add("Server-Timing", stats.server_timing(total))
+        return response
+
+    app.extensions["queries"] = monitor
+    return monitor
@@ -0,0 +1,207 @@
+"""
+Module: resilience
+
+Retry policy and circuit breaker for database calls
+
+Only transient database errors (lost connections, server shutting down,
+too many connections, serialization failures) are retried, with capped
+exponential backoff, full jitter and a total time budget. Every call also
+goes through a CircuitBreaker: after `failure_threshold` calls in a row
+fail with a transient error the circuit opens and further calls fail fast,
+until `reset_timeout` seconds later a single trial call is let through.
+A guarded call made from inside another one runs as part of the outer
+call, which owns the breaker slot, the retries and the error handling.
+"""
+import logging
+import random
+import threading
+import time
+from functools import wraps
+from sqlalchemy import exc
+
+# SQLSTATE classes worth retrying: connection exception, transaction
+# rollback, insufficient resources and operator intervention
+TRANSIENT_SQLSTATE_CLASSES = ("08", "40", "53", "57")
+
+logger = logging.getLogger("flask.app")
+
+# how many guarded calls the current thread is inside of
+_guard = threading.local()
+
+
+def is_transient(error):
+    """Returns True if a database error may succeed when tried again"""
+    if isinstance(error, exc.DisconnectionError):
+        return True
+    if not isinstance(error, exc.DBAPIError):
+        return False
+    if error.connection_invalidated:
+        return True
+    if not isinstance(error, (exc.OperationalError, exc.InterfaceError)):
+        return False
+    orig = error.orig
+    if type(orig).__module__.startswith("sqlite3"):
+        return "database is locked" in str(orig)
+    code = getattr(orig, "pgcode", None)
+    return code is None or code[:2] in TRANSIENT_SQLSTATE_CLASSES
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit is open"""
+
+
+class CircuitBreaker:
+    """Fails fast while the database keeps failing"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self.rejected = 0
+        self.opened = 0
+
+    @property
+    def state(self):
+        """The current state: closed, open or half_open"""
+        with self._lock:
+            if self._state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        """Raises CircuitOpenError unless the call may go ahead"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if self._state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True  # let a single trial call through
+                return
+            self.rejected += 1
+            retry_in = max(0.0, self.reset_timeout - (self.clock() - self._opened_at))
+        raise CircuitOpenError("Database circuit is open, retry in {:.0f}s".format(retry_in))
+
+    def record_success(self):
+        """Closes the circuit after a successful call"""
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        """Counts a failed call and opens the circuit past the threshold"""
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.opened += 1
+                self._state = self.OPEN
+                self._opened_at = self.clock()
+
+    def release(self):
+        """Ends a trial call that failed for a reason other than the database"""
+        with self._lock:
+            self._trial_running = False
+
+    def stats(self):
+        """Returns the breaker state and counters"""
+        state = self.state
+        with self._lock:
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout,
+                "times_opened": self.opened,
+                "rejected_calls": self.rejected,
+            }
+
+
+class RetryPolicy:
+    """Capped exponential backoff with full jitter and a total time budget"""
+
+    def __init__(self, tries=3, delay=0.1, backoff=2, max_delay=1.0, budget=5.0,
+                 sleep=time.sleep, clock=time.monotonic):
+        self.tries = tries
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.budget = budget
+        self.sleep = sleep
+        self.clock = clock
+
+    def call(self, func, *args, **kwargs):
+        """Calls func, retrying transient errors within the tries and budget"""
+        start = self.clock()
+        attempt = 1
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as error:
+                if not is_transient(error) or attempt >= self.tries:
+                    raise
+                pause = random.uniform(0, min(self.max_delay, self.delay * self.backoff ** (attempt - 1)))
+                if self.clock() - start + pause > self.budget:
+                    raise
+                logger.warning("%s, retrying in %.2fs (attempt %s)", error.__class__.__name__, pause, attempt)
+                self.sleep(pause)
+                attempt += 1
+
+
+def guarded(breaker, policy=None, on_error=None, error_class=CircuitOpenError, can_retry=None):
+    """Decorator that runs a database call through a breaker and retry policy
+
+    :param breaker: the CircuitBreaker shared by every database call
+    :param policy: the RetryPolicy, or None to never retry (e.g. non idempotent writes)
+    :param on_error: called after every failed attempt, i.e. to roll back the session
+    :param error_class: raised instead of transient errors and open circuits
+    :param can_retry: called before each call, returns False when the policy must not be used
+
+    """
+    def decorator(func):
+        def attempt(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                if on_error:
+                    on_error()
+                raise
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            depth = getattr(_guard, "depth", 0)
+            if depth:
+                return func(*args, **kwargs)
+            try:
+                breaker.before_call()
+            except CircuitOpenError as error:
+                raise error_class(str(error)) from error
+            _guard.depth = depth + 1
+            try:
+                if policy is None or (can_retry is not None and not can_retry()):
+                    result = attempt(*args, **kwargs)
+                else:
+                    result = policy.call(attempt, *args, **kwargs)
+            except Exception as error:
+                if not is_transient(error):
+                    breaker.release()
+                    raise
+                breaker.record_failure()
+                raise error_class("Database unavailable: {}".format(error.__class__.__name__)) from error
+            finally:
+                _guard.depth = depth
+            breaker.record_success()
+            return result
+        return wrapper
+    return decorator
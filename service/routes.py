@@ -5,15 +5,29 @@ Wishlists Service
 
 import uuid
 import os
+import json
+import hashlib
+from urllib.parse import urlencode
 from functools import wraps
-from flask import abort, jsonify, make_response, request, url_for, send_from_directory
+from flask import Response, abort, jsonify, make_response, request, url_for, send_from_directory, stream_with_context
 from flask_restx import Api, Resource, fields, reqparse, inputs
 from service import status  # HTTP Status Codes
-from service.models import Item, Wishlist, DataValidationError, DatabaseConnectionError
+from service.models import db, cache, breaker, Item, Wishlist, DataValidationError, DatabaseConnectionError
+from service.models import PAGE_SIZE, MAX_PAGE_SIZE, MAX_BATCH_SIZE, purchase_selector
+from service.models import ITEM_FIELDS, ITEM_SORT_COLUMNS, parse_fields, parse_sort
+from service.models import PURGE_THRESHOLD, unit_of_work
+from service.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from service.pool import pool_status
+from service.profiler import SORT_KEYS as PROFILE_SORT_KEYS, admin_required
+from service.search import search, KINDS as SEARCH_KINDS
+from service.sync import CursorExpired, changes, parse_cursor
+from service.models import serialize_item, serialize_wishlist
+from service.serializers import item_projection
 
 # Import Flask application
 from . import app, APP_NAME, VERSION
 from werkzeug.exceptions import NotFound
+from werkzeug.http import http_date, quote_etag
 
 ######################################################################
 # Main index route before we define the API
@@ -30,6 +44,82 @@ def service_public_file(name):
 def favicon():
     return send_from_directory('../app/public', 'favicon-32x32.png', mimetype='image/vnd.microsoft.icon')
 
+@app.route("/stats/pool", methods=["GET"])
+def database_pool_stats():
+    """Returns the live database connection pool statistics"""
+    return jsonify(pool_status(db.engine.pool)), status.HTTP_200_OK
+
+@app.route("/stats/cache", methods=["GET"])
+def model_cache_stats():
+    """Returns the model cache hit, miss and eviction counters"""
+    return jsonify(cache.stats()), status.HTTP_200_OK
+
+@app.route("/stats/logging", methods=["GET"])
+def logging_stats():
+    """Returns the depth of the log queue and the records it dropped"""
+    return jsonify(app.extensions["log_pipeline"].stats()), status.HTTP_200_OK
+
+@app.route("/stats/breaker", methods=["GET"])
+def database_breaker_stats():
+    """Returns the state of the database circuit breaker"""
+    return jsonify(breaker.stats()), status.HTTP_200_OK
+
+@app.route("/health/live", methods=["GET"])
+def liveness():
+    """Answers as long as the worker serves requests"""
+    return jsonify(app.extensions["health"].check.liveness()), status.HTTP_200_OK
+
+@app.route("/health/ready", methods=["GET"])
+def readiness():
+    """Answers 200 when the worker can serve requests, 503 otherwise, from cached checks only"""
+    health = app.extensions["health"]
+    health.check.wait(health.timeout)  # only waits for the first ping of a new worker
+    ready, report = health.check.readiness(pool_status(db.engine.pool), breaker.state)
+    return jsonify(report), status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Returns the request metrics of every worker in the Prometheus text format"""
+    return Response(app.extensions["metrics"].render(), status.HTTP_200_OK, content_type=METRICS_CONTENT_TYPE)
+
+@app.route("/stats/purge", methods=["GET"])
+def purge_stats():
+    """Returns the Wishlists waiting for and done with a background purge"""
+    return jsonify(app.extensions["purger"].stats()), status.HTTP_200_OK
+
+
+@app.route("/profiles", methods=["GET"])
+@admin_required
+def list_profiles():
+    """Returns the stored request profiles, newest first, optionally of one resource"""
+    profiler = app.extensions["profiler"]
+    return jsonify(profiler.profiles(request.args.get("resource"))), status.HTTP_200_OK
+
+@app.route("/profiles/hot", methods=["GET"])
+@admin_required
+def hot_functions():
+    """Returns the top functions of the stored profiles, e.g. ?resource=WishlistCollection.get&top=20"""
+    sort = request.args.get("sort", "cumulative")
+    if sort not in PROFILE_SORT_KEYS:
+        abort(status.HTTP_400_BAD_REQUEST, "sort must be one of {}".format(", ".join(PROFILE_SORT_KEYS)))
+    top = request.args.get("top", 20, type=int)
+    profiler = app.extensions["profiler"]
+    return jsonify(profiler.hot_functions(request.args.get("resource"), top, sort)), status.HTTP_200_OK
+
+@app.route("/profiles/<profile_id>.<any(pstats, collapsed):extension>", methods=["GET"])
+@admin_required
+def download_profile(profile_id, extension):
+    """Returns the pstats or collapsed stacks file of a profile"""
+    profiler = app.extensions["profiler"]
+    return send_from_directory(
+        profiler.directory, "{}.{}".format(profile_id, extension), mimetype="application/octet-stream"
+    )
+
+@app.route("/stats/profiler", methods=["GET"])
+def profiler_stats():
+    """Returns the requests profiled and skipped by this worker"""
+    return jsonify(app.extensions["profiler"].stats()), status.HTTP_200_OK
+
 
 # configure swagger
 api = Api(app,
@@ -82,6 +172,15 @@ wishlist_model = api.inherit(
             readOnly=True,
             description='The unique id assigned internally by service'
         ),
+        'version': fields.Integer(
+            readOnly=True,
+            description='Bumped whenever the Wishlist or one of its Items changes'
+        ),
+        'updated_at': fields.DateTime(
+            readOnly=True,
+            dt_format='iso8601',
+            description='When the Wishlist or one of its Items last changed (UTC)'
+        ),
     }
 )
 
@@ -96,9 +195,206 @@ item_model = api.inherit(
     }
 )
 
+wishlist_items_model = api.inherit(
+    'WishlistWithItems',
+    wishlist_model,
+    {
+        'items': fields.List(
+            fields.Nested(item_model),
+            description='The Items on the Wishlist, with expand=items'
+        ),
+    }
+)
+
+item_batch_result_model = api.model(
+    'ItemBatchResult',
+    {
+        'index': fields.Integer(
+            description='The position of the Item in the posted batch'
+        ),
+        'status': fields.Integer(
+            description='201 if the Item was created, 400 if it was not valid'
+        ),
+        'id': fields.Integer(
+            description='The id assigned to the created Item'
+        ),
+        'message': fields.String(
+            description='Why the Item was not valid'
+        ),
+    }
+)
+
+item_batch_model = api.model(
+    'ItemBatch',
+    {
+        'wishlist_id': fields.Integer(
+            description='The wishlist ID'
+        ),
+        'created': fields.List(
+            fields.Integer,
+            description='The ids of the created Items, in posted order'
+        ),
+        'results': fields.List(
+            fields.Nested(item_batch_result_model),
+            description='The outcome for every posted Item'
+        ),
+    }
+)
+
+item_purchase_request_model = api.model(
+    'ItemPurchaseRequest',
+    {
+        'ids': fields.List(
+            fields.Integer,
+            description='The ids of the Items to purchase'
+        ),
+        'all': fields.Boolean(
+            description='Purchase every unpurchased Item on the Wishlist instead'
+        ),
+    }
+)
+
+item_purchase_model = api.model(
+    'ItemPurchase',
+    {
+        'wishlist_id': fields.Integer(
+            description='The wishlist ID'
+        ),
+        'purchased': fields.List(
+            fields.Integer,
+            description='The ids of the Items purchased by this request'
+        ),
+        'already_purchased': fields.List(
+            fields.Integer,
+            description='The ids of the Items that were purchased before'
+        ),
+        'missing': fields.List(
+            fields.Integer,
+            description='The ids that are not Items on the Wishlist'
+        ),
+    }
+)
+
+search_result_model = api.model(
+    'SearchResult',
+    {
+        'type': fields.String(
+            description='"wishlist" or "item"'
+        ),
+        'id': fields.Integer(
+            description='The id of the Wishlist or Item'
+        ),
+        'name': fields.String(
+            description='The name that matched'
+        ),
+        'customer_id': fields.Integer(
+            description='The customer the Wishlist (or the Item\'s Wishlist) belongs to'
+        ),
+        'wishlist_id': fields.Integer(
+            description='The Wishlist of a matching Item'
+        ),
+        'score': fields.Float(
+            description='Word similarity of the name to the query, from 0 to 1'
+        ),
+    }
+)
+
+sync_wishlist_model = api.inherit(
+    'SyncWishlist',
+    wishlist_model,
+    {
+        'created_at': fields.DateTime(
+            readOnly=True,
+            dt_format='iso8601',
+            description='When the Wishlist was created (UTC)'
+        ),
+    }
+)
+
+sync_item_model = api.inherit(
+    'SyncItem',
+    item_model,
+    {
+        'created_at': fields.DateTime(
+            readOnly=True,
+            dt_format='iso8601',
+            description='When the Item was created (UTC)'
+        ),
+        'updated_at': fields.DateTime(
+            readOnly=True,
+            dt_format='iso8601',
+            description='When the Item last changed (UTC)'
+        ),
+    }
+)
+
+sync_model = api.model(
+    'Sync',
+    {
+        'customer_id': fields.Integer(
+            description='The customer whose changes these are'
+        ),
+        'updated_since': fields.DateTime(
+            dt_format='iso8601',
+            description='The cursor the changes were asked for, null for everything'
+        ),
+        'cursor': fields.DateTime(
+            dt_format='iso8601',
+            description='Send as updated_since on the next sync, and as cursor for the next page of this one'
+        ),
+        'after': fields.Integer(
+            description='Send as after for the next page, null on the last page'
+        ),
+        'wishlists': fields.List(
+            fields.Nested(sync_wishlist_model),
+            description='The Wishlists created or changed since the cursor'
+        ),
+        'items': fields.List(
+            fields.Nested(sync_item_model),
+            description='The Items created or changed since the cursor'
+        ),
+        'deleted': fields.Raw(
+            description='The ids of the "wishlists" and "items" deleted since the cursor, to apply first'
+        ),
+    }
+)
+
+class NotModified(Exception):
+    """Raised when a conditional GET matches the current representation"""
+
+    def __init__(self, headers):
+        super().__init__("Not Modified")
+        self.headers = headers
+
 # query string arguments
-wishlist_args = reqparse.RequestParser()
+expand_args = reqparse.RequestParser()
+expand_args.add_argument('expand', type=str, location='args', choices=('items',), required=False, help='Nest the Items in every Wishlist')
+
+wishlist_args = expand_args.copy()
 wishlist_args.add_argument('customer_id', type=str, required=False, help='List Wishlists by Customer ID')
+wishlist_args.add_argument('limit', type=inputs.int_range(1, MAX_PAGE_SIZE), required=False, help='Maximum number of Wishlists in one page')
+wishlist_args.add_argument('after', type=int, required=False, help='Cursor: only list Wishlists with an id greater than this')
+
+search_args = reqparse.RequestParser()
+search_args.add_argument('q', type=str, location='args', required=True, help='The text to search Wishlist and Item names for')
+search_args.add_argument('type', type=str, choices=SEARCH_KINDS, location='args', required=False, help='Only search Wishlists or Items')
+search_args.add_argument('customer_id', type=int, location='args', required=False, help='Only search the Wishlists (and Items) of this customer')
+search_args.add_argument('limit', type=inputs.int_range(1, MAX_PAGE_SIZE), location='args', required=False, help='Maximum number of results in one page')
+search_args.add_argument('offset', type=inputs.natural, location='args', required=False, help='Number of ranked results to skip')
+
+sync_args = reqparse.RequestParser()
+sync_args.add_argument('customer_id', type=int, location='args', required=True, help='The customer whose Wishlists and Items to sync')
+sync_args.add_argument('updated_since', type=str, location='args', required=False, help='The cursor of the last sync (ISO 8601, UTC), omit for everything')
+sync_args.add_argument('limit', type=inputs.int_range(1, MAX_PAGE_SIZE), location='args', required=False, help='Maximum number of Wishlists in one page')
+sync_args.add_argument('after', type=int, location='args', required=False, help='The after of the previous page')
+sync_args.add_argument('cursor', type=str, location='args', required=False, help='The cursor of the first page, for the next pages')
+
+item_args = reqparse.RequestParser()
+item_args.add_argument('purchased', type=inputs.boolean, location='args', required=False, help='List only purchased (true) or unpurchased (false) Items')
+item_args.add_argument('name', type=str, location='args', required=False, help='List Items whose name starts with this prefix')
+item_args.add_argument('sort', type=str, location='args', required=False, help='Comma separated columns to sort by, prefixed with - for descending order')
+item_args.add_argument('fields', type=str, location='args', required=False, help='Comma separated columns to return')
+item_args.add_argument('count', type=inputs.boolean, location='args', required=False, help='Only return the number of matching Items')
 
 @api.errorhandler(DataValidationError)
 def request_validation_error(error):
@@ -111,6 +407,22 @@ def request_validation_error(error):
         'message': message
     }, status.HTTP_400_BAD_REQUEST
 
+@api.errorhandler(NotModified)
+def not_modified(error):
+    """ Answers conditional GETs when the client's copy is still current """
+    return {}, status.HTTP_304_NOT_MODIFIED, error.headers
+
+@api.errorhandler(CursorExpired)
+def cursor_expired(error):
+    """ Tells a syncing client its cursor is too old and it must start over """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_410_GONE,
+        'error': 'Gone',
+        'message': message
+    }, status.HTTP_410_GONE
+
 @api.errorhandler(DatabaseConnectionError)
 def database_connection_error(error):
     """ Handles Database Errors from connection attempts """
@@ -125,7 +437,7 @@ def database_connection_error(error):
 ######################################################################
 #  PATH: /wishlists/{id}
 ######################################################################
-@api.route('/wishlists/<wishlist_id>')
+@api.route('/wishlists/<int:wishlist_id>')
 @api.param('wishlist_id', 'The Wishlist identifier')
 class WishlistResource(Resource):
     """
@@ -141,25 +453,32 @@ class WishlistResource(Resource):
     # RETRIEVE A WISHLIST
     #------------------------------------------------------------------
     @api.doc('get_wishlists')
-    @api.response(200, 'Wishlist found')
+    @api.response(200, 'Wishlist found', wishlist_items_model)
+    @api.response(304, 'Wishlist not modified')
     @api.response(404, 'Wishlist not found')
-    @api.marshal_with(wishlist_model)
+    @api.expect(expand_args, validate=True)
     def get(self, wishlist_id):
         """
         Retrieve a single Wishlist
 
-        This endpoint will return a Wishlist based on its id
-        """
-
-        """
-        Retrieve a single Wishlist. This endpoint will return a Wishlist based on its id
+        This endpoint will return a Wishlist based on its id.
+        With `expand=items` its Items are nested in it, read with one more query.
         """
         app.logger.info("Request for wishlist with id: %s", wishlist_id)
+        expand = expand_args.parse_args()['expand']
         wishlist = Wishlist.find(wishlist_id)
         if not wishlist:
             abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
 
-        return wishlist.serialize(), status.HTTP_200_OK
+        if not expand:
+            headers = check_not_modified(wishlist, 'wishlist')
+            return api.marshal(wishlist.serialize(), wishlist_model), status.HTTP_200_OK, headers
+
+        headers = check_not_modified(wishlist, 'wishlist+items')
+        data = dict(wishlist.serialize(), items=[
+            serialize_item(item) for item in Item.find_rows_by_wishlist_id(wishlist.id)
+        ])
+        return api.marshal(data, wishlist_items_model), status.HTTP_200_OK, headers
 
     #------------------------------------------------------------------
     # UPDATE AN EXISTING WISHLIST
@@ -193,15 +512,21 @@ class WishlistResource(Resource):
     #------------------------------------------------------------------
     @api.doc('delete_wishlists')
     @api.response(204, 'Wishlist deleted')
+    @api.response(202, 'Wishlist queued for deletion')
     def delete(self, wishlist_id):
         """
         Delete a Wishlist
 
-        This endpoint will delete a Wishlist based the id specified in the path
+        This endpoint will delete a Wishlist based the id specified in the path.
+        A Wishlist with very many Items is deleted in the background instead (202).
         """
         app.logger.info("Request to delete wishlist with id: %s", wishlist_id)
         wishlist = Wishlist.find(wishlist_id)
         if wishlist:
+            if Item.has_more_than(wishlist.id, PURGE_THRESHOLD):
+                app.extensions["purger"].submit(wishlist.id)
+                app.logger.info('Wishlist with id [%s] was queued for deletion', wishlist_id)
+                return '', status.HTTP_202_ACCEPTED
             wishlist.delete()
             app.logger.info('Wishlist with id [%s] was deleted', wishlist_id)
 
@@ -218,27 +543,51 @@ class WishlistCollection(Resource):
     # LIST ALL WISHLISTS
     #------------------------------------------------------------------
     @api.doc('list_wishlists')
-    @api.response(200, 'Listing wishlists')
+    @api.response(200, 'Listing wishlists', [wishlist_model])
     @api.expect(wishlist_args, validate=True)
-    @api.marshal_list_with(wishlist_model)
     def get(self):
-        """ Returns all of the Wishlists """
+        """
+        Returns all of the Wishlists
+
+        Pass `limit` (and the `after` cursor from the previous page) to page through
+        the Wishlists by id. Without them the whole collection is streamed in chunks.
+        """
         app.logger.info('Request to list Wishlists...')
-        wishlists = []
         args = wishlist_args.parse_args()
-        if args['customer_id']:
-            customer_id = args['customer_id']
+        customer_id = args['customer_id'] or None
+        if customer_id:
             app.logger.info('Filtering by customer_id: %s', customer_id)
-            wishlists = Wishlist.find_by_customer_id(customer_id)
-        else:
-            app.logger.info('Returning unfiltered list.')
-            wishlists = Wishlist.all()
 
-        app.logger.info(wishlists)
-        #app.logger.info('[%s] Wishlists returned', len(wishlists))
-        results = [wishlist.serialize() for wishlist in wishlists]
-        app.logger.info(results)
-        return results, status.HTTP_200_OK
+        expand = args['expand']
+        if args['limit'] is None and args['after'] is None:
+            app.logger.info('Streaming unpaginated list.')
+            if expand:
+                pages = Wishlist.pages(customer_id=customer_id)
+                return stream_json_list(
+                    (record for page in pages for record in with_items(page)), serialize=None
+                )
+            return stream_json_list(Wishlist.iter_pages(customer_id=customer_id))
+
+        # fetch one extra row to find out whether there is a next page
+        limit = args['limit'] or PAGE_SIZE
+        wishlists = Wishlist.find_page_rows(after=args['after'], limit=limit + 1, customer_id=customer_id)
+        headers = {}
+        if len(wishlists) > limit:
+            wishlists = wishlists[:limit]
+            cursor = wishlists[-1].id
+            next_url = api.url_for(
+                WishlistCollection, after=cursor, limit=limit, customer_id=customer_id, expand=expand,
+                _external=True
+            )
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+            headers['X-Next-Cursor'] = str(cursor)
+
+        app.logger.info('[%s] Wishlists returned', len(wishlists))
+        if expand:
+            results = with_items(wishlists)
+        else:
+            results = [serialize_wishlist(wishlist) for wishlist in wishlists]
+        return json_response(results, status.HTTP_200_OK, headers)
 
     #------------------------------------------------------------------
     # ADD A NEW WISHLIST
@@ -275,8 +624,10 @@ class WishlistCollection(Resource):
         """
         app.logger.info('Request to Delete all wishlists...')
         if "TESTING" in app.config and app.config["TESTING"]:
-            Item.query.delete()
-            Wishlist.query.delete()
+            with unit_of_work():
+                Item.query.delete()
+                Wishlist.query.delete()
+            cache.clear()
             app.logger.info("Removed all Wishlists and Items from the database")
 
         return '', status.HTTP_204_NO_CONTENT
@@ -298,7 +649,7 @@ class WishlistCollection(Resource):
 ######################################################################
 #  PATH: /wishlists/{id}/items/{item_id}
 ######################################################################
-@api.route('/wishlists/<wishlist_id>/items/<item_id>')
+@api.route('/wishlists/<int:wishlist_id>/items/<int:item_id>')
 @api.param('wishlist_id', 'The Wishlist identifier')
 @api.param('item_id', 'The Item identifier')
 class ItemResource(Resource):
@@ -325,11 +676,10 @@ class ItemResource(Resource):
         This endpoint will return an Item based on its id
         """
         app.logger.info("Request for item with wishlist_id: %s and item_id: %s", wishlist_id, item_id)
-        wishlist = Wishlist.find(wishlist_id)
-        if not wishlist:
+        wishlist_found, item = Item.find_on_wishlist(wishlist_id, item_id)
+        if not wishlist_found:
             abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
 
-        item = Item.get_by_wishlist_id_and_item_id(wishlist_id, item_id)
         if not item:
             base = "Item with wishlist_id '{}' and item_id '{}' was not found."
             message = base.format(wishlist_id, item_id)
@@ -354,11 +704,10 @@ class ItemResource(Resource):
         """
         check_content_type("application/json")
         app.logger.info("Request to update an item with id: %s", item_id)
-        wishlist = Wishlist.find(wishlist_id)
-        if not wishlist:
+        wishlist_found, item = Item.find_on_wishlist(wishlist_id, item_id)
+        if not wishlist_found:
             abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
 
-        item = Item.get_by_wishlist_id_and_item_id(wishlist_id, item_id)
         if not item:
             base = "Item with wishlist_id '{}' and item_id '{}' was not found."
             message = base.format(wishlist_id, item_id)
@@ -382,11 +731,10 @@ class ItemResource(Resource):
         This endpoint will delete a Item based the id specified in the path
         """
         app.logger.info("Request to delete item with id: %s", item_id)
-        wishlist = Wishlist.find(wishlist_id)
-        if not wishlist:
+        wishlist_found, item = Item.find_on_wishlist(wishlist_id, item_id)
+        if not wishlist_found:
             abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
 
-        item = Item.get_by_wishlist_id_and_item_id(wishlist_id, item_id)
         if item:
             item.delete()
 
@@ -397,31 +745,68 @@ class ItemResource(Resource):
 ######################################################################
 #  PATH: /wishlists/{id}/items
 ######################################################################
-@api.route('/wishlists/<wishlist_id>/items', strict_slashes=False)
+@api.route('/wishlists/<int:wishlist_id>/items', strict_slashes=False)
 class ItemCollection(Resource):
     """ Handles all interactions with collections of Items """
     #------------------------------------------------------------------
     # LIST ALL ITEMS
     #------------------------------------------------------------------
     @api.doc('list_items')
-    @api.response(200, 'Listing all items')
+    @api.response(200, 'Listing all items', [item_model])
+    @api.response(304, 'Items not modified')
+    @api.response(400, 'Unknown sort or fields column')
     @api.response(404, 'Wishlist not found or Wishlist empty')
-    @api.marshal_list_with(item_model)
+    @api.expect(item_args, validate=True)
     def get(self, wishlist_id):
-        """ Returns all of the Items on a specific Wishlist """
+        """
+        Returns all of the Items on a specific Wishlist
+
+        Filter with `purchased` and a `name` prefix, order with `sort=-purchased,name`
+        and pick the columns with `fields=id,name`; all of it happens in the SELECT.
+        With `count=true` only the number of matching Items is returned.
+        """
         app.logger.info('Request to list Items on Wishlist with id %s...', wishlist_id)
+        query = read_item_query()
         wishlist = Wishlist.find(wishlist_id)
         if not wishlist:
             abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
 
-        items = []
-        items = Item.find_by_wishlist_id(wishlist_id)
-        if not items:
+        headers = check_not_modified(wishlist, query['representation'])
+        if query['count']:
+            count = Item.count_by_wishlist_id(wishlist.id, **query['filters'])
+            headers['X-Total-Count'] = str(count)
+            return json_response({'count': count}, status.HTTP_200_OK, headers)
+
+        items = Item.find_rows_by_wishlist_id(
+            wishlist.id, sort=query['sort'], fields=query['fields'], **query['filters']
+        )
+        if not items and not any(value is not None for value in query['filters'].values()):
             abort(status.HTTP_404_NOT_FOUND, "No items found on Wishlist with id '{}'.".format(wishlist_id))
 
         app.logger.info('[%s] Items returned', len(items))
-        results = [item.serialize() for item in items]
-        return results, status.HTTP_200_OK
+        serialize = item_projection(tuple(query['fields'])) if query['fields'] else serialize_item
+        results = [serialize(item) for item in items]
+        return json_response(results, status.HTTP_200_OK, headers)
+
+    #------------------------------------------------------------------
+    # COUNT ITEMS
+    #------------------------------------------------------------------
+    @api.doc('count_items')
+    @api.response(200, 'The number of matching items is in X-Total-Count')
+    @api.response(304, 'Items not modified')
+    @api.response(404, 'Wishlist not found')
+    @api.expect(item_args, validate=True)
+    def head(self, wishlist_id):
+        """ Counts the Items on a Wishlist with SELECT count(*), without reading them """
+        app.logger.info('Request to count Items on Wishlist with id %s...', wishlist_id)
+        query = read_item_query()
+        wishlist = Wishlist.find(wishlist_id)
+        if not wishlist:
+            abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+
+        headers = check_not_modified(wishlist, query['representation'] + '-count')
+        headers['X-Total-Count'] = str(Item.count_by_wishlist_id(wishlist.id, **query['filters']))
+        return app.response_class(status=status.HTTP_200_OK, headers=headers, mimetype='application/json')
 
     #------------------------------------------------------------------
     # ADD A NEW ITEM
@@ -452,10 +837,109 @@ class ItemCollection(Resource):
         return item.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
 
+######################################################################
+#  PATH: /wishlists/{id}/items:batch
+######################################################################
+@api.route('/wishlists/<int:wishlist_id>/items:batch')
+@api.param('wishlist_id', 'The Wishlist identifier')
+class ItemBatchCollection(Resource):
+    """ Creates many Items on a Wishlist in a single request """
+    @api.doc('create_items_batch')
+    @api.response(201, 'All items added', item_batch_model)
+    @api.response(207, 'Some items were not valid', item_batch_model)
+    @api.response(400, 'None of the posted items were valid')
+    @api.response(404, 'Wishlist not found')
+    @api.response(413, 'Too many items in one batch')
+    @api.expect([create_item_model])
+    def post(self, wishlist_id):
+        """
+        Creates many Items
+
+        This endpoint takes a JSON array (or an application/x-ndjson stream) of Items
+        and inserts every valid one in a single statement, reporting a result per row
+        """
+        check_content_type("application/json", "application/x-ndjson")
+        app.logger.info("Request to create a batch of items")
+        wishlist = Wishlist.find(wishlist_id)
+        if not wishlist:
+            abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+
+        rows = read_batch_payload(MAX_BATCH_SIZE + 1)
+        if len(rows) > MAX_BATCH_SIZE:
+            abort(
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                "At most {} items may be created at once.".format(MAX_BATCH_SIZE)
+            )
+
+        items, accepted, results = [], [], []
+        for index, data in enumerate(rows):
+            if isinstance(data, dict):
+                # items in the batch belong to the wishlist in the path
+                data = dict({"wishlist_id": wishlist.id}, **data)
+            result = {"index": index}
+            try:
+                items.append(Item().deserialize(data))
+                result["status"] = status.HTTP_201_CREATED
+                accepted.append(result)
+            except DataValidationError as error:
+                result["status"] = status.HTTP_400_BAD_REQUEST
+                result["message"] = str(error)
+            results.append(result)
+
+        if not items:
+            abort(status.HTTP_400_BAD_REQUEST, "No valid items were posted.")
+
+        ids = Item.create_many(wishlist.id, items)
+        for result, item_id in zip(accepted, ids):
+            result["id"] = item_id
+
+        app.logger.info("[%s] of [%s] Items created on Wishlist %s", len(ids), len(rows), wishlist.id)
+        code = status.HTTP_201_CREATED if len(ids) == len(rows) else status.HTTP_207_MULTI_STATUS
+        return {"wishlist_id": wishlist.id, "created": ids, "results": results}, code
+
+
+######################################################################
+#  PATH: /wishlists/{id}/items:purchase
+######################################################################
+@api.route('/wishlists/<int:wishlist_id>/items:purchase')
+@api.param('wishlist_id', 'The Wishlist identifier')
+class ItemPurchaseCollection(Resource):
+    """ Purchases many Items on a Wishlist in a single request """
+    @api.doc('purchase_items_bulk')
+    @api.response(200, 'Items purchased', item_purchase_model)
+    @api.response(400, 'The posted selector was not valid')
+    @api.response(404, 'Wishlist not found')
+    @api.expect(item_purchase_request_model)
+    def put(self, wishlist_id):
+        """
+        Purchases many Items
+
+        This endpoint takes {"ids": [...]} or {"all": true} and marks the Items as
+        purchased with a single UPDATE, reporting which ids were purchased now,
+        which already were and which are not on the Wishlist
+        """
+        check_content_type("application/json")
+        app.logger.info("Request to purchase a batch of items")
+        item_ids = purchase_selector(request.get_json())
+        wishlist = Wishlist.find(wishlist_id)
+        if not wishlist:
+            abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
+
+        purchased, already_purchased, missing = Item.purchase_many(wishlist.id, item_ids)
+
+        app.logger.info("[%s] Items purchased on Wishlist %s", len(purchased), wishlist.id)
+        return {
+            "wishlist_id": wishlist.id,
+            "purchased": purchased,
+            "already_purchased": already_purchased,
+            "missing": missing,
+        }, status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /wishlists/{wishlist_id}/items/{item_id}/purchase
 ######################################################################
-@api.route('/wishlists/<wishlist_id>/items/<item_id>/purchase')
+@api.route('/wishlists/<int:wishlist_id>/items/<int:item_id>/purchase')
 @api.param('wishlist_id', 'The Wishlist identifier')
 @api.param('item_id', 'The Item identifier')
 class PurchaseResource(Resource):
@@ -470,12 +954,11 @@ class PurchaseResource(Resource):
         """
         check_content_type("application/json")
         app.logger.info('Request to Purchase an Item')
-        wishlist = Wishlist.find(wishlist_id)
-        if not wishlist:
+        wishlist_found, item = Item.find_on_wishlist(wishlist_id, item_id)
+        if not wishlist_found:
             app.logger.info("WISHLIST NOT FOUND (wishlist_id: '{}')".format(wishlist_id))
             abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' was not found.".format(wishlist_id))
 
-        item = Item.get_by_wishlist_id_and_item_id(wishlist_id, item_id)
         if not item:
             app.logger.info("ITEM NOT FOUND (item_id: '{}')".format(item_id))
             base = "item with wishlist_id '{}' and item_id '{}' was not found."
@@ -489,6 +972,89 @@ class PurchaseResource(Resource):
         return item.serialize(), status.HTTP_200_OK
 
 
+######################################################################
+#  PATH: /search
+######################################################################
+@api.route('/search', strict_slashes=False)
+class SearchCollection(Resource):
+    """ Ranked prefix and fuzzy search over Wishlist and Item names """
+    @api.doc('search')
+    @api.response(200, 'Ranked search results', [search_result_model])
+    @api.response(400, 'Missing q or a bad parameter')
+    @api.expect(search_args, validate=True)
+    def get(self):
+        """
+        Searches Wishlist and Item names
+
+        Names starting with `q` rank first, then names sharing the most of its
+        trigrams, so typos still match. Page through the results with `limit`
+        and `offset`.
+        """
+        args = search_args.parse_args()
+        app.logger.info('Request to search for %s', args['q'])
+        limit = args['limit'] or PAGE_SIZE
+        offset = args['offset'] or 0
+        # fetch one extra result to find out whether there is a next page
+        results = search(args['q'], args['type'], args['customer_id'], limit + 1, offset)
+        headers = {}
+        if len(results) > limit:
+            results = results[:limit]
+            next_url = api.url_for(
+                SearchCollection, q=args['q'], type=args['type'], customer_id=args['customer_id'],
+                limit=limit, offset=offset + limit, _external=True
+            )
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+            headers['X-Next-Offset'] = str(offset + limit)
+
+        app.logger.info('[%s] search results returned', len(results))
+        return json_response(results, status.HTTP_200_OK, headers)
+
+
+######################################################################
+#  PATH: /sync
+######################################################################
+@api.route('/sync', strict_slashes=False)
+class SyncResource(Resource):
+    """ Delta sync of a customer's Wishlists and Items """
+    @api.doc('sync')
+    @api.response(200, 'The changes since the cursor', sync_model)
+    @api.response(400, 'Missing customer_id or a bad cursor')
+    @api.response(410, 'The cursor is older than the deletes that are kept')
+    @api.expect(sync_args, validate=True)
+    def get(self):
+        """
+        Returns what changed since the last sync
+
+        Returns the Wishlists and Items of `customer_id` created or changed
+        since `updated_since`, the ids of the ones deleted since then, and
+        the `cursor` to send as `updated_since` next time. Without
+        `updated_since` everything is returned. Apply the deletes first,
+        then upsert the rows.
+
+        The changes come in pages of up to `limit` Wishlists with their
+        Items. Follow the `Link: rel="next"` header until there is none.
+        """
+        args = sync_args.parse_args()
+        app.logger.info('Request to sync customer %s since %s', args['customer_id'], args['updated_since'])
+        limit = args['limit'] or PAGE_SIZE
+        result = changes(
+            args['customer_id'], parse_cursor(args['updated_since']),
+            after=args['after'], limit=limit, cursor=parse_cursor(args['cursor']),
+        )
+        headers = {}
+        if result['after'] is not None:
+            next_url = api.url_for(
+                SyncResource, customer_id=args['customer_id'], updated_since=args['updated_since'],
+                after=result['after'], limit=limit, cursor=result['cursor'], _external=True
+            )
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+            headers['X-Next-Cursor'] = str(result['after'])
+        app.logger.info(
+            '[%s] Wishlists, [%s] Items changed', len(result['wishlists']), len(result['items'])
+        )
+        return json_response(result, status.HTTP_200_OK, headers)
+
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
@@ -498,13 +1064,134 @@ def abort(error_code: int, message: str):
     app.logger.error(message)
     api.abort(error_code, message)
 
-def check_content_type(media_type):
-    """Checks that the media type is correct"""
+def check_not_modified(wishlist, representation):
+    """Returns the ETag and Last-Modified headers of a Wishlist representation
+
+    Raises NotModified instead when the client already has this version.
+    """
+    headers, not_modified = conditional_headers(
+        representation, wishlist.id, wishlist.version, wishlist.updated_at,
+        request.if_none_match, request.if_modified_since
+    )
+    if not_modified:
+        raise NotModified(headers)
+    return headers
+
+def conditional_headers(representation, wishlist_id, version, updated_at, if_none_match, if_modified_since):
+    """Computes the validators of a Wishlist representation for the WSGI and ASGI routes
+
+    Item changes bump the Wishlist version, so the ETag of a representation
+    with Items changes with them and no Item rows are read for a 304. An
+    If-None-Match header takes precedence over If-Modified-Since.
+
+    :param representation: names the representation, i.e. 'wishlist' or items_representation()
+    :type representation: str
+    :param if_none_match: the ETags of the request's If-None-Match header
+    :type if_none_match: werkzeug.datastructures.ETags
+    :param if_modified_since: the request's If-Modified-Since, or None
+    :type if_modified_since: datetime
+
+    :return: the ETag and Last-Modified headers, and whether the client has them already
+    :rtype: tuple
+
+    """
+    etag = "{}-{}-v{}".format(representation, wishlist_id, version)
+    headers = {'ETag': quote_etag(etag)}
+    if updated_at:
+        headers['Last-Modified'] = http_date(updated_at)
+
+    if if_none_match:
+        return headers, if_none_match.contains_weak(etag)
+    if if_modified_since and updated_at:
+        return headers, updated_at.replace(microsecond=0) <= if_modified_since
+    return headers, False
+
+def read_item_query():
+    """Reads and checks the filtering, sorting and projection arguments of an Item listing
+
+    The listing's ETag names the representation, so filtered listings get
+    their own ETags while still changing whenever the Wishlist version does.
+    """
+    args = item_args.parse_args()
+    sort = (args['sort'] or '').split(',')
+    fields = (args['fields'] or '').split(',')
+    parse_sort(sort, ITEM_SORT_COLUMNS)
+    query = {
+        'filters': {'purchased': args['purchased'], 'name': args['name'] or None},
+        'sort': sort,
+        'fields': parse_fields(fields, ITEM_FIELDS) if args['fields'] else None,
+        'count': bool(args['count']),
+    }
+    query['representation'] = items_representation(
+        [(key, args[key]) for key in ('purchased', 'name', 'sort', 'fields', 'count')]
+    )
+    return query
+
+def items_representation(params):
+    """Names a filtered Item listing for its ETag, so every filter gets its own"""
+    params = [(key, value) for key, value in params if value not in (None, '')]
+    if not params:
+        return 'items'
+    return 'items.' + hashlib.sha1(urlencode(params).encode('utf-8')).hexdigest()[:16]
+
+def with_items(wishlists):
+    """Serializes a page of Wishlists with their Items nested, read with one IN query"""
+    items = Item.find_rows_by_wishlist_ids([wishlist.id for wishlist in wishlists])
+    return [
+        dict(serialize_wishlist(wishlist), items=[serialize_item(item) for item in items.get(wishlist.id, ())])
+        for wishlist in wishlists
+    ]
+
+def json_encoder():
+    """Returns the JSON_BACKEND encoder create_app() picked, which returns bytes"""
+    return app.extensions["json_backend"][1]
+
+def json_response(data, code=status.HTTP_200_OK, headers=None):
+    """Encodes data with the fast JSON backend, without marshalling it"""
+    return app.response_class(json_encoder()(data), status=code, headers=headers, mimetype='application/json')
+
+def stream_json_list(records, serialize=serialize_wishlist):
+    """Streams the serialized Wishlists as a chunked JSON array
+
+    Pass serialize=None when the records already are dictionaries.
+    """
+    def generate():
+        dumps = json_encoder()
+        yield b'['
+        for count, record in enumerate(records):
+            data = record if serialize is None else serialize(record)
+            yield (b',' if count else b'') + dumps(data)
+        yield b']'
+
+    return app.response_class(stream_with_context(generate()), mimetype='application/json')
+
+def read_batch_payload(max_rows):
+    """Reads a JSON array or an NDJSON stream of records from the request body"""
+    if request.mimetype == "application/x-ndjson":
+        rows = []
+        for line in request.stream:
+            if len(rows) >= max_rows:
+                break
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                rows.append(None)  # reported as a bad row by deserialize()
+        return rows
+
+    payload = request.get_json()
+    if not isinstance(payload, list):
+        raise DataValidationError("Invalid batch: body of request must be a JSON array")
+    return payload[:max_rows]
+
+def check_content_type(*media_types):
+    """Checks that the media type is one of the accepted ones"""
     content_type = request.headers.get("Content-Type")
-    if content_type and content_type == media_type:
+    if content_type and content_type in media_types:
         return
     app.logger.error("Invalid Content-Type: %s", content_type)
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-        "Content-Type must be {}".format(media_type),
+        "Content-Type must be {}".format(" or ".join(media_types)),
     )
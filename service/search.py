@@ -0,0 +1,238 @@
+"""
+Module: search
+
+Ranked prefix and fuzzy search over Wishlist and Item names
+
+On PostgreSQL the names are matched with pg_trgm: a prefix ILIKE and the
+word similarity operator (<%) are both served by the GIN trigram indexes
+declared on the models, so a search only reads the matching rows.
+Results rank prefix matches first, then by word similarity, then by id.
+
+Other databases (SQLite in tests and local runs) have no trigram indexes,
+so a TrigramIndex with the same scoring is kept in memory instead. It is
+rebuilt from the tables on the first search after a write.
+
+SEARCH_THRESHOLD is the word similarity a fuzzy match needs (0 to 1).
+"""
+import os
+import re
+import threading
+import weakref
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+from service.models import db, db_call, read_rows, Wishlist, Item
+
+# word similarity a fuzzy match needs, also set as pg_trgm.word_similarity_threshold
+SEARCH_THRESHOLD = float(os.environ.get("SEARCH_THRESHOLD", 0.5))
+
+KINDS = ("wishlist", "item")
+
+WORD = re.compile(r"[^\W_]+")
+
+
+def trigrams(text):
+    """Returns the trigrams of every word in text, padded the way pg_trgm pads them"""
+    grams = set()
+    for word in WORD.findall(text.lower()):
+        padded = "  {} ".format(word)
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def escape_like(text):
+    """Escapes the LIKE wildcards in text, using backslash as the escape character"""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class TrigramIndex:
+    """An inverted index from trigrams to the names containing them"""
+
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+
+    def add(self, key, name, data):
+        """Indexes a name under key, returning data with every match"""
+        self.documents[key] = (name.lower(), data)
+        for gram in trigrams(name):
+            self.postings.setdefault(gram, set()).add(key)
+
+    def search(self, query, threshold, accept=None):
+        """Returns (prefix, score, data) for the prefix and fuzzy matches of query
+
+        The score is the share of the query's trigrams found in the name,
+        close to what pg_trgm's word_similarity() returns.
+        """
+        wanted = trigrams(query)
+        prefix = query.lower()
+        counts = {}
+        for gram in wanted:
+            for key in self.postings.get(gram, ()):
+                counts[key] = counts.get(key, 0) + 1
+        if prefix:
+            # a prefix shorter than a trigram may share none with the name
+            counts.update({
+                key: counts.get(key, 0) for key, document in self.documents.items()
+                if key not in counts and document[0].startswith(prefix)
+            })
+        matches = []
+        for key, common in counts.items():
+            name, data = self.documents[key]
+            if accept is not None and not accept(data):
+                continue
+            score = common / len(wanted) if wanted else 0.0
+            is_prefix = name.startswith(prefix)
+            if is_prefix or score >= threshold:
+                matches.append((is_prefix, score, data))
+        return matches
+
+
+class MemorySearch:
+    """TrigramIndexes of both tables, rebuilt lazily after writes
+
+    Any statement other than a SELECT, and any commit of a connection that
+    wrote, moves the generation on; a search finding the index built at an
+    older generation rebuilds it first.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engines = weakref.WeakSet()
+        self.generation = 0
+        self.built = None
+        self.indexes = {}
+
+    def watch(self, engine):
+        """Listens for writes on an engine"""
+        if engine in self._engines:
+            return
+        self._engines.add(engine)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+        event.listen(engine, "commit", self._after_commit)
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:6].upper() not in ("SELECT", "PRAGMA"):
+            conn.info["search_wrote"] = True
+            self.generation += 1
+
+    def _after_commit(self, conn):
+        if conn.info.pop("search_wrote", False):
+            self.generation += 1
+
+    def rebuild(self):
+        """Reads every name into fresh TrigramIndexes"""
+        generation = self.generation
+        wishlists, items = TrigramIndex(), TrigramIndex()
+        wishlist, item = Wishlist.__table__, Item.__table__
+        customers = {}
+        for row in read_rows(db.select([wishlist.c.id, wishlist.c.name, wishlist.c.customer_id])):
+            customers[row.id] = row.customer_id
+            wishlists.add(row.id, row.name, {
+                "type": "wishlist", "id": row.id, "name": row.name, "customer_id": row.customer_id,
+            })
+        for row in read_rows(db.select([item.c.id, item.c.name, item.c.wishlist_id])):
+            if row.wishlist_id not in customers:
+                continue  # items without a wishlist cannot be scoped to a customer
+            items.add(row.id, row.name, {
+                "type": "item", "id": row.id, "name": row.name,
+                "customer_id": customers[row.wishlist_id], "wishlist_id": row.wishlist_id,
+            })
+        self.indexes = {"wishlist": wishlists, "item": items}
+        self.built = generation
+
+    def search(self, query, kind, customer_id, limit):
+        """Returns the best `limit` matches of one kind"""
+        self.watch(db.engine)
+        with self._lock:
+            if self.built != self.generation:
+                self.rebuild()
+            index = self.indexes[kind]
+        accept = None
+        if customer_id is not None:
+            accept = lambda data: data["customer_id"] == customer_id
+        matches = index.search(query, SEARCH_THRESHOLD, accept)
+        matches.sort(key=lambda match: (not match[0], -match[1], match[2]["id"]))
+        return [dict(data, score=round(score, 4)) for _, score, data in matches[:limit]]
+
+
+memory_search = MemorySearch()
+
+
+@event.listens_for(Pool, "connect")
+def set_threshold(dbapi_connection, _):
+    """Sets the fuzzy match threshold on every new PostgreSQL connection"""
+    if type(dbapi_connection).__module__.split(".")[0] != "psycopg2":
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("SET pg_trgm.word_similarity_threshold = %s", (SEARCH_THRESHOLD,))
+    cursor.close()
+    dbapi_connection.commit()  # a session-level SET outlives the transaction it ran in
+
+
+def postgres_search(query, kind, customer_id, limit):
+    """Returns the best `limit` matches of one kind using the trigram indexes"""
+    wishlist, item = Wishlist.__table__, Item.__table__
+    table = wishlist if kind == "wishlist" else item
+    prefix = table.c.name.ilike(escape_like(query) + "%", escape="\\")
+    score = db.func.word_similarity(query, table.c.name)
+    columns = [table.c.id, table.c.name, wishlist.c.customer_id]
+    if kind == "item":
+        columns.append(item.c.wishlist_id)
+    # name %> query is query <% name, which the GIN trigram index serves; the
+    # % is doubled because psycopg2 reads a lone one as a parameter marker
+    criteria = [db.or_(prefix, table.c.name.op("%%>")(query))]
+    if customer_id is not None:
+        criteria.append(wishlist.c.customer_id == customer_id)
+    statement = db.select(columns + [prefix.label("prefix"), score.label("score")])
+    if kind == "item":
+        statement = statement.select_from(item.join(wishlist, wishlist.c.id == item.c.wishlist_id))
+    statement = statement.where(db.and_(*criteria)).order_by(
+        db.desc("prefix"), db.desc("score"), table.c.id
+    ).limit(limit)
+    results = []
+    for row in read_rows(statement):
+        result = {"type": kind, "id": row.id, "name": row.name, "customer_id": row.customer_id}
+        if kind == "item":
+            result["wishlist_id"] = row.wishlist_id
+        result["score"] = round(float(row.score), 4)
+        results.append(result)
+    return results
+
+
+@db_call()
+def search(query, kind=None, customer_id=None, limit=20, offset=0):
+    """Finds Wishlists and Items whose names start with or resemble query
+
+    :param query: the text to look for
+    :type query: str
+    :param kind: "wishlist" or "item", None for both
+    :type kind: str
+    :param customer_id: only match the Wishlists (and their Items) of this customer
+    :type customer_id: int
+    :param limit: the most results to return
+    :type limit: int
+    :param offset: the number of ranked results to skip
+    :type offset: int
+
+    :return: the ranked results, each with its type, id, name, customer_id and score
+    :rtype: list
+
+    """
+    query = query.strip()
+    if not query:
+        return []
+    find = postgres_search if db.engine.dialect.name == "postgresql" else memory_search.search
+    kinds = [kind] if kind else list(KINDS)
+    results = []
+    for each in kinds:
+        results.extend(find(query, each, customer_id, offset + limit))
+    if len(kinds) > 1:
+        # the prefix flag is not returned, so re-rank merged lists the same way
+        lowered = query.lower()
+        results.sort(key=lambda result: (
+            not result["name"].lower().startswith(lowered),
+            -result["score"],
+            KINDS.index(result["type"]),
+            result["id"],
+        ))
+    return results[offset:offset + limit]
@@ -0,0 +1,83 @@
+"""
+Module: serializers
+
+Fast JSON encoding for the list endpoints
+
+flask_restx's marshal_with walks every field of every record through the
+fields.* descriptors after serialize() has already built a dict, and the
+result is then encoded by the stdlib json module. The list endpoints
+instead use serializers built once per model from its field list (see
+WISHLIST_SERIALIZED and ITEM_SERIALIZED in service/models.py), and encode
+the result straight to bytes with the fastest JSON backend available. The
+Swagger models in routes.py still document the responses.
+
+JSON_BACKEND picks the encoder: "orjson" (needs the optional orjson
+package), "json" (stdlib) or "auto" to use orjson when it is installed.
+"""
+import json
+import logging
+from functools import lru_cache
+from operator import attrgetter
+
+logger = logging.getLogger("flask.app")
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def stdlib_dumps(data):
+    """Encodes data as compact JSON bytes with the stdlib encoder"""
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def backend_from_name(name="auto"):
+    """Returns the (name, dumps) of the JSON backend to use
+
+    :param name: "auto", "orjson" or "json"
+    :type name: str
+
+    """
+    if name in ("auto", "orjson") and orjson is not None:
+        return "orjson", orjson.dumps
+    if name == "orjson":
+        logger.warning("JSON_BACKEND is orjson but orjson is not installed, using json")
+    elif name not in ("auto", "json"):
+        logger.warning("Unknown JSON_BACKEND %s, using json", name)
+    return "json", stdlib_dumps
+
+
+def compile_serializer(fields, getter=attrgetter):
+    """Builds a function that turns one record into a dict
+
+    The getters are built once, so serializing a record only reads and
+    converts its fields.
+
+    :param fields: (key, attribute) or (key, attribute, converter) tuples
+    :type fields: list
+    :param getter: attrgetter for model instances and query rows, which
+        expose their columns as attributes, itemgetter for asyncpg records
+    :type getter: function
+
+    :return: a function of one record returning a dict
+    :rtype: function
+
+    """
+    steps = []
+    for field in fields:
+        key, attribute = str(field[0]), field[1]
+        if not attribute.isidentifier():
+            raise ValueError("Cannot serialize attribute {!r}".format(attribute))
+        steps.append((key, getter(attribute), field[2] if len(field) > 2 else None))
+
+    def serialize(record):
+        return {key: get(record) if convert is None else convert(get(record)) for key, get, convert in steps}
+
+    return serialize
+
+
+@lru_cache(maxsize=64)
+def item_projection(fields):
+    """Returns a serializer for only some Item columns, compiled once per tuple of fields"""
+    return compile_serializer([(field, field) for field in fields])
@@ -0,0 +1,133 @@
+"""
+Module: sync
+
+Delta sync of a customer's Wishlists and Items
+
+A client that already holds a customer's data asks for what changed since
+the cursor of its last sync:
+
+    GET /api/sync?customer_id=7&updated_since=2026-01-01T12:00:00
+
+and receives the Wishlists and Items updated since then, the ids of the
+ones deleted since then, and the cursor to send next time. Without
+updated_since it receives everything, which is how a client starts. The
+reads are served by the (customer_id, updated_at) and (wishlist_id,
+updated_at) indexes, so a sync costs in proportion to the changes rather
+than to the data held.
+
+Clients apply the deletes first, then upsert the rows: an Item moved to
+another Wishlist shows up as both. Deleting a Wishlist deletes its Items.
+
+A sync is paged by Wishlist id, each page holding up to `limit` Wishlists
+and their changed Items. While there is more, a page names the last
+Wishlist in `after`; the next page is asked for with the same
+updated_since, that `after` and the `cursor` of the first page, which
+every page returns unchanged. The deletes come with the first page only.
+
+Timestamps are taken when a write is made, not when it commits, so the
+cursor handed out is SYNC_WINDOW seconds before the sync started. A write
+whose transaction was still open then is picked up by the next sync;
+some rows are sent twice, which upserts absorb. Deletes older than
+TOMBSTONE_TTL_DAYS are forgotten, so an older cursor is refused and the
+client starts over.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from service.models import DataValidationError, Item, Tombstone, Wishlist, PAGE_SIZE, TOMBSTONE_TTL_DAYS
+from service.models import isoformat_or_none, utcnow
+
+# seconds the cursor lags behind the start of a sync, longer than any write transaction
+SYNC_WINDOW = float(os.environ.get("SYNC_WINDOW", 5))
+
+WISHLIST_COLUMNS = ("id", "name", "customer_id", "version", "created_at", "updated_at")
+ITEM_COLUMNS = ("id", "name", "wishlist_id", "purchased", "created_at", "updated_at")
+
+
+class CursorExpired(Exception):
+    """Raised for a cursor older than the tombstones that are kept"""
+
+
+def parse_cursor(text):
+    """Reads an updated_since cursor into a naive UTC datetime
+
+    :param text: an ISO 8601 time, UTC unless it has an offset
+    :type text: str
+
+    :return: the time, None for an empty cursor
+    :rtype: datetime
+
+    """
+    if not text:
+        return None
+    try:
+        value = datetime.fromisoformat(text.strip().replace("Z", "+00:00"))
+    except ValueError:
+        raise DataValidationError("Invalid updated_since: {!r} is not an ISO 8601 time".format(text))
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def as_dict(row, columns):
+    """Serializes a row with its timestamps in ISO 8601"""
+    data = {}
+    for column in columns:
+        value = getattr(row, column)
+        data[column] = isoformat_or_none(value) if isinstance(value, datetime) else value
+    return data
+
+
+def check_cursor(since, now):
+    """Refuses a cursor from before the oldest deletes that are kept"""
+    if since is not None and since < now - timedelta(days=TOMBSTONE_TTL_DAYS):
+        raise CursorExpired(
+            "updated_since is older than {:g} days, sync again without it".format(TOMBSTONE_TTL_DAYS)
+        )
+
+
+def changes(customer_id, updated_since=None, after=None, limit=PAGE_SIZE, cursor=None):
+    """Returns a page of what changed in a customer's Wishlists and Items since a cursor
+
+    The tombstones are read before the rows: a row deleted in between is
+    then missing from both, never sent back to life after its delete. A
+    sync without updated_since starts from nothing, so it has no deletes.
+
+    :param customer_id: the customer to sync
+    :type customer_id: int
+    :param updated_since: the cursor of the last sync, None for everything
+    :type updated_since: datetime
+    :param after: the `after` of the previous page, None for the first page
+    :type after: int
+    :param limit: the maximum number of Wishlists in the page
+    :type limit: int
+    :param cursor: the `cursor` of the first page, None for the first page
+    :type cursor: datetime
+
+    :return: the changed Wishlists and Items, the deleted ids, the next cursor
+        and the `after` of the next page, None on the last page
+    :rtype: dict
+
+    """
+    started = utcnow()
+    check_cursor(updated_since, started)
+    deleted = {"wishlists": [], "items": []}
+    if updated_since is not None and after is None:
+        for tombstone in Tombstone.since(customer_id, updated_since):
+            deleted[tombstone.kind + "s"].append(tombstone.object_id)
+        deleted = {kind: list(dict.fromkeys(ids)) for kind, ids in deleted.items()}  # moved twice, listed once
+    # fetch one extra Wishlist to find out whether there is a next page
+    wishlists = Wishlist.changed_rows(customer_id, updated_since, after, limit + 1)
+    more = len(wishlists) > limit
+    wishlists = wishlists[:limit]
+    items = Item.changed_rows([row.id for row in wishlists], updated_since)
+    if cursor is None:
+        cursor = started - timedelta(seconds=SYNC_WINDOW)
+    return {
+        "customer_id": customer_id,
+        "updated_since": isoformat_or_none(updated_since),
+        "cursor": isoformat_or_none(cursor),
+        "after": wishlists[-1].id if more else None,
+        "wishlists": [as_dict(row, WISHLIST_COLUMNS) for row in wishlists],
+        "items": [as_dict(row, ITEM_COLUMNS) for row in items],
+        "deleted": deleted,
+    }
@@ -0,0 +1,44 @@
+"""
+Module: threads
+
+Background threads for gunicorn workers
+
+Threads do not survive fork(): a worker forked from a master that had
+already started one (i.e. with PRELOAD_APP) finds its copy of the Thread
+object stopped. A BackgroundThread remembers the process that started it,
+so start() called in a forked worker starts that worker's own thread.
+"""
+import os
+import threading
+
+
+class BackgroundThread:
+    """A daemon thread that runs at most once per process"""
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self.thread = None
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def running(self):
+        """Returns True if this process has started the thread and it is alive"""
+        return self.pid == os.getpid() and self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """Starts the thread unless this process already runs it
+
+        :return: True if the thread was started by this call
+        :rtype: bool
+
+        """
+        if self.running():
+            return False
+        with self._lock:
+            if self.running():
+                return False
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+            self.thread.start()
+        return True
@@ -0,0 +1,11 @@
+"""
+Module: wsgi
+
+The configured app for gunicorn and the flask command
+
+    gunicorn service.wsgi:app
+    FLASK_APP=service.wsgi flask migrate
+"""
+from service import create_app
+
+app = create_app()
@@ -0,0 +1,114 @@
+"""
+Test cases for the model cache backends
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+
+"""
+import fnmatch
+import unittest
+from service.cache import LRUCache, SharedCache, NullCache, ReadThroughCache, backend_from_config
+
+
+class FakeRedis:
+    """Local stand-in for the subset of redis-py used by SharedCache"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, pattern):
+        return [key for key in list(self.data) if fnmatch.fnmatch(key, pattern)]
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestCache(unittest.TestCase):
+    """Test Cases for the cache backends"""
+
+    def test_lru_evicts_least_recently_used(self):
+        """The LRU cache evicts the oldest entry when full"""
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)  # "b" is now least recently used
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_lru_expires_entries(self):
+        """The LRU cache expires entries after the ttl"""
+        now = [100.0]
+        cache = LRUCache(ttl=10, clock=lambda: now[0])
+        cache.set("a", 1)
+        now[0] = 109.0
+        self.assertEqual(cache.get("a"), 1)
+        now[0] = 110.0
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_shared_cache(self):
+        """The shared cache round trips JSON through the client"""
+        client = FakeRedis()
+        cache = SharedCache(client, prefix="test:")
+        cache.set("wishlist:1", {"id": 1, "name": "fido"})
+        self.assertIn("test:wishlist:1", client.data)
+        self.assertEqual(cache.get("wishlist:1"), {"id": 1, "name": "fido"})
+        cache.delete("wishlist:1")
+        self.assertIsNone(cache.get("wishlist:1"))
+        cache.set("a", 1)
+        cache.set("b", 2)
+        client.set("other", 3)
+        cache.clear()
+        self.assertEqual(list(client.data), ["other"])
+
+    def test_read_through_counters(self):
+        """Hits, misses and invalidations are counted"""
+        cache = ReadThroughCache(LRUCache())
+        loads = []
+        loader = lambda: loads.append(1) or {"id": 1}
+        self.assertEqual(cache.get_or_load("k", loader), {"id": 1})
+        self.assertEqual(cache.get_or_load("k", loader), {"id": 1})
+        self.assertEqual(len(loads), 1)
+        # misses are not cached
+        self.assertIsNone(cache.get_or_load("missing", lambda: None))
+        cache.invalidate("k")
+        self.assertIsNone(cache.get("k"))
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 3)
+        self.assertEqual(stats["invalidations"], 1)
+        self.assertEqual(stats["backend"], "LRUCache")
+
+    def test_backend_from_config(self):
+        """The backend is chosen from the app config"""
+        self.assertIsInstance(backend_from_config({}), LRUCache)
+        self.assertIsInstance(backend_from_config({"CACHE_BACKEND": "none"}), NullCache)
+        backend = backend_from_config({"CACHE_BACKEND": "memory", "CACHE_TTL": 5})
+        self.assertEqual(backend.ttl, 5)
+
+    def test_no_private_cache_with_several_workers(self):
+        """Several workers only share a cache, or go without one"""
+        self.assertIsInstance(backend_from_config({"WEB_CONCURRENCY": 1}), LRUCache)
+        self.assertIsInstance(backend_from_config({"WEB_CONCURRENCY": 4}), NullCache)
+        self.assertIsInstance(
+            backend_from_config({"WEB_CONCURRENCY": 4, "CACHE_BACKEND": "redis"}), (SharedCache, NullCache)
+        )
+        self.assertIsInstance(
+            backend_from_config({"WEB_CONCURRENCY": 4, "CACHE_URL": "redis://cache:6379/0"}),
+            (SharedCache, NullCache),
+        )
@@ -12,8 +12,11 @@ While debugging just these tests it's convinient to use this:
 import os
 import logging
 import unittest
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import NotFound
-from service.models import Item, Wishlist, DataValidationError, db
+from service.models import Item, Wishlist, DataValidationError, db, cache, init_db
+from service.models import unit_of_work, savepoint, wishlist_key
 from service import app
 from factories import ItemFactory, WishlistFactory
 from nose.tools import *
@@ -35,7 +38,7 @@ class TestItemModel(unittest.TestCase):
         app.config["DEBUG"] = False
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
-        Item.init_db(app)
+        init_db(app)
 
     @classmethod
     def tearDownClass(cls):
@@ -46,6 +49,7 @@ class TestItemModel(unittest.TestCase):
         """This runs before each test"""
         db.drop_all()  # clean up the last tests
         db.create_all()  # make our sqlalchemy tables
+        cache.clear()  # cached rows do not survive the tables
 
     def tearDown(self):
         """This runs after each test"""
@@ -186,19 +190,6 @@ class TestItemModel(unittest.TestCase):
         self.assertEqual(item.id, items[1].id)
         self.assertEqual(item.name, items[1].name)
 
-    def test_find_by_wishlist_id(self):
-        """Find items by Wishlist ID"""
-        Wishlist(name="fido", customer_id=1).create()
-        Wishlist(name="kitty", customer_id=2).create()
-        Item(name="Ziyi", wishlist_id=1).create(1)
-        Item(name="Huang", wishlist_id=2).create(2)
-        items = Item.find_by_wishlist_id(2)
-        self.assertEqual(items[0].wishlist_id, 2)
-        self.assertEqual(items[0].name, "Huang")
-        Item(name="DevOps", wishlist_id=2).create(2)
-        items = Item.find_by_wishlist_id(2)
-        self.assertEqual(len(items), 2)
-
     def test_find_or_404_found(self):
         """Find or return 404 found"""
         wishlists = WishlistFactory.create_batch(3)
@@ -220,3 +211,160 @@ class TestItemModel(unittest.TestCase):
     def test_find_or_404_not_found(self):
         """Find or return 404 NOT found"""
         self.assertRaises(NotFound, Item.find_or_404, 0)
+
+    def test_create_many_items(self):
+        """Create many Items with one bulk insert"""
+        Wishlist(name="fido", customer_id=1).create()
+        items = [Item(name="item%d" % i, purchased=(i == 2)) for i in range(3)]
+        ids = Item.create_many(1, items)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual([item.id for item in items], ids)
+        found = Item.find_rows_by_wishlist_id(1)
+        self.assertEqual(sorted(item.name for item in found), ["item0", "item1", "item2"])
+        self.assertTrue(Item.find(ids[2]).purchased)
+        self.assertEqual(Item.create_many(1, []), [])
+
+    def test_purchase_many_items(self):
+        """Purchase many Items with one bulk update"""
+        Wishlist(name="fido", customer_id=1).create()
+        Wishlist(name="kitty", customer_id=2).create()
+        ids = Item.create_many(1, [Item(name="a"), Item(name="b", purchased=True), Item(name="c")])
+        other = Item.create_many(2, [Item(name="d")])
+        purchased, already, missing = Item.purchase_many(1, [ids[0], ids[1], ids[0], other[0], 999])
+        self.assertEqual(purchased, [ids[0]])
+        self.assertEqual(already, [ids[1]])
+        self.assertEqual(missing, sorted([other[0], 999]))
+        self.assertFalse(Item.find(other[0]).purchased)
+        self.assertEqual(Wishlist.find(1).version, 3)
+        # everything that is left
+        self.assertEqual(Item.purchase_many(1), ([ids[2]], [], []))
+        self.assertEqual(Item.purchase_many(1), ([], [], []))
+        self.assertEqual(Wishlist.find(1).version, 4)
+        self.assertEqual(Item.purchase_many(1, []), ([], [], []))
+
+    def test_find_rows_by_wishlist_id(self):
+        """Read the Items on a Wishlist as plain rows outside the session"""
+        Wishlist(name="fido", customer_id=1).create()
+        Item.create_many(1, [Item(name="a", wishlist_id=1), Item(name="b", wishlist_id=1, purchased=True)])
+        db.session.expunge_all()
+        rows = Item.find_rows_by_wishlist_id(1)
+        self.assertEqual([(row.name, row.purchased) for row in rows], [("a", False), ("b", True)])
+        self.assertEqual(len(db.session.identity_map), 0)
+        self.assertEqual(Item.find_rows_by_wishlist_id(2), [])
+
+    def test_find_rows_by_wishlist_ids(self):
+        """Read the Items of many Wishlists with one query"""
+        for name in ("fido", "kitty", "empty"):
+            Wishlist(name=name, customer_id=1).create()
+        Item.create_many(1, [Item(name="a"), Item(name="b")])
+        Item.create_many(2, [Item(name="c")])
+        items = Item.find_rows_by_wishlist_ids([1, 2, 3])
+        self.assertEqual(sorted(items), [1, 2])
+        self.assertEqual([row.name for row in items[1]], ["a", "b"])
+        self.assertEqual([row.name for row in items[2]], ["c"])
+        self.assertEqual(Item.find_rows_by_wishlist_ids([]), {})
+
+    def test_filter_and_sort_by_wishlist_id(self):
+        """Filter, sort, project and count the Items on a Wishlist in SQL"""
+        Wishlist(name="fido", customer_id=1).create()
+        Item.create_many(1, [
+            Item(name="apple"), Item(name="apricot", purchased=True), Item(name="banana"), Item(name="a_b"),
+        ])
+        rows = Item.find_rows_by_wishlist_id(1, purchased=False, sort=["-name"])
+        self.assertEqual([row.name for row in rows], ["banana", "apple", "a_b"])
+        rows = Item.find_rows_by_wishlist_id(1, name="ap", fields=["name"])
+        self.assertEqual([tuple(row) for row in rows], [("apple",), ("apricot",)])
+        # the prefix is escaped, _ is not a wildcard
+        self.assertEqual([row.name for row in Item.find_rows_by_wishlist_id(1, name="a_")], ["a_b"])
+        items = Item.find_rows_by_wishlist_id(1, sort=["-purchased", "name"])
+        self.assertEqual([item.name for item in items], ["apricot", "a_b", "apple", "banana"])
+        self.assertEqual(Item.count_by_wishlist_id(1), 4)
+        self.assertEqual(Item.count_by_wishlist_id(1, purchased=True), 1)
+        self.assertEqual(Item.count_by_wishlist_id(1, purchased=False, name="b"), 1)
+        self.assertEqual(Item.count_by_wishlist_id(2), 0)
+        self.assertRaises(DataValidationError, Item.find_rows_by_wishlist_id, 1, sort=["wishlist_id"])
+        self.assertRaises(DataValidationError, Item.find_rows_by_wishlist_id, 1, fields=["secret"])
+
+    def test_find_on_wishlist(self):
+        """Find an Item and its Wishlist in one query"""
+        Wishlist(name="fido", customer_id=1).create()
+        Wishlist(name="kitty", customer_id=2).create()
+        item = Item(name="Ziyi", wishlist_id=1)
+        item.create(1)
+        wishlist_found, found = Item.find_on_wishlist(1, item.id)
+        self.assertTrue(wishlist_found)
+        self.assertEqual(found.id, item.id)
+        self.assertEqual(found.name, "Ziyi")
+        # the item is not on the other wishlist
+        wishlist_found, found = Item.find_on_wishlist(2, item.id)
+        self.assertTrue(wishlist_found)
+        self.assertIsNone(found)
+        # the wishlist does not exist at all
+        wishlist_found, found = Item.find_on_wishlist(999, item.id)
+        self.assertFalse(wishlist_found)
+        self.assertIsNone(found)
+
+    def test_item_changes_bump_wishlist_version(self):
+        """Item writes bump the version of their Wishlist"""
+        wishlist = Wishlist(name="fido", customer_id=1)
+        wishlist.create()
+        self.assertEqual(Wishlist.find(1).version, 1)
+        item = Item(name="Ziyi", wishlist_id=1)
+        item.create(1)
+        self.assertEqual(Wishlist.find(1).version, 2)
+        item.name = "Huang"
+        item.update()
+        self.assertEqual(Wishlist.find(1).version, 3)
+        Item.create_many(1, [Item(name="a"), Item(name="b")])
+        self.assertEqual(Wishlist.find(1).version, 4)
+        item.delete()
+        self.assertEqual(Wishlist.find(1).version, 5)
+
+    def _statements(self):
+        """Records the statements sent to the database until the test ends"""
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement.split()[0].upper())
+        event.listen(db.engine, "before_cursor_execute", record)
+        self.addCleanup(event.remove, db.engine, "before_cursor_execute", record)
+        return statements
+
+    def test_unit_of_work_commits_once(self):
+        """Writes in a unit of work share one transaction"""
+        Wishlist(name="fido", customer_id=1).create()
+        self.assertEqual(Wishlist.find(1).version, 1)
+        statements = self._statements()
+        with unit_of_work():
+            for name in ("a", "b", "c"):
+                Item(name=name).create(1)
+            # the cache is only invalidated once the transaction commits
+            self.assertIsNotNone(cache.get(wishlist_key(1)))
+        self.assertIsNone(cache.get(wishlist_key(1)))
+        self.assertEqual(statements[0], "BEGIN")
+        self.assertEqual(statements.count("COMMIT"), 1)
+        self.assertEqual(len(Item.find_rows_by_wishlist_id(1)), 3)
+        self.assertEqual(Wishlist.find(1).version, 4)
+
+    def test_unit_of_work_rolls_back(self):
+        """An exception in a unit of work undoes all of its writes"""
+        Wishlist(name="fido", customer_id=1).create()
+        with self.assertRaises(KeyError):
+            with unit_of_work():
+                Item(name="a").create(1)
+                Item(name="b").create(1)
+                raise KeyError("b")
+        self.assertEqual(Item.all(), [])
+        self.assertEqual(Wishlist.find(1).version, 1)
+
+    def test_savepoint_partial_failure(self):
+        """A failed savepoint only undoes its own writes"""
+        Wishlist(name="fido", customer_id=1).create()
+        with unit_of_work():
+            Item(name="a").create(1)
+            with self.assertRaises(IntegrityError):
+                with savepoint():
+                    Item(name="b").create(1)
+                    Item(name=None).create(1)
+            Item(name="c").create(1)
+        names = [row.name for row in Item.find_rows_by_wishlist_id(1)]
+        self.assertEqual(names, ["a", "c"])
+        self.assertEqual(Wishlist.find(1).version, 3)
@@ -0,0 +1,103 @@
+"""
+Test cases for the queue based logging pipeline
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+
+"""
+import json
+import logging
+import queue
+import unittest
+from service.log import (
+    GuardedQueueHandler, JSONFormatter, LogPipeline, SamplingFilter, parse_sample_rates
+)
+
+
+class ListHandler(logging.Handler):
+    """Keeps the formatted records"""
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+######################################################################
+#  L O G G I N G   T E S T   C A S E S
+######################################################################
+class TestLogPipeline(unittest.TestCase):
+    """Test Cases for the logging pipeline"""
+
+    def setUp(self):
+        self.target = ListHandler()
+        self.target.setFormatter(JSONFormatter(max_length=50))
+        self.logger = logging.getLogger("tests.log")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        self.logger.handlers = []
+
+    def test_records_are_written_as_json(self):
+        """Records reach the target handler as JSON lines"""
+        pipeline = LogPipeline([self.target], max_length=50)
+        self.logger.handlers = [pipeline.handler]
+        pipeline.start()
+        self.logger.info("Wishlist %s created", 7, extra={"customer_id": 3})
+        pipeline.stop()
+        record = json.loads(self.target.lines[0])
+        self.assertEqual(record["message"], "Wishlist 7 created")
+        self.assertEqual(record["level"], "INFO")
+        self.assertEqual(record["customer_id"], 3)
+
+    def test_large_payloads_are_truncated(self):
+        """Huge arguments are snapshotted small on the calling thread"""
+        log_queue = queue.Queue()
+        handler = GuardedQueueHandler(log_queue, max_length=50)
+        self.logger.handlers = [handler]
+        rows = list(range(100000))
+        self.logger.info("rows: %s", rows)
+        self.logger.info("x" * 1000)
+        rows.append(-1)  # later changes do not leak into the queued record
+        first, second = log_queue.get_nowait(), log_queue.get_nowait()
+        self.assertLess(len(first.getMessage()), 100)
+        self.assertIn("...", first.getMessage())
+        self.assertIn("(950 more chars)", second.getMessage())
+
+    def test_exceptions_are_rendered(self):
+        """Tracebacks are rendered before the record is queued"""
+        log_queue = queue.Queue()
+        self.logger.handlers = [GuardedQueueHandler(log_queue)]
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            self.logger.exception("failed")
+        record = log_queue.get_nowait()
+        self.assertIsNone(record.exc_info)
+        self.assertIn("ValueError: boom", record.exc_text)
+        self.assertIn("ValueError: boom", json.loads(JSONFormatter().format(record))["exception"])
+
+    def test_full_queue_drops_records(self):
+        """A full queue drops records instead of blocking"""
+        pipeline = LogPipeline([self.target], queue_size=2)
+        self.logger.handlers = [pipeline.handler]
+        for number in range(5):
+            self.logger.warning("record %s", number)
+        self.assertEqual(pipeline.stats(), {"queued": 2, "capacity": 2, "dropped": 3})
+
+    def test_sampling(self):
+        """Sampled levels keep only a fraction, other levels are kept"""
+        rates = parse_sample_rates("info=0.5, debug=0")
+        self.assertEqual(rates, {logging.INFO: 0.5, logging.DEBUG: 0.0})
+        rolls = iter([0.1, 0.9])
+        sampler = SamplingFilter(rates, rand=lambda: next(rolls))
+        info = logging.makeLogRecord({"levelno": logging.INFO})
+        self.assertTrue(sampler.filter(info))
+        self.assertFalse(sampler.filter(info))
+        self.assertFalse(sampler.filter(logging.makeLogRecord({"levelno": logging.DEBUG})))
+        self.assertTrue(sampler.filter(logging.makeLogRecord({"levelno": logging.ERROR})))
+        self.assertRaises(ValueError, parse_sample_rates, "loud=1")
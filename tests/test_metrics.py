@@ -0,0 +1,116 @@
+"""
+Test cases for the request metrics
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from flask import Flask, g
+from service.metrics import MetricsRegistry, finish_requests, parse_buckets, DEFAULT_BUCKETS
+
+
+######################################################################
+#  M E T R I C S   T E S T   C A S E S
+######################################################################
+class TestMetricsRegistry(unittest.TestCase):
+    """Test Cases for the sharded metrics registry"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parse_buckets(self):
+        """Bucket bounds are parsed and sorted"""
+        self.assertEqual(parse_buckets("1, 0.1,0.5"), (0.1, 0.5, 1.0))
+        self.assertEqual(parse_buckets(""), DEFAULT_BUCKETS)
+
+    def test_render_histogram(self):
+        """Latencies are rendered as cumulative buckets with their sum and count"""
+        registry = MetricsRegistry(buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.5, 5.0):
+            registry.started("WishlistResource", "GET")
+            registry.finished("WishlistResource", "GET", 200, seconds)
+        registry.started("WishlistResource", "GET")
+        text = registry.render()
+        labels = 'resource="WishlistResource",method="GET"'
+        self.assertIn('wishlists_http_request_duration_seconds_bucket{%s,le="0.1"} 1' % labels, text)
+        self.assertIn('wishlists_http_request_duration_seconds_bucket{%s,le="1"} 2' % labels, text)
+        self.assertIn('wishlists_http_request_duration_seconds_bucket{%s,le="+Inf"} 3' % labels, text)
+        self.assertIn("wishlists_http_request_duration_seconds_sum{%s} 5.55" % labels, text)
+        self.assertIn("wishlists_http_request_duration_seconds_count{%s} 3" % labels, text)
+        self.assertIn('wishlists_http_requests_total{%s,status="200"} 3' % labels, text)
+        self.assertIn("wishlists_http_requests_in_progress{%s} 1" % labels, text)
+        self.assertIn("# TYPE wishlists_http_requests_total counter", text)
+
+    def test_threads_record_into_shards(self):
+        """Every thread records into its own shard, a snapshot adds them up"""
+        registry = MetricsRegistry()
+
+        def serve():
+            for _ in range(100):
+                registry.started("ItemCollection", "POST")
+                registry.finished("ItemCollection", "POST", 201, 0.001)
+
+        threads = [threading.Thread(target=serve) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot["requests"], {"ItemCollection POST 201": 400})
+        self.assertEqual(snapshot["in_progress"], {"ItemCollection POST": 0})
+        self.assertEqual(len(registry._shards), 4)
+
+    def test_workers_share_a_directory(self):
+        """Totals flushed by other workers are added, gauges only while they run"""
+        registry = MetricsRegistry(directory=self.directory)
+        registry.started("WishlistCollection", "GET")
+        registry.finished("WishlistCollection", "GET", 200, 0.01)
+        registry.flush()
+        with open(registry.path()) as stream:
+            self.assertEqual(json.load(stream)["requests"], {"WishlistCollection GET 200": 1})
+        # a worker that has exited (no process has a pid this large)
+        with open(os.path.join(self.directory, "metrics_4194999.json"), "w") as stream:
+            json.dump({
+                "latency": {"WishlistCollection GET": [0] * (len(DEFAULT_BUCKETS) + 1) + [0.5]},
+                "requests": {"WishlistCollection GET 200": 2},
+                "in_progress": {"WishlistCollection GET": 3},
+            }, stream)
+        registry.started("WishlistCollection", "GET")
+        totals = registry.collect()
+        self.assertEqual(totals["requests"], {"WishlistCollection GET 200": 3})
+        self.assertEqual(totals["in_progress"], {"WishlistCollection GET": 1})
+
+    def test_finish_requests(self):
+        """Every started request is finished once, failed ones without a response"""
+        app = Flask(__name__)
+        app.config["PROPAGATE_EXCEPTIONS"] = True
+        finished = []
+
+        @app.before_request
+        def start():
+            g.timed = "started"
+
+        @app.route("/ok")
+        def ok():
+            return "ok"
+
+        @app.route("/fail")
+        def fail():
+            raise RuntimeError("boom")
+
+        finish_requests(app, "timed", lambda value, response: finished.append(
+            (value, response.status_code if response is not None else None)))
+        client = app.test_client()
+        client.get("/ok")
+        self.assertRaises(RuntimeError, client.get, "/fail")
+        self.assertEqual(finished, [("started", 200), ("started", None)])
@@ -0,0 +1,53 @@
+"""
+Test cases for the instrumented connection pool
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+
+"""
+import sqlite3
+import unittest
+from sqlalchemy import exc
+from service.pool import PoolStats, InstrumentedQueuePool, pool_status
+
+
+######################################################################
+#  P O O L   T E S T   C A S E S
+######################################################################
+class TestInstrumentedPool(unittest.TestCase):
+    """Test Cases for the connection pool instrumentation"""
+
+    def test_histogram_is_cumulative(self):
+        """Checkout latencies land in cumulative buckets"""
+        stats = PoolStats()
+        stats.observe(0.0001)
+        stats.observe(0.003)
+        stats.observe(10, timed_out=True)
+        data = stats.snapshot()
+        self.assertEqual(data["checkouts"], 3)
+        self.assertEqual(data["timeouts"], 1)
+        self.assertEqual(data["wait_seconds_max"], 10)
+        histogram = data["checkout_latency_ms"]
+        self.assertEqual(histogram["0.5"], 1)
+        self.assertEqual(histogram["5"], 2)
+        self.assertEqual(histogram["5000"], 2)
+        self.assertEqual(histogram["+Inf"], 3)
+
+    def test_pool_gauges(self):
+        """Checked out and overflow connections are reported"""
+        pool = InstrumentedQueuePool(
+            lambda: sqlite3.connect(":memory:"), pool_size=1, max_overflow=1, timeout=0.01
+        )
+        first = pool.connect()
+        second = pool.connect()
+        data = pool_status(pool)
+        self.assertEqual(data["checked_out"], 2)
+        self.assertEqual(data["overflow"], 1)
+        self.assertEqual(data["checkouts"], 2)
+        # the pool is exhausted so the next checkout times out
+        self.assertRaises(exc.TimeoutError, pool.connect)
+        self.assertEqual(pool_status(pool)["timeouts"], 1)
+        first.close()
+        second.close()
+        self.assertEqual(pool_status(pool)["checked_out"], 0)
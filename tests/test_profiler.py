@@ -0,0 +1,115 @@
+"""
+Test cases for the request profiler
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from service.profiler import RequestProfiler, Sampler, check_token, profile_token
+
+
+def busy_loop(seconds):
+    """Keeps the calling thread on the CPU"""
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+######################################################################
+#  P R O F I L E R   T E S T   C A S E S
+######################################################################
+class TestRequestProfiler(unittest.TestCase):
+    """Test Cases for the profiler, its tokens and its stored profiles"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = RequestProfiler(self.directory, secret="secret")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_tokens(self):
+        """Only unexpired tokens signed with the secret are accepted"""
+        self.assertTrue(check_token("secret", profile_token("secret")))
+        self.assertFalse(check_token("other", profile_token("secret")))
+        self.assertFalse(check_token("secret", profile_token("secret", ttl=-10)))
+        self.assertFalse(check_token("secret", "garbage"))
+        self.assertFalse(check_token("", profile_token("")))
+        self.assertEqual(self.profiler.reason({"X-Profile": profile_token("secret")}), "header")
+        self.assertIsNone(self.profiler.reason({"X-Profile": "1.bad"}))
+        self.assertIsNone(self.profiler.reason({}))
+
+    def test_sampling(self):
+        """A sampled fraction of requests is profiled without a header"""
+        profiler = RequestProfiler(self.directory, sample_rate=1.0)
+        self.assertEqual(profiler.reason({}), "sample")
+        self.assertIsNone(RequestProfiler(self.directory).reason({}))
+        self.assertIsNone(RequestProfiler("", sample_rate=1.0).reason({}))
+
+    def test_profile_is_written(self):
+        """A profile leaves its pstats, collapsed stacks and metadata"""
+        profile = self.profiler.start("header")
+        busy_loop(0.05)
+        meta = self.profiler.stop(profile, {"resource": "WishlistCollection.get", "status": 200})
+        for extension in ("pstats", "collapsed", "json"):
+            self.assertTrue(os.path.exists(self.profiler.path(meta["id"], extension)))
+        self.assertGreater(meta["samples"], 0)
+        with open(self.profiler.path(meta["id"], "collapsed")) as stream:
+            self.assertIn("test_profiler.py:busy_loop", stream.read())
+        self.assertEqual([found["id"] for found in self.profiler.profiles("WishlistCollection.get")], [meta["id"]])
+        self.assertEqual(self.profiler.profiles("ItemCollection.get"), [])
+
+    def test_one_profile_at_a_time(self):
+        """A request arriving during a profile is not profiled"""
+        profile = self.profiler.start("header")
+        self.assertIsNone(self.profiler.start("header"))
+        self.profiler.stop(profile, {})
+        self.assertEqual(self.profiler.stats(), {"enabled": True, "profiled": 1, "skipped": 1})
+        self.profiler.stop(self.profiler.start("header"), {})
+
+    def test_hot_functions(self):
+        """The stored profiles are merged and their top functions ranked"""
+        for _ in range(2):
+            profile = self.profiler.start("sample")
+            busy_loop(0.01)
+            self.profiler.stop(profile, {"resource": "WishlistCollection.get"})
+        hot = self.profiler.hot_functions("WishlistCollection.get", top=5, sort="own")
+        self.assertEqual(hot["profiles"], 2)
+        self.assertEqual(len(hot["functions"]), 5)
+        self.assertEqual(hot["functions"][0]["function"], "busy_loop")
+        self.assertEqual(hot["functions"][0]["calls"], 2)
+        self.assertEqual(self.profiler.hot_functions("ItemCollection.get")["functions"], [])
+
+    def test_prune(self):
+        """Only the newest profiles are kept"""
+        self.profiler.keep = 2
+        ids = []
+        for _ in range(3):
+            ids.append(self.profiler.stop(self.profiler.start("header"), {})["id"])
+        self.assertEqual([meta["id"] for meta in self.profiler.profiles()], ids[:0:-1])
+        self.assertEqual(len(os.listdir(self.directory)), 6)
+
+
+class TestSampler(unittest.TestCase):
+    """Test Cases for the stack sampler"""
+
+    def test_folded_stacks(self):
+        """The stacks of another thread are counted root first"""
+        thread = threading.Thread(target=busy_loop, args=(0.1,))
+        thread.start()
+        sampler = Sampler(thread.ident, 0.001)
+        sampler.start()
+        thread.join()
+        sampler.stop()
+        self.assertGreater(sampler.samples, 0)
+        line = sampler.collapsed().splitlines()[0]
+        stack, count = line.rsplit(" ", 1)
+        self.assertTrue(stack.startswith("threading.py:_bootstrap"))
+        self.assertGreater(int(count), 0)
@@ -0,0 +1,73 @@
+"""
+Test cases for the SQL statement instrumentation
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+
+"""
+import logging
+import unittest
+from sqlalchemy import create_engine
+from service.queries import QueryMonitor, capture_queries
+
+
+######################################################################
+#  Q U E R Y   M O N I T O R   T E S T   C A S E S
+######################################################################
+class TestQueryMonitor(unittest.TestCase):
+    """Test Cases for the statement counts and the slow query log"""
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://", isolation_level="AUTOCOMMIT")
+        self.engine.execute("CREATE TABLE pet (id INTEGER PRIMARY KEY, name VARCHAR(63))")
+        self.engine.execute("INSERT INTO pet (name) VALUES ('fido'), ('kitty')")
+        self.logger = logging.getLogger("flask.app")
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_statements_are_counted_per_thread(self):
+        """Only statements run while counting are added up"""
+        monitor = QueryMonitor(slow_ms=None)
+        monitor.listen(self.engine)
+        self.engine.execute("SELECT 1")
+        stats = monitor.start()
+        self.engine.execute("SELECT * FROM pet")
+        self.engine.execute("SELECT count(*) FROM pet")
+        self.assertIs(monitor.stop(), stats)
+        self.assertEqual(stats.count, 2)
+        self.assertGreater(stats.seconds, 0)
+        self.assertRegex(stats.server_timing(0.01), r'^db;dur=[0-9.]+;desc="2 queries", app;dur=10.0$')
+
+    def test_failed_statements_are_forgotten(self):
+        """A failing statement does not leave its start time behind"""
+        monitor = QueryMonitor(slow_ms=None)
+        monitor.listen(self.engine)
+        with self.engine.connect() as conn:
+            with self.assertRaises(Exception):
+                conn.execute("SELECT * FROM nothing")
+            self.assertEqual(conn.info.get(monitor._key), [])
+
+    def test_slow_queries_are_logged_with_their_plan(self):
+        """Statements over the threshold are logged with parameters and plan"""
+        monitor = QueryMonitor(slow_ms=0, explain=True)
+        monitor.listen(self.engine)
+        with self.assertLogs(self.logger, logging.WARNING) as logs:
+            self.engine.execute("SELECT name FROM pet WHERE id = ?", 1)
+            self.engine.execute("UPDATE pet SET name = ? WHERE id = ?", "rex", 2)
+        self.assertEqual(monitor.slow, 2)
+        select, update = logs.records
+        self.assertIn("SELECT name FROM pet", select.getMessage())
+        self.assertEqual(select.parameters, (1,))
+        self.assertIn("SEARCH", select.plan)
+        # writes are never run a second time to explain them
+        self.assertIsNone(update.plan)
+        self.assertEqual(self.engine.execute("SELECT name FROM pet WHERE id = 2").scalar(), "rex")
+
+    def test_capture_queries(self):
+        """capture_queries collects the statements of its block only"""
+        with capture_queries(self.engine) as statements:
+            self.engine.execute("SELECT 1")
+        self.engine.execute("SELECT 2")
+        self.assertEqual(statements, ["SELECT 1"])
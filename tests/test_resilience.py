@@ -0,0 +1,169 @@
+"""
+Test cases for the database retry policy and circuit breaker
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+
+"""
+import unittest
+from sqlalchemy import exc
+from service.resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, guarded, is_transient
+
+
+class FakePgError(Exception):
+    """Stand-in for a psycopg2 error carrying a SQLSTATE code"""
+
+    def __init__(self, pgcode):
+        super().__init__("pg error {}".format(pgcode))
+        self.pgcode = pgcode
+
+
+def operational_error(pgcode=None):
+    """Builds a SQLAlchemy OperationalError wrapping a driver error"""
+    return exc.OperationalError("SELECT 1", {}, FakePgError(pgcode))
+
+
+class Clock:
+    """A manually advanced clock"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+######################################################################
+#  R E S I L I E N C E   T E S T   C A S E S
+######################################################################
+class TestResilience(unittest.TestCase):
+    """Test Cases for retries and the circuit breaker"""
+
+    def test_is_transient(self):
+        """Only connection level errors are transient"""
+        self.assertTrue(is_transient(operational_error()))
+        self.assertTrue(is_transient(operational_error("57P01")))  # admin shutdown
+        self.assertTrue(is_transient(operational_error("40001")))  # serialization failure
+        self.assertFalse(is_transient(operational_error("42P01")))  # undefined table
+        self.assertFalse(is_transient(exc.IntegrityError("INSERT", {}, FakePgError("23505"))))
+        self.assertFalse(is_transient(ValueError("bad")))
+
+    def test_breaker_opens_and_recovers(self):
+        """The breaker opens after repeated failures and closes after a good trial"""
+        clock = Clock()
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+        # after the reset timeout one trial call is let through
+        clock.now = 10
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.before_call()
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        stats = breaker.stats()
+        self.assertEqual(stats["times_opened"], 1)
+        self.assertEqual(stats["rejected_calls"], 2)
+
+    def test_failed_trial_reopens(self):
+        """A failed trial call opens the breaker again"""
+        clock = Clock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        clock.now = 10
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_retry_policy_retries_transient_errors(self):
+        """Transient errors are retried with bounded, jittered sleeps"""
+        sleeps = []
+        policy = RetryPolicy(tries=3, delay=0.1, backoff=2, max_delay=0.15, sleep=sleeps.append)
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise operational_error()
+            return "ok"
+
+        self.assertEqual(policy.call(flaky), "ok")
+        self.assertEqual(len(sleeps), 2)
+        self.assertTrue(0 <= sleeps[0] <= 0.1)
+        self.assertTrue(0 <= sleeps[1] <= 0.15)
+
+    def test_retry_policy_gives_up(self):
+        """Retries stop at the try limit, the budget or a permanent error"""
+        sleeps = []
+        policy = RetryPolicy(tries=2, sleep=sleeps.append)
+        self.assertRaises(exc.OperationalError, policy.call, self._raise, operational_error())
+        self.assertEqual(len(sleeps), 1)
+        policy = RetryPolicy(tries=5, delay=10, max_delay=10, budget=0, sleep=sleeps.append)
+        self.assertRaises(exc.OperationalError, policy.call, self._raise, operational_error())
+        self.assertEqual(len(sleeps), 1)
+        self.assertRaises(ValueError, policy.call, self._raise, ValueError("bad"))
+
+    def test_guarded_raises_error_class(self):
+        """Guarded calls fail fast with the configured error"""
+        breaker = CircuitBreaker(failure_threshold=1)
+        rollbacks = []
+        call = guarded(breaker, None, on_error=lambda: rollbacks.append(1), error_class=RuntimeError)(self._raise)
+        self.assertRaises(RuntimeError, call, operational_error())
+        self.assertEqual(rollbacks, [1])
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        # the database is not touched again while the circuit is open
+        self.assertRaises(RuntimeError, call, ValueError("never raised"))
+        self.assertEqual(rollbacks, [1])
+
+    def test_guarded_skips_retries(self):
+        """can_retry=False makes a single attempt, i.e. inside a transaction"""
+        breaker = CircuitBreaker(failure_threshold=5)
+        sleeps = []
+        policy = RetryPolicy(tries=3, sleep=sleeps.append)
+        call = guarded(breaker, policy, error_class=RuntimeError, can_retry=lambda: False)(self._raise)
+        self.assertRaises(RuntimeError, call, operational_error())
+        self.assertEqual(sleeps, [])
+
+    def test_guarded_passes_other_errors(self):
+        """Errors that are not transient do not trip the breaker"""
+        breaker = CircuitBreaker(failure_threshold=1)
+        call = guarded(breaker, RetryPolicy(sleep=lambda _: None))(self._raise)
+        self.assertRaises(ValueError, call, ValueError("bad"))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_nested_guarded_calls(self):
+        """A guarded call inside another one runs as part of the outer call"""
+        clock = Clock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        clock.now = 10
+        inner = guarded(breaker, error_class=RuntimeError)(lambda: "inner")
+        outer = guarded(breaker, error_class=RuntimeError)(lambda: inner())
+        # the inner call does not ask for a second trial slot
+        self.assertEqual(outer(), "inner")
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        # transient errors of an inner call reach the outer retry policy unwrapped
+        sleeps = []
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise operational_error()
+            return "ok"
+
+        inner = guarded(breaker, error_class=RuntimeError)(flaky)
+        outer = guarded(breaker, RetryPolicy(tries=3, sleep=sleeps.append), error_class=RuntimeError)(
+            lambda: inner())
+        self.assertEqual(outer(), "ok")
+        self.assertEqual(len(sleeps), 1)
+        self.assertEqual(breaker.stats()["consecutive_failures"], 0)
+
+    @staticmethod
+    def _raise(error):
+        raise error
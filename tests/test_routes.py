@@ -1,10 +1,17 @@
 import logging
 import os
+import shutil
+import tempfile
+from contextlib import contextmanager
 from unittest import TestCase
+from unittest.mock import patch
+from urllib.parse import urlencode
 from flask_api import status
 from factories import ItemFactory, WishlistFactory
 from service import APP_NAME, VERSION
-from service.models import db, init_db
+from service.profiler import profile_token
+from service.queries import capture_queries
+from service.models import db, cache, breaker, init_db
 from service.routes import app
 
 DATABASE_URI = os.getenv(
@@ -38,11 +45,29 @@ class TestResourceServer(TestCase):
         }
         db.drop_all()
         db.create_all()
+        cache.clear()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
 
+    def _count_queries(self, *args, **kwargs):
+        """Returns the response to a GET and the number of SQL statements it ran"""
+        cache.clear()
+        with capture_queries(db.engine) as statements:
+            resp = self.app.get(*args, **kwargs)
+            resp.get_data()  # runs a streamed body to the end
+        return resp, len(statements)
+
+    @contextmanager
+    def assertMaxQueries(self, limit, route=""):
+        """Fails if the block runs more than limit SQL statements, i.e. an N+1 query"""
+        with capture_queries(db.engine) as statements:
+            yield statements
+        self.assertLessEqual(len(statements), limit, "{} ran {} queries, at most {} expected:\n{}".format(
+            route or "The block", len(statements), limit, "\n".join(statements)
+        ))
+
     def _create_wishlists(self, count):
         """Factory method to create wishlists in bulk"""
         wishlists = []
@@ -91,11 +116,75 @@ class TestResourceServer(TestCase):
         response = self.app.get("/favicon.ico")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_pool_stats(self):
+        """Database pool statistics are reported"""
+        self.app.get(BASE_URL)
+        resp = self.app.get("/stats/pool")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["pool"], "InstrumentedQueuePool")
+        for key in ("size", "checked_out", "overflow", "checkouts", "checkout_latency_ms"):
+            self.assertIn(key, data)
+        self.assertGreater(data["checkouts"], 0)
+        self.assertEqual(data["checkout_latency_ms"]["+Inf"], data["checkouts"])
+
+    def test_logging_stats(self):
+        """Log queue statistics are reported"""
+        resp = self.app.get("/stats/logging")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["capacity"], app.config["LOG_QUEUE_SIZE"])
+        self.assertIn("dropped", data)
+
+    def test_open_circuit_returns_503(self):
+        """Requests fail fast with 503 while the database circuit is open"""
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        try:
+            resp = self.app.get(BASE_URL + "/1")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            resp = self.app.get("/stats/breaker")
+            self.assertEqual(resp.get_json()["state"], "open")
+        finally:
+            breaker.record_success()
+
     def test_list_wishlist(self):
         """List all wishlists"""
         resp = self.app.get(BASE_URL)
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_list_wishlist_streams_all(self):
+        """List all wishlists as a streamed JSON array"""
+        wishlists = self._create_wishlists(3)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.is_streamed)
+        data = resp.get_json()
+        self.assertEqual([w["id"] for w in data], [w.id for w in wishlists])
+
+    def test_list_wishlist_paginated(self):
+        """Page through wishlists with limit and after"""
+        wishlists = self._create_wishlists(5)
+        resp = self.app.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([w["id"] for w in data], [w.id for w in wishlists[:2]])
+        cursor = resp.headers.get("X-Next-Cursor")
+        self.assertEqual(cursor, str(wishlists[1].id))
+        self.assertIn('rel="next"', resp.headers.get("Link"))
+        # follow the cursor to the last page
+        resp = self.app.get(BASE_URL, query_string="limit=3&after={}".format(cursor))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([w["id"] for w in data], [w.id for w in wishlists[2:]])
+        self.assertIsNone(resp.headers.get("X-Next-Cursor"))
+        self.assertIsNone(resp.headers.get("Link"))
+
+    def test_list_wishlist_bad_limit(self):
+        """List wishlists with an out of range limit"""
+        resp = self.app.get(BASE_URL, query_string="limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_create_wishlist(self):
         """Create a wishlist"""
         test_wishlist = WishlistFactory()
@@ -137,6 +226,202 @@ class TestResourceServer(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_delete_wishlist_with_items(self):
+        """Delete a Wishlist and its Items, in the background when it has many"""
+        wishlists = self._create_wishlists(2)
+        for wishlist in wishlists:
+            items = [{"name": "item{}".format(n)} for n in range(3)]
+            resp = self.app.post("{0}/{1}/items:batch".format(BASE_URL, wishlist.id), json=items)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.delete("{0}/{1}".format(BASE_URL, wishlists[0].id))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get("{0}/{1}/items".format(BASE_URL, wishlists[0].id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        with patch("service.routes.PURGE_THRESHOLD", 2):
+            resp = self.app.delete("{0}/{1}".format(BASE_URL, wishlists[1].id))
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        purger = app.extensions["purger"]
+        purger.join()
+        resp = self.app.get("{0}/{1}".format(BASE_URL, wishlists[1].id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(purger.stats()["pending"], 0)
+        self.assertEqual(self.app.get("/stats/purge").get_json()["failed"], 0)
+
+    def test_metrics(self):
+        """Requests are measured per Resource and exposed to Prometheus"""
+        self._create_wishlists(2)
+        self.app.get("{0}/{1}".format(BASE_URL, 0))
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/plain; version=0.0.4"))
+        text = resp.get_data(as_text=True)
+        self.assertRegex(text, r'wishlists_http_requests_total\{resource="WishlistCollection",method="POST",status="201"\} \d+')
+        self.assertRegex(text, r'wishlists_http_requests_total\{resource="WishlistResource",method="GET",status="404"\} \d+')
+        self.assertIn('wishlists_http_request_duration_seconds_bucket{resource="WishlistCollection",method="POST",le="+Inf"}', text)
+        # the scrape itself is still in progress
+        self.assertIn('wishlists_http_requests_in_progress{resource="prometheus_metrics",method="GET"} 1', text)
+
+    def test_sync(self):
+        """A delta sync returns the changes and deletes since its cursor"""
+        wishlist = self._create_wishlists(1)[0]
+        url = "/api/sync?customer_id={}".format(wishlist.customer_id)
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([row["id"] for row in data["wishlists"]], [wishlist.id])
+        with patch("service.sync.SYNC_WINDOW", 0):
+            cursor = self.app.get(url).get_json()["cursor"]
+        self.app.delete("{0}/{1}".format(BASE_URL, wishlist.id))
+        resp = self.app.get(url + "&" + urlencode({"updated_since": cursor}))
+        data = resp.get_json()
+        self.assertEqual(data["wishlists"], [])
+        self.assertEqual(data["deleted"]["wishlists"], [wishlist.id])
+        self.assertEqual(data["updated_since"], cursor)
+        self.assertEqual(self.app.get("/api/sync").status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(url + "&updated_since=last+week")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(url + "&updated_since=2000-01-01T00:00:00Z")
+        self.assertEqual(resp.status_code, status.HTTP_410_GONE)
+
+    def test_sync_pages(self):
+        """A sync is paged by Wishlist and linked to its next page"""
+        for _ in range(3):
+            WishlistFactory(customer_id=7).create()
+        resp = self.app.get("/api/sync?customer_id=7&limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        first = resp.get_json()
+        self.assertEqual(len(first["wishlists"]), 2)
+        self.assertEqual(resp.headers["X-Next-Cursor"], str(first["after"]))
+        next_url = resp.headers["Link"].split(">")[0].lstrip("<")
+        resp = self.app.get(next_url)
+        last = resp.get_json()
+        self.assertEqual(len(last["wishlists"]), 1)
+        self.assertEqual(last["cursor"], first["cursor"])
+        self.assertIsNone(last["after"])
+        self.assertNotIn("Link", resp.headers)
+
+    def test_health(self):
+        """Liveness always answers, readiness follows the cached checks"""
+        resp = self.app.get("/health/live")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["status"], "alive")
+        health = app.extensions["health"]
+        health.ping()
+        resp = self.app.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        checks = resp.get_json()["checks"]
+        self.assertEqual(checks["database"]["status"], "up")
+        self.assertEqual(checks["breaker"]["state"], "closed")
+        self.assertIn("checked_out", checks["pool"])
+        with patch.object(breaker, "_state", breaker.OPEN), patch.object(breaker, "_opened_at", breaker.clock()):
+            resp = self.app.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.get_json()["status"], "unavailable")
+
+    def test_profile_request(self):
+        """A request with a signed X-Profile header is profiled, streamed body included"""
+        self._create_wishlists(2)
+        profiler = app.extensions["profiler"]
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with patch.object(profiler, "directory", directory), patch.object(profiler, "secret", "secret"):
+            headers = {"X-Profile": profile_token("secret")}
+            resp = self.app.get(BASE_URL, headers={"X-Profile": "1.forged"})
+            resp.get_data()
+            self.assertNotIn("X-Profile-Id", resp.headers)
+            resp = self.app.get(BASE_URL, headers=headers)
+            resp.get_data()
+            resp.close()
+            profile_id = resp.headers["X-Profile-Id"]
+            self.assertEqual(self.app.get("/profiles").status_code, status.HTTP_403_FORBIDDEN)
+            resp = self.app.get("/profiles?resource=WishlistCollection.get", headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual([meta["id"] for meta in resp.get_json()], [profile_id])
+            resp = self.app.get("/profiles/hot?resource=WishlistCollection.get&top=500", headers=headers)
+            functions = [function["function"] for function in resp.get_json()["functions"]]
+            self.assertIn("find_page_rows", functions)  # runs while the body streams
+            resp = self.app.get("/profiles/hot?sort=slowest", headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            resp = self.app.get("/profiles/{}.collapsed".format(profile_id), headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            resp.close()
+
+    def test_profiles_need_a_secret(self):
+        """Without PROFILE_SECRET the stored profiles are not served to anyone"""
+        profiler = app.extensions["profiler"]
+        with patch.object(profiler, "secret", ""), patch.object(profiler, "sample_rate", 1.0):
+            for url in ("/profiles", "/profiles/hot", "/profiles/1.pstats"):
+                resp = self.app.get(url, headers={"X-Profile": profile_token("")})
+                self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_query_budgets(self):
+        """No route runs more SQL statements than its budget (SQLite counts)"""
+        for wishlist in self._create_wishlists(2):
+            items = [{"name": "item{}".format(n)} for n in range(3)]
+            self.app.post("{0}/{1}/items:batch".format(BASE_URL, wishlist.id), json=items)
+        first, item = BASE_URL + "/1", BASE_URL + "/1/items/1"
+        budgets = [
+            ("get", BASE_URL, None, 1),
+            ("get", BASE_URL + "?expand=items", None, 2),
+            ("get", first, None, 1),
+            ("get", first + "?expand=items", None, 2),
+            ("put", first, {"name": "renamed", "customer_id": 1}, 7),  # moved: tombstone and Items touched
+            ("get", first + "/items", None, 2),
+            ("post", first + "/items", {"name": "new", "wishlist_id": 1}, 7),
+            ("get", item, None, 1),
+            ("put", item, {"name": "renamed", "wishlist_id": 1}, 7),
+            ("put", item + "/purchase", {}, 7),
+            ("put", first + "/items:purchase", {"all": True}, 8),
+            ("post", first + "/items:batch", [{"name": "a"}, {"name": "b"}], 8),
+            ("delete", first + "/items/2", None, 7),
+            ("get", "/api/search?q=item", None, 2),
+            ("delete", BASE_URL + "/2", None, 7),
+        ]
+        for method, url, body, limit in budgets:
+            cache.clear()
+            with self.assertMaxQueries(limit, "{} {}".format(method.upper(), url)):
+                if body is None:
+                    resp = getattr(self.app, method)(url)
+                else:
+                    resp = getattr(self.app, method)(url, json=body)
+                resp.get_data()
+            self.assertLess(resp.status_code, 300, url)
+
+    def test_server_timing(self):
+        """Responses report the statements they ran in Server-Timing"""
+        wishlist = self._create_wishlists(1)[0]
+        cache.clear()
+        resp = self.app.get("{0}/{1}".format(BASE_URL, wishlist.id))
+        self.assertRegex(resp.headers["Server-Timing"], r'^db;dur=[0-9.]+;desc="1 query", app;dur=[0-9.]+$')
+
+    def test_get_wishlist_conditional(self):
+        """Conditional GET of a Wishlist with ETag and Last-Modified"""
+        wishlist = self._create_wishlists(1)[0]
+        url = "{0}/{1}".format(BASE_URL, wishlist.id)
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+        self.assertIsNotNone(etag)
+        self.assertIsNotNone(last_modified)
+        self.assertEqual(resp.get_json()["version"], 1)
+        # the client's copy is current
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers.get("ETag"), etag)
+        self.assertEqual(len(resp.data), 0)
+        resp = self.app.get(url, headers={"If-Modified-Since": last_modified})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # an update changes the ETag
+        resp = self.app.put(
+            url, json={"name": "renamed", "customer_id": wishlist.customer_id},
+            content_type=CONTENT_TYPE_JSON
+        )
+        self.assertEqual(resp.get_json()["version"], 2)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers.get("ETag"), etag)
+
     def test_update_wishlist(self):
         """Update an existing Wishlist"""
         # create a wishlist to update
@@ -169,6 +454,27 @@ class TestResourceServer(TestCase):
         )
         self.assertEqual(resp2.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_update_invalidates_any_spelling_of_the_id(self):
+        """A write invalidates the cached Wishlist or Item however its id was spelled"""
+        wishlist = self._create_wishlists(1)[0]
+        item = ItemFactory(wishlist_id=wishlist.id)
+        item.create(wishlist.id)
+        padded = "{}/0{}".format(BASE_URL, wishlist.id)
+        item_url = "{}/items/0{}".format(padded, item.id)
+        self.assertEqual(self.app.get(padded).get_json()["name"], wishlist.name)
+        self.assertEqual(self.app.get(item_url).get_json()["name"], item.name)
+        self.app.put(
+            "{}/{}".format(BASE_URL, wishlist.id),
+            json={"name": "renamed", "customer_id": wishlist.customer_id}, headers=self.headers,
+        )
+        self.app.put(
+            "{}/{}/items/{}".format(BASE_URL, wishlist.id, item.id),
+            json={"name": "renamed item", "wishlist_id": wishlist.id}, headers=self.headers,
+        )
+        self.assertEqual(self.app.get(padded).get_json()["name"], "renamed")
+        self.assertEqual(self.app.get(item_url).get_json()["name"], "renamed item")
+        self.assertEqual(self.app.get(BASE_URL + "/abc").status_code, status.HTTP_404_NOT_FOUND)
+
     def test_read_wishlist_item_success(self):
         """Read a wishlist Item"""
         wishlist = WishlistFactory()
@@ -289,6 +595,94 @@ class TestResourceServer(TestCase):
         resp = self.app.post(ITEM_URL, headers=self.headers)
         self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
+    def test_create_items_batch(self):
+        """Create a batch of Items from a JSON array"""
+        wishlist = self._create_wishlists(1)[0]
+        batch = [{"name": "one"}, {"name": "two", "purchased": True}]
+        resp = self.app.post(
+            BASE_URL + "/{}/items:batch".format(wishlist.id),
+            json=batch, content_type=CONTENT_TYPE_JSON, headers=self.headers
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(len(data["created"]), 2)
+        self.assertEqual([r["id"] for r in data["results"]], data["created"])
+        resp = self.app.get(BASE_URL + "/{}/items".format(wishlist.id))
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_create_items_batch_partial(self):
+        """Create a batch of Items where some rows are invalid"""
+        wishlist = self._create_wishlists(1)[0]
+        batch = [{"name": "one"}, {"purchased": True}, "bad"]
+        resp = self.app.post(
+            BASE_URL + "/{}/items:batch".format(wishlist.id),
+            json=batch, content_type=CONTENT_TYPE_JSON, headers=self.headers
+        )
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        results = resp.get_json()["results"]
+        self.assertEqual([r["status"] for r in results], [201, 400, 400])
+
+    def test_create_items_batch_ndjson(self):
+        """Create a batch of Items from an NDJSON stream"""
+        wishlist = self._create_wishlists(1)[0]
+        body = '{"name": "one"}\n\n{"name": "two"}\nnot json\n'
+        resp = self.app.post(
+            BASE_URL + "/{}/items:batch".format(wishlist.id),
+            data=body, content_type="application/x-ndjson", headers=self.headers
+        )
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(len(data["created"]), 2)
+        self.assertEqual(data["results"][2]["status"], status.HTTP_400_BAD_REQUEST)
+
+    def test_create_items_batch_bad_requests(self):
+        """Create a batch of Items with bad input"""
+        wishlist = self._create_wishlists(1)[0]
+        url = BASE_URL + "/{}/items:batch".format(wishlist.id)
+        resp = self.app.post(url, json={"name": "one"}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(url, json=[{}], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(url, data="[]", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = self.app.post(BASE_URL + "/999/items:batch", json=[], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_purchase_items_bulk(self):
+        """Purchase many Items in one request"""
+        wishlist = self._create_wishlists(1)[0]
+        url = BASE_URL + "/{}/items:purchase".format(wishlist.id)
+        resp = self.app.post(
+            BASE_URL + "/{}/items:batch".format(wishlist.id),
+            json=[{"name": "one"}, {"name": "two", "purchased": True}, {"name": "three"}],
+            content_type=CONTENT_TYPE_JSON, headers=self.headers
+        )
+        ids = resp.get_json()["created"]
+        resp = self.app.put(url, json={"ids": ids[:2] + [999]}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {
+            "wishlist_id": wishlist.id,
+            "purchased": [ids[0]],
+            "already_purchased": [ids[1]],
+            "missing": [999],
+        })
+        resp = self.app.put(url, json={"all": True}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.get_json()["purchased"], [ids[2]])
+        resp = self.app.get(BASE_URL + "/{}/items".format(wishlist.id))
+        self.assertTrue(all(item["purchased"] for item in resp.get_json()))
+
+    def test_purchase_items_bulk_bad_requests(self):
+        """Purchase many Items with bad input"""
+        wishlist = self._create_wishlists(1)[0]
+        url = BASE_URL + "/{}/items:purchase".format(wishlist.id)
+        for body in ([1, 2], {"ids": ["1"]}, {"ids": [True]}, {"all": False}, {}):
+            resp = self.app.put(url, json=body, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, body)
+        resp = self.app.put(url, data="{}", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = self.app.put(BASE_URL + "/999/items:purchase", json={"all": True}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_delete_item(self):
         """Delete an Item"""
         test_item = self._create_items(1)[0]
@@ -428,7 +822,9 @@ class TestResourceServer(TestCase):
         )
         items = resp3.get_json()
         self.assertEqual(resp3.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp3.mimetype, CONTENT_TYPE_JSON)
         self.assertEqual(len(items), 1)
+        self.assertEqual(items[0], item_json)
 
         # get all items on non-existent wishlist
         resp4 = self.app.get(
@@ -437,6 +833,123 @@ class TestResourceServer(TestCase):
         )
         self.assertEqual(resp4.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_list_items_conditional(self):
+        """Conditional GET of the Items on a Wishlist"""
+        self._create_items(1)
+        resp = self.app.get(ITEM_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers.get("ETag")
+        resp = self.app.get(ITEM_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # adding an item bumps the wishlist version
+        test_item = ItemFactory(__sequence=1)
+        resp = self.app.post(ITEM_URL, json=test_item.serialize(), content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get(ITEM_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertNotEqual(resp.headers.get("ETag"), etag)
+
+    def test_list_items_filtered(self):
+        """List Items filtered, sorted and projected by the query string"""
+        wishlist = self._create_wishlists(1)[0]
+        url = BASE_URL + "/{}/items".format(wishlist.id)
+        self.app.post(
+            url + ":batch", json=[{"name": "apple"}, {"name": "apricot", "purchased": True}, {"name": "banana"}],
+            content_type=CONTENT_TYPE_JSON
+        )
+        resp = self.app.get(url, query_string={"purchased": "false", "sort": "-name", "fields": "name"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [{"name": "banana"}, {"name": "apple"}])
+        etag = resp.headers["ETag"]
+        self.assertNotEqual(etag, self.app.get(url).headers["ETag"])
+        resp = self.app.get(
+            url, query_string={"purchased": "false", "sort": "-name", "fields": "name"},
+            headers={"If-None-Match": etag}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # filters that match nothing are an empty list, not a 404
+        resp = self.app.get(url, query_string={"name": "zzz"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [])
+        for query in ({"sort": "wishlist_id"}, {"fields": "id,secret"}, {"purchased": "maybe"}):
+            resp = self.app.get(url, query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+    def test_count_items(self):
+        """Count Items with HEAD or count=true"""
+        wishlist = self._create_wishlists(1)[0]
+        url = BASE_URL + "/{}/items".format(wishlist.id)
+        self.app.post(
+            url + ":batch", json=[{"name": "apple"}, {"name": "apricot", "purchased": True}],
+            content_type=CONTENT_TYPE_JSON
+        )
+        resp = self.app.head(url, query_string={"purchased": "true"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["X-Total-Count"], "1")
+        self.assertEqual(resp.data, b"")
+        resp = self.app.get(url, query_string={"count": "true", "name": "ap"})
+        self.assertEqual(resp.get_json(), {"count": 2})
+        self.assertEqual(resp.headers["X-Total-Count"], "2")
+        resp = self.app.head(BASE_URL + "/999/items")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_search(self):
+        """Search names with a paginated endpoint"""
+        wishlist = self._create_wishlists(1)[0]
+        self.app.post(
+            BASE_URL + "/{}/items:batch".format(wishlist.id),
+            json=[{"name": "apple"}, {"name": "apricot"}, {"name": "pineapple"}], content_type=CONTENT_TYPE_JSON
+        )
+        resp = self.app.get("/api/search", query_string={"q": "ap", "type": "item", "limit": 1})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([result["name"] for result in resp.get_json()], ["apple"])
+        self.assertEqual(resp.headers["X-Next-Offset"], "1")
+        self.assertIn("offset=1", resp.headers["Link"])
+        resp = self.app.get("/api/search", query_string={"q": "ap", "type": "item", "offset": 1})
+        self.assertEqual([result["name"] for result in resp.get_json()], ["apricot"])
+        self.assertNotIn("Link", resp.headers)
+        resp = self.app.get("/api/search")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/api/search", query_string={"q": "ap", "type": "customer"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_wishlist_expand_items(self):
+        """Get a Wishlist with its Items nested"""
+        wishlist = self._create_wishlists(1)[0]
+        url = "{}/{}".format(BASE_URL, wishlist.id)
+        self.app.post(url + "/items:batch", json=[{"name": "one"}, {"name": "two"}], content_type=CONTENT_TYPE_JSON)
+        resp, queries = self._count_queries(url, query_string={"expand": "items"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([item["name"] for item in data["items"]], ["one", "two"])
+        self.assertEqual(data["version"], 2)
+        self.assertEqual(queries, 2)
+        self.assertNotEqual(resp.headers["ETag"], self.app.get(url).headers["ETag"])
+        self.assertNotIn("items", self.app.get(url).get_json())
+        resp = self.app.get(url, query_string={"expand": "wishlists"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_wishlists_expand_items(self):
+        """List Wishlists with their Items in a constant number of queries"""
+        counts = {}
+        for number in (2, 6):
+            db.drop_all()
+            db.create_all()
+            for wishlist in self._create_wishlists(number):
+                self.app.post(
+                    "{}/{}/items:batch".format(BASE_URL, wishlist.id),
+                    json=[{"name": "one"}, {"name": "two"}], content_type=CONTENT_TYPE_JSON
+                )
+            resp, counts[number, "page"] = self._count_queries(BASE_URL, query_string={"expand": "items", "limit": 10})
+            data = resp.get_json()
+            self.assertEqual(len(data), number)
+            self.assertTrue(all(len(wishlist["items"]) == 2 for wishlist in data))
+            resp, counts[number, "stream"] = self._count_queries(BASE_URL, query_string={"expand": "items"})
+            self.assertEqual(resp.get_json(), data)
+        self.assertEqual(counts[2, "page"], counts[6, "page"])
+        self.assertEqual(counts[2, "stream"], counts[6, "stream"])
+
     def test_list_all_items_on_empty_wishlist(self):
         """List items on an empty Wishlist"""
         test_wishlist = WishlistFactory()
@@ -0,0 +1,55 @@
+"""
+Test cases for the fast JSON serializers
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+
+"""
+import json
+import unittest
+from datetime import datetime
+from operator import itemgetter
+from service.models import Item, Wishlist, WISHLIST_SERIALIZED, serialize_item, serialize_wishlist
+from service.serializers import backend_from_name, compile_serializer, stdlib_dumps
+
+
+######################################################################
+#  S E R I A L I Z E R   T E S T   C A S E S
+######################################################################
+class TestSerializers(unittest.TestCase):
+    """Test Cases for the compiled serializers"""
+
+    def test_matches_serialize(self):
+        """Compiled serializers return the same dicts as serialize()"""
+        item = Item(id=3, name="book", wishlist_id=1, purchased=True)
+        self.assertEqual(serialize_item(item), item.serialize())
+        wishlist = Wishlist(
+            id=1, name="books", customer_id="7", version=2, updated_at=datetime(2021, 3, 1, 12, 30)
+        )
+        self.assertEqual(serialize_wishlist(wishlist), wishlist.serialize())
+        self.assertEqual(serialize_wishlist(wishlist)["updated_at"], "2021-03-01T12:30:00")
+
+    def test_converters_and_keys(self):
+        """Keys may differ from attributes and values can be converted"""
+        serialize = compile_serializer([("key", "name", str.upper), ("n", "id")])
+        self.assertEqual(serialize(Item(id=4, name="pen")), {"key": "PEN", "n": 4})
+
+    def test_records_read_by_key(self):
+        """The same field list serializes records read by key, like asyncpg's"""
+        record = {"id": 1, "name": "books", "customer_id": 7, "version": 2, "updated_at": datetime(2021, 3, 1)}
+        serialize = compile_serializer(WISHLIST_SERIALIZED, itemgetter)
+        self.assertEqual(serialize(record), dict(record, updated_at="2021-03-01T00:00:00"))
+
+    def test_bad_attribute(self):
+        """Only plain attribute names can be compiled"""
+        self.assertRaises(ValueError, compile_serializer, [("x", "name; import os")])
+
+    def test_backends(self):
+        """The stdlib backend is compact and unknown names fall back to it"""
+        self.assertEqual(stdlib_dumps([{"a": 1}]), b'[{"a":1}]')
+        name, dumps = backend_from_name("no-such-backend")
+        self.assertEqual(name, "json")
+        self.assertEqual(json.loads(dumps({"a": [1, 2]})), {"a": [1, 2]})
+        name, _ = backend_from_name("auto")
+        self.assertIn(name, ("json", "orjson"))
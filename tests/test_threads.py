@@ -0,0 +1,54 @@
+"""
+Test cases for the per-process background threads
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+
+"""
+import os
+import threading
+import unittest
+from service.threads import BackgroundThread
+
+
+######################################################################
+#  T H R E A D   T E S T   C A S E S
+######################################################################
+class TestBackgroundThread(unittest.TestCase):
+    """Test Cases for BackgroundThread"""
+
+    def test_starts_once(self):
+        """The thread is only started once per process"""
+        stop = threading.Event()
+        thread = BackgroundThread(stop.wait, "test-thread")
+        self.assertFalse(thread.running())
+        self.assertTrue(thread.start())
+        self.assertFalse(thread.start())
+        self.assertTrue(thread.running())
+        self.assertTrue(thread.thread.daemon)
+        self.assertEqual(thread.thread.name, "test-thread")
+        stop.set()
+        thread.thread.join()
+        # a thread that ended is started again
+        self.assertTrue(thread.start())
+        thread.thread.join()
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork()")
+    def test_restarts_after_fork(self):
+        """A forked process starts its own thread"""
+        stop = threading.Event()
+        thread = BackgroundThread(stop.wait, "test-thread")
+        thread.start()
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            started = not thread.running() and thread.start() and thread.running()
+            os.write(write, b"1" if started else b"0")
+            os._exit(0)
+        os.close(write)
+        self.assertEqual(os.read(read, 1), b"1")
+        os.close(read)
+        os.waitpid(pid, 0)
+        self.assertFalse(thread.start())
+        stop.set()
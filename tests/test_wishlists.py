@@ -13,7 +13,7 @@ import os
 import logging
 import unittest
 from werkzeug.exceptions import NotFound
-from service.models import Wishlist, DataValidationError, db
+from service.models import Wishlist, Item, DataValidationError, db, cache, init_db, breaker
 from service import app
 from factories import WishlistFactory
 
@@ -34,7 +34,7 @@ class TestWishlistModel(unittest.TestCase):
         app.config["DEBUG"] = False
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
-        Wishlist.init_db(app)
+        init_db(app)
 
     @classmethod
     def tearDownClass(cls):
@@ -45,6 +45,7 @@ class TestWishlistModel(unittest.TestCase):
         """This runs before each test"""
         db.drop_all()  # clean up the last tests
         db.create_all()  # make our sqlalchemy tables
+        cache.clear()  # cached rows do not survive the tables
 
     def tearDown(self):
         """This runs after each test"""
@@ -107,6 +108,47 @@ class TestWishlistModel(unittest.TestCase):
         wishlist.delete()
         self.assertEqual(len(Wishlist.all()), 0)
 
+    def test_write_closes_half_open_circuit(self):
+        """A single write is the trial call that closes a half open circuit"""
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        clock = breaker.clock
+        breaker.clock = lambda: clock() + breaker.reset_timeout
+        try:
+            self.assertEqual(breaker.state, breaker.HALF_OPEN)
+            wishlist = WishlistFactory()
+            wishlist.create()
+            wishlist.name = "k9"
+            wishlist.update()
+            self.assertEqual(breaker.state, breaker.CLOSED)
+        finally:
+            breaker.clock = clock
+            breaker.record_success()
+
+    def test_delete_cascades_to_items(self):
+        """Deleting a Wishlist deletes its Items in the database"""
+        wishlist = WishlistFactory()
+        wishlist.create()
+        Item.create_many(wishlist.id, [Item(name="a"), Item(name="b")])
+        other = WishlistFactory()
+        other.create()
+        Item.create_many(other.id, [Item(name="c")])
+        wishlist.delete()
+        self.assertEqual([item.name for item in Item.all()], ["c"])
+
+    def test_purge_a_wishlist(self):
+        """Purge a Wishlist a batch of Items at a time"""
+        wishlist = WishlistFactory()
+        wishlist.create()
+        Item.create_many(wishlist.id, [Item(name=str(n)) for n in range(5)])
+        self.assertTrue(Item.has_more_than(wishlist.id, 4))
+        self.assertFalse(Item.has_more_than(wishlist.id, 5))
+        self.assertEqual(Wishlist.purge(wishlist.id, batch_size=2), 5)
+        self.assertEqual(Wishlist.all(), [])
+        self.assertEqual(Item.all(), [])
+        # a Wishlist that is already gone is not an error
+        self.assertEqual(Wishlist.purge(wishlist.id), 0)
+
     def test_serialize_a_wishlist(self):
         """Test serialization of a Wishlist"""
         wishlist = WishlistFactory()
@@ -159,14 +201,6 @@ class TestWishlistModel(unittest.TestCase):
         self.assertEqual(wishlist.id, wishlists[1].id)
         self.assertEqual(wishlist.name, wishlists[1].name)
 
-    def test_find_by_customer_id(self):
-        """Find Wishlists by Customer"""
-        Wishlist(name="fido", customer_id=1).create()
-        Wishlist(name="kitty", customer_id=2).create()
-        wishlists = Wishlist.find_by_customer_id(2)
-        self.assertEqual(wishlists[0].customer_id, 2)
-        self.assertEqual(wishlists[0].name, "kitty")
-
     def test_find_or_404_found(self):
         """Find or return 404 found"""
         wishlists = WishlistFactory.create_batch(3)
@@ -181,3 +215,62 @@ class TestWishlistModel(unittest.TestCase):
     def test_find_or_404_not_found(self):
         """Find or return 404 NOT found"""
         self.assertRaises(NotFound, Wishlist.find_or_404, 0)
+
+    def test_find_page(self):
+        """Find a keyset page of Wishlists"""
+        for wishlist in WishlistFactory.create_batch(5):
+            wishlist.create()
+        page = Wishlist.find_page_rows(limit=2)
+        self.assertEqual([wishlist.id for wishlist in page], [1, 2])
+        page = Wishlist.find_page_rows(after=page[-1].id, limit=2)
+        self.assertEqual([wishlist.id for wishlist in page], [3, 4])
+        page = Wishlist.find_page_rows(after=4, limit=2)
+        self.assertEqual([wishlist.id for wishlist in page], [5])
+
+    def test_iter_pages(self):
+        """Walk every Wishlist one page at a time"""
+        for wishlist in WishlistFactory.create_batch(5):
+            wishlist.create()
+        Wishlist(name="kitty", customer_id=99).create()
+        wishlists = list(Wishlist.iter_pages(page_size=2))
+        self.assertEqual([wishlist.id for wishlist in wishlists], [1, 2, 3, 4, 5, 6])
+        wishlists = list(Wishlist.iter_pages(customer_id=99, page_size=2))
+        self.assertEqual(len(wishlists), 1)
+        self.assertEqual(wishlists[0].name, "kitty")
+        pages = list(Wishlist.pages(page_size=3))
+        self.assertEqual([[row.id for row in page] for page in pages], [[1, 2, 3], [4, 5, 6]])
+
+    def test_find_rows(self):
+        """Read Wishlist columns as plain rows outside the session"""
+        for wishlist in WishlistFactory.create_batch(3):
+            wishlist.create()
+        Wishlist(name="kitty", customer_id=99).create()
+        db.session.expunge_all()
+        rows = Wishlist.find_page_rows(after=1, limit=2)
+        self.assertEqual([row.id for row in rows], [2, 3])
+        self.assertEqual(len(db.session.identity_map), 0)
+        rows = Wishlist.find_page_rows(customer_id=99)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].name, "kitty")
+        self.assertEqual(rows[0].version, 1)
+        rows = list(Wishlist.iter_pages(page_size=3))
+        self.assertEqual([row.id for row in rows], [1, 2, 3, 4])
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_find_uses_cache(self):
+        """Find a Wishlist from the cache and invalidate it on writes"""
+        wishlist = Wishlist(name="fido", customer_id=1)
+        wishlist.create()
+        hits = cache.hits
+        self.assertEqual(Wishlist.find(wishlist.id).name, "fido")
+        db.session.expunge_all()
+        found = Wishlist.find(wishlist.id)
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertEqual(found.name, "fido")
+        # a cached wishlist can still be updated
+        found.name = "k9"
+        found.update()
+        db.session.expunge_all()
+        self.assertEqual(Wishlist.find(wishlist.id).name, "k9")
+        Wishlist.find(wishlist.id).delete()
+        self.assertIsNone(Wishlist.find(wishlist.id))